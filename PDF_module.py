@@ -2,75 +2,317 @@
 import os
 import re
 import multiprocessing
+import queue
+import threading
+import time
 import fitz
+from pdf_cache import PdfTextCache
+from worker_pool import WorkerPool
+from instrumentation import instrumentation
+
+ALL_PARTS_PATTERN = r"GEO\\?(?:.*?\\?)*([^\\]+)\.GEO" # Pattern for every part in a PDF (PDF-TAF compare tab)
+BATCH_TARGET_BYTES = 4 * 1024 * 1024 # Small PDFs are grouped into batches of about this size
+BATCH_MAX_FILES = 32 # Most PDFs in one batch so progress still updates regularly
+
+def build_pdf_batches(pdf_files, target_bytes=BATCH_TARGET_BYTES, max_files=BATCH_MAX_FILES):
+    """Groups the PDFs into batches for the worker pool. The largest PDFs come first (on their own if they are bigger than target_bytes) so they don't hold up the end of the search,
+    and small PDFs are grouped together so there are fewer tasks to send between processes. Returns a list of (file_paths, total_bytes)."""
+    sized = []
+    for file_path in pdf_files:
+        try:
+            sized.append((os.path.getsize(file_path), file_path))
+        except OSError:
+            sized.append((0, file_path)) # Let the worker report the error
+    sized.sort(key=lambda item: item[0], reverse=True)
+    
+    batches = []
+    batch, batch_bytes = [], 0
+    for size, file_path in sized:
+        if batch and (batch_bytes + size > target_bytes or len(batch) >= max_files):
+            batches.append((batch, batch_bytes))
+            batch, batch_bytes = [], 0
+        batch.append(file_path)
+        batch_bytes += size
+    if batch:
+        batches.append((batch, batch_bytes))
+    return batches
+
+GEO_CANDIDATE_PATTERN = re.compile(r"G\s*E\s*O", flags=re.IGNORECASE) # Where "GEO" would be once the whitespace is removed
+WHITESPACE_PATTERN = re.compile(r"\s+")
+
+def clean_page_text(text, fast=True):
+    """Removes all whitespace from the page text. In fast mode pages without a GEO reference return an empty string without being copied,
+    and only the text from the first GEO onwards is cleaned. Every search pattern starts with GEO, so the matches are the same as cleaning the whole page."""
+    if not fast:
+        return WHITESPACE_PATTERN.sub('', text)
+    candidate = GEO_CANDIDATE_PATTERN.search(text) # Scans the text without making a copy
+    if candidate is None:
+        return '' # Tool tables, sheet images etc.
+    return WHITESPACE_PATTERN.sub('', text[candidate.start():])
+
+batch_searchers = {} # One PdfSearcher per cache path in each worker process so the cache connection is reused between batches
+
+def search_pdf_batch(task):
+    """Searches a batch of PDFs in a worker process. task is (spec, file_paths, total_bytes) where spec comes from PdfSearcher.get_search_spec, so only the pattern
+    and not the whole searcher is sent to the worker. Returns (results, (pid, files, bytes, seconds, instrumentation data)) where results is a list of (file_path, search_pdf result)."""
+    (search_pattern, all_parts, cache_path, instrumentation_settings), file_paths, total_bytes = task
+    instrumentation.follow(instrumentation_settings) # Follow the main process
+    searcher = batch_searchers.get(cache_path)
+    if searcher is None:
+        searcher = batch_searchers[cache_path] = PdfSearcher(None, None, cache_path)
+    start = time.perf_counter()
+    with instrumentation.profile_thread():
+        results = [(file_path, searcher.search_pdf(file_path, all_parts, search_pattern)) for file_path in file_paths]
+    return results, (os.getpid(), len(file_paths), total_bytes, time.perf_counter() - start, instrumentation.worker_data())
+
+class WorkerThroughput:
+    """This class adds up the files, bytes and time of every batch per worker process so the throughput of each worker can be reported after a search."""
+    def __init__(self):
+        """Create the empty totals."""
+        self.workers = {} # pid -> [files, bytes, seconds]
+
+    def add(self, pid, files, total_bytes, seconds, instrumentation_data=None):
+        """Add the stats of one finished batch. The spans and counters collected by the worker (if the instrumentation is enabled) are merged into this process."""
+        instrumentation.merge(instrumentation_data)
+        totals = self.workers.setdefault(pid, [0, 0, 0.0])
+        totals[0] += files
+        totals[1] += total_bytes
+        totals[2] += seconds
+
+    def summary(self):
+        """Returns a line per worker with its files, MB and MB/s."""
+        lines = []
+        for pid, (files, total_bytes, seconds) in sorted(self.workers.items()):
+            rate = total_bytes / 1e6 / seconds if seconds else 0.0
+            lines.append(f"Worker {pid}: {files} PDFs, {total_bytes / 1e6:.1f} MB in {seconds:.1f} s ({rate:.1f} MB/s)")
+        return lines
 
 class PdfSearcher:
     """This class is used to search through a PDF file for a specific string or all parts in the TAF file. The search_string is used to search for a specific part in the TAF file."""
-    def __init__(self, search_string, directory):
-        """Passes the search_string and the TMT directory to the class."""
+    def __init__(self, search_string, directory, cache_path=None, fast_extract=True):
+        """Passes the search_string and the TMT directory to the class. If a cache_path is given the extracted page text is cached there (see PdfTextCache).
+        fast_extract skips the pages without GEO references when cleaning the page text (see clean_page_text)."""
         
         # Ensure that the search_string exists and remove all whitespace
         if search_string is not None:
             self.search_string = re.sub(r'\s+', '', search_string)  # Remove all whitespace for the search
         self.directory = directory
+        self.cache_path = cache_path
+        self.fast_extract = fast_extract
+        self.text_cache = None # Opened on first use in each process because database connections can't be sent to the worker processes
+
+    def __getstate__(self):
+        """Leave the cache connection out when the searcher is sent to a worker process."""
+        state = self.__dict__.copy()
+        state['text_cache'] = None
+        return state
 
-    def search_pdf(self, file_path, all_parts=False):
-        """Search for specific part in the PDF or return list of all parts in the TAF file."""
+    def get_page_texts(self, file_path):
+        """Returns the text of each page with all whitespace removed (from the first GEO onwards in fast mode). Cached text is used if the PDF hasn't changed, otherwise the pages are extracted with PyMuPDF.
+        Without a cache the pages are extracted one at a time so a search can stop at the first matching page."""
+        if self.cache_path is None:
+            with instrumentation.span('pdf.open'):
+                doc = fitz.open(file_path) # Open with PyMuPDF
+            with doc:
+                for page in doc:
+                    with instrumentation.span('pdf.extract'):
+                        text = clean_page_text(page.get_text(), self.fast_extract) # Clean up page text
+                    yield text
+            return
         
-        print(f"Searching through: {file_path}") # Debug print statement
+        if self.text_cache is None:
+            self.text_cache = PdfTextCache(self.cache_path)
+        stat_result = os.stat(file_path)
+        pages = self.text_cache.get_pages(file_path, stat_result)
+        
+        # Extract every page so the whole PDF can be cached
+        if pages is None:
+            with instrumentation.span('pdf.open'):
+                doc = fitz.open(file_path)
+            with doc, instrumentation.span('pdf.extract'):
+                pages = [clean_page_text(page.get_text(), self.fast_extract) for page in doc]
+            self.text_cache.put_pages(file_path, stat_result, pages)
+        else:
+            instrumentation.count('pdf.cache_hits')
+        yield from pages
+
+    def get_search_pattern(self, all_parts=False):
+        """Returns the regex pattern for the search string, or for every part if all_parts is set."""
+        if all_parts:
+            return ALL_PARTS_PATTERN
+        return rf"GEO\\.*?{self.search_string}.*?\.GEO"
+
+    def get_search_spec(self, all_parts=False):
+        """Returns the small (pattern, all_parts, cache_path, instrumentation settings) tuple that search_pdf_batch needs, so the searcher itself doesn't have to be sent to the workers."""
+        return self.get_search_pattern(all_parts), all_parts, self.cache_path, instrumentation.worker_settings()
+
+    def search_pdf(self, file_path, all_parts=False, search_pattern=None):
+        """Search for specific part in the PDF or return list of all parts in the TAF file. search_pattern overrides the pattern built from the search string."""
+        instrumentation.count('pdf.files_scanned')
         
         # Set the search_string depending on the all_parts flag
+        if search_pattern is None:
+            search_pattern = self.get_search_pattern(all_parts)
         if all_parts:
-            search_pattern = r"GEO\\?(?:.*?\\?)*([^\\]+)\.GEO"
             match_list = []
-        else:
-            search_pattern = rf"GEO\\.*?{self.search_string}.*?\.GEO"
-        pattern = re.compile(search_pattern, flags=re.IGNORECASE | re.DOTALL) # Compile the regex pattern
+        pattern = re.compile(search_pattern, flags=re.IGNORECASE | re.DOTALL) # Compile the regex pattern (re keeps the compiled patterns cached)
         
-        # Open the PDF file and search through it
+        # Open the PDF file (or its cached text) and search through it
         try:
-            doc = fitz.open(file_path) # OPen with PyMuPDF
-            
             # Go through the pages in the PDF
-            for page_num in range(len(doc)):
-                page = doc.load_page(page_num)
-                text = page.get_text()
+            for text in self.get_page_texts(file_path):
+                instrumentation.count('pdf.pages')
                 if text:
-                    text = re.sub(r'\s+', '', text) # Clean up page text
-                    
+                    instrumentation.count('pdf.bytes_scanned', len(text))
                     # Return list of all parts in TAF file (PDF-TAF compare tab)
                     if all_parts:
-                        matches = pattern.findall(text) # Find all matches for the regex pattern
-                        print(f"Matches: {matches}")
+                        with instrumentation.span('pdf.regex'):
+                            matches = pattern.findall(text) # Find all matches for the regex pattern
                         match_list.extend(matches) # Add the matches to the list
                     
                     # Return filepath of taf with matching part (PDF search tab)
                     else:
-                        if pattern.search(text):
-                            print(f"Match found in: {file_path}")
-                            doc.close()
+                        with instrumentation.span('pdf.regex'):
+                            found = pattern.search(text)
+                        if found:
+                            instrumentation.count('pdf.files_matched')
                             return file_path
             # Return list of all parts in TAF file (PDF-TAF compare tab)
             if all_parts:
-                print(f"Match List: {match_list}")
-                doc.close()
+                instrumentation.count('pdf.parts_found', len(match_list))
                 return match_list
-            # Print a message if no match is found in the current PDF
-            print(f"No match found in: {file_path}")
-            doc.close()
         except Exception as e:
             print(f"Error processing {file_path}: {e}")
         return None
 
-    def search_in_directory(self, update_callback):
-        """Search each PDF in the directory using multiprocessing. The update_callback is used to update the GUI with the results."""
-        pdf_files = [os.path.join(root, file) 
-                     for root, _, files in os.walk(self.directory)
-                     for file in files if file.endswith(".pdf")] # Create list of PDF files in the directory
+    def search_in_directory(self, update_callback, index=None, worker_pool=None):
+        """Search each PDF in the directory using multiprocessing. The update_callback is used to update the GUI with the results.
+        If a PdfPartIndex is given it is brought up to date (only new and changed PDFs are read) and the search is answered from the index.
+        If the application's WorkerPool is given it is used instead of starting a new pool."""
+        with instrumentation.span('pdf.list'):
+            pdf_files = [os.path.join(root, file) 
+                         for root, _, files in os.walk(self.directory)
+                         for file in files if file.endswith(".pdf")] # Create list of PDF files in the directory
+        
+        # Drop the cached text of PDFs that have been deleted
+        if self.cache_path is not None:
+            PdfTextCache(self.cache_path).prune(pdf_files, self.directory)
+        
+        # Answer the search from the part index
+        if index is not None:
+            index.update(pdf_files, worker_pool)
+            for result in index.search(self.search_string):
+                update_callback(result)
+            return
         
-        # Start new multiprocessing pool
+        # Batch the PDFs by size and only send the search spec to the workers
+        spec = self.get_search_spec()
+        tasks = [(spec, batch, batch_bytes) for batch, batch_bytes in build_pdf_batches(pdf_files)]
+        
+        # Use the application's pool if there is one, otherwise start new multiprocessing pool
         # https://docs.python.org/3/library/multiprocessing.html
-        with multiprocessing.Pool() as pool:
-            for result in pool.imap_unordered(self.search_pdf, pdf_files): # Pass the search_pdf function and the list of PDF files to the pool
-                if result: # Check if the result is not None and update the callback
-                    update_callback(result)
\ No newline at end of file
+        if worker_pool is not None:
+            batch_results = worker_pool.imap_unordered(search_pdf_batch, tasks)
+        else:
+            pool = multiprocessing.Pool()
+            batch_results = pool.imap_unordered(search_pdf_batch, tasks)
+        try:
+            for results, batch_stats in batch_results:
+                instrumentation.merge(batch_stats[4])
+                for _, result in results:
+                    if result: # Check if the result is not None and update the callback
+                        update_callback(result)
+        finally:
+            if worker_pool is None:
+                pool.terminate()
+
+class PdfSearchJob:
+    """This class runs a PDF search on a background thread so the Tk main loop keeps running. Messages are put on a queue as the search goes:
+    ('total', number_of_pdfs), ('result', pdf_path), ('progress', pdfs_done), ('stats', WorkerThroughput) and finally ('done', None) or ('cancelled', None).
+    The GUI polls the queue with root.after, and cancel() stops the search at the next finished PDF."""
+    def __init__(self, searcher, index=None, worker_pool=None):
+        """Passes the PdfSearcher (with the search string and directory), the optional PdfPartIndex and the application's WorkerPool to the job.
+        Without a WorkerPool the job starts its own pool and shuts it down when it finishes."""
+        self.searcher = searcher
+        self.index = index
+        self.worker_pool = worker_pool
+        self.queue = queue.Queue()
+        self.cancel_event = threading.Event()
+        self.thread = threading.Thread(target=self.run, daemon=True)
+
+    def start(self):
+        """Start the search thread."""
+        self.thread.start()
+
+    def cancel(self):
+        """Ask the search to stop. Worker processes are terminated when the thread notices."""
+        self.cancel_event.set()
+
+    def is_cancelled(self):
+        """Returns True if the search was cancelled."""
+        return self.cancel_event.is_set()
+
+    def run(self):
+        """Runs the search and puts the messages on the queue."""
+        with instrumentation.profile_thread():
+            self.search()
+        self.queue.put(('cancelled' if self.is_cancelled() else 'done', None))
+
+    def search(self):
+        """Lists the PDFs and searches them in the worker pool (the body of run)."""
+        try:
+            with instrumentation.span('pdf.list'):
+                pdf_files = [os.path.join(root, file)
+                             for root, _, files in os.walk(self.searcher.directory)
+                             for file in files if file.endswith(".pdf")] # Create list of PDF files in the directory
+            self.queue.put(('total', len(pdf_files)))
+            worker_pool = self.worker_pool or WorkerPool()
+            try:
+                if self.index is not None:
+                    self.run_indexed(pdf_files, worker_pool)
+                else:
+                    self.run_scan(pdf_files, worker_pool)
+            finally:
+                if worker_pool is not self.worker_pool:
+                    worker_pool.shutdown() # Only shut down the pool if the job started it
+        except Exception as e:
+            print(f"Error searching {self.searcher.directory}: {e}")
+
+    def run_indexed(self, pdf_files, worker_pool):
+        """Answers the search from the index straight away for the PDFs that haven't changed, then streams the matches from the new and changed PDFs as they are read."""
+        changed = self.index.find_changed(pdf_files)
+        changed_set = set(changed)
+        for result in self.index.search(self.searcher.search_string):
+            if result not in changed_set:
+                self.queue.put(('result', result))
+        done = len(pdf_files) - len(changed)
+        self.queue.put(('progress', done))
+        if not changed:
+            return
+
+        throughput = WorkerThroughput()
+        for file_path, refs in self.index.index_changed(changed, worker_pool, self.cancel_event, throughput): # No new PDFs are handed out once the search is cancelled
+            if self.is_cancelled():
+                return
+            if self.index.refs_match(refs, self.searcher.search_string):
+                self.queue.put(('result', file_path))
+            done += 1
+            self.queue.put(('progress', done))
+        self.queue.put(('stats', throughput))
+
+    def run_scan(self, pdf_files, worker_pool):
+        """Searches every PDF with the worker pool in size-ordered batches and streams the matches as soon as each batch is finished."""
+        done = 0
+        throughput = WorkerThroughput()
+        spec = self.searcher.get_search_spec()
+        tasks = [(spec, batch, batch_bytes) for batch, batch_bytes in build_pdf_batches(pdf_files)]
+        for results, batch_stats in worker_pool.imap_unordered(search_pdf_batch, tasks, self.cancel_event):
+            if self.is_cancelled():
+                return
+            throughput.add(*batch_stats)
+            for _, result in results:
+                if result:
+                    self.queue.put(('result', result))
+            done += len(results)
+            self.queue.put(('progress', done))
+        self.queue.put(('stats', throughput))
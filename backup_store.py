@@ -0,0 +1,172 @@
+# This module contains all code related to the TAF backup store
+import os
+import re
+import gzip
+import json
+import hashlib
+import datetime
+import threading
+from instrumentation import instrumentation
+
+class BackupRun:
+    """One update run in the backup store. Every TAF backed up during the run is recorded in the run's manifest (manifest.json in the run directory) with the hash of its contents."""
+    def __init__(self, store, run_id, run_dir):
+        self.store = store
+        self.run_id = run_id
+        self.run_dir = run_dir
+        self.entries = []
+        self.lock = threading.Lock() # TAFs are backed up from the commit threads
+
+    def add(self, file_path, data):
+        """Backs up the contents of a TAF (bytes) before it is changed. Returns the hash of the contents."""
+        with instrumentation.span('backup.write'):
+            digest = self.store.put_object(data)
+        with self.lock:
+            self.entries.append({'taf_file': os.path.basename(file_path), 'path': file_path, 'sha256': digest, 'size': len(data)})
+        return digest
+
+    def save(self, fsync=False):
+        """Writes the run's manifest."""
+        manifest = {'run_id': self.run_id, 'created': datetime.datetime.now().strftime('%Y-%m-%d %H:%M:%S'), 'files': sorted(self.entries, key=lambda entry: entry['path'])}
+        self.store.write_atomic(os.path.join(self.run_dir, 'manifest.json'), json.dumps(manifest, indent=1).encode('utf-8'), fsync)
+
+    def write_journal(self, state, entries):
+        """Records the run's commit journal (journal.json in the run directory) and marks the run as pending so an interrupted commit is found on the next start.
+        state is 'staging' while the new TAFs are written to their temporary files and 'commit' once they are all on disk and the renames start.
+        entries is the list of dictionaries describing each TAF (see FileManager.stage_taf_file)."""
+        journal = {'run_id': self.run_id, 'state': state, 'files': entries}
+        open(self.store.pending_path(self.run_id), 'a').close()
+        self.store.write_atomic(os.path.join(self.run_dir, 'journal.json'), json.dumps(journal, indent=1).encode('utf-8'), fsync=True)
+
+    def finish_journal(self):
+        """Marks the run's commit as finished. The journal is kept in the run directory as a record of the commit."""
+        self.store.finish_journal(self.run_id)
+
+class BackupStore:
+    """This class implements a content-addressed backup store. Each TAF version is hashed once (SHA-256) and stored once under objects/, optionally gzip compressed,
+    so backing up a TAF that is already in the store costs nothing. Every update run gets a small directory under runs/ with its manifest and change log.
+    The next run id is kept in a counter file so starting a run never lists the backup directory."""
+    def __init__(self, base_dir, compress=True):
+        """Passes the backup base directory to the class. With compress the objects are stored gzip compressed."""
+        self.base_dir = base_dir
+        self.compress = compress
+        self.objects_dir = os.path.join(base_dir, 'objects')
+        self.runs_dir = os.path.join(base_dir, 'runs')
+        self.pending_dir = os.path.join(base_dir, 'pending') # One empty marker file per run with an unfinished commit journal
+        self.counter_path = os.path.join(base_dir, 'next_run_id')
+        self.lock = threading.Lock()
+        os.makedirs(self.objects_dir, exist_ok=True)
+        os.makedirs(self.runs_dir, exist_ok=True)
+        os.makedirs(self.pending_dir, exist_ok=True)
+
+    @staticmethod
+    def write_atomic(file_path, data, fsync=False):
+        """Writes a file through a temporary file so it is never left half written. With fsync the data is flushed to disk before the rename."""
+        temp_path = f"{file_path}.{os.getpid()}.{threading.get_ident()}.tmp"
+        with open(temp_path, 'wb') as file:
+            file.write(data)
+            if fsync:
+                file.flush()
+                os.fsync(file.fileno())
+        os.replace(temp_path, file_path)
+
+    def object_path(self, digest, compressed=None):
+        """Returns the path of an object. Objects are spread over 256 sub folders by the first two characters of the hash."""
+        if compressed is None:
+            compressed = self.compress
+        return os.path.join(self.objects_dir, digest[:2], digest + ('.gz' if compressed else ''))
+
+    def put_object(self, data):
+        """Stores the bytes if they aren't in the store yet and returns their hash."""
+        digest = hashlib.sha256(data).hexdigest()
+        if os.path.exists(self.object_path(digest, True)) or os.path.exists(self.object_path(digest, False)):
+            return digest # Already stored by an earlier run (or earlier in this one)
+        os.makedirs(os.path.dirname(self.object_path(digest)), exist_ok=True)
+        self.write_atomic(self.object_path(digest), gzip.compress(data, 6) if self.compress else data)
+        return digest
+
+    def get_object(self, digest):
+        """Returns the bytes stored under a hash."""
+        if os.path.exists(self.object_path(digest, True)):
+            with gzip.open(self.object_path(digest, True), 'rb') as file:
+                return file.read()
+        with open(self.object_path(digest, False), 'rb') as file:
+            return file.read()
+
+    def read_next_run_id(self):
+        """Returns the next run id from the counter file. When there is no counter yet it is started after the highest run or old backup_N folder, which is the only time the directory is listed."""
+        try:
+            with open(self.counter_path, 'r') as file:
+                return int(file.read().strip())
+        except (FileNotFoundError, ValueError):
+            pattern = re.compile(r"(?:backup_|run_)(\d+)$")
+            existing = [int(match.group(1)) for directory in (self.base_dir, self.runs_dir) for name in os.listdir(directory) for match in [pattern.match(name)] if match]
+            return max(existing, default=0) + 1
+
+    def start_run(self):
+        """Creates the directory of a new run and returns its BackupRun. The run id comes from the counter file (O(1)) instead of listing the existing backups."""
+        with self.lock:
+            run_id = self.read_next_run_id()
+            while True:
+                run_dir = os.path.join(self.runs_dir, f'run_{run_id}')
+                try:
+                    os.makedirs(run_dir)
+                    break
+                except FileExistsError:
+                    run_id += 1 # Another instance of the program took this id
+            self.write_atomic(self.counter_path, str(run_id + 1).encode('ascii'))
+        return BackupRun(self, run_id, run_dir)
+
+    def pending_path(self, run_id):
+        """Returns the path of the marker file of a run with an unfinished commit journal."""
+        return os.path.join(self.pending_dir, f'run_{run_id}')
+
+    def pending_journals(self):
+        """Returns the list of journals (dictionaries, see BackupRun.write_journal) of the runs whose commit didn't finish. Only the small pending folder is listed."""
+        journals = []
+        for name in sorted(os.listdir(self.pending_dir)):
+            if not (name.startswith('run_') and name[4:].isdigit()):
+                continue
+            try:
+                with open(os.path.join(self.get_run_dir(int(name[4:])), 'journal.json'), 'r', encoding='utf-8') as file:
+                    journals.append(json.load(file))
+            except (FileNotFoundError, ValueError):
+                self.finish_journal(int(name[4:])) # Stopped before the journal was written so nothing was staged
+        return journals
+
+    def finish_journal(self, run_id):
+        """Removes the pending marker of a run."""
+        try:
+            os.remove(self.pending_path(run_id))
+        except FileNotFoundError:
+            pass
+
+    def get_run_dir(self, run_id):
+        """Returns the directory of a run."""
+        return os.path.join(self.runs_dir, f'run_{run_id}')
+
+    def load_manifest(self, run_id):
+        """Returns the manifest of a run as a dictionary (run_id, created and the list of files). Raises FileNotFoundError if the run doesn't exist."""
+        with open(os.path.join(self.get_run_dir(run_id), 'manifest.json'), 'r', encoding='utf-8') as file:
+            return json.load(file)
+
+    def list_runs(self):
+        """Returns the sorted list of run ids with a manifest."""
+        run_ids = []
+        for name in os.listdir(self.runs_dir):
+            if name.startswith('run_') and name[4:].isdigit() and os.path.exists(os.path.join(self.runs_dir, name, 'manifest.json')):
+                run_ids.append(int(name[4:]))
+        return sorted(run_ids)
+
+    def restore_run(self, run_id, target_dir=None):
+        """Puts back every TAF backed up in a run, as it was before the run changed it. The TAFs are written to their original paths, or into target_dir if one is given.
+        Returns the list of restored file paths."""
+        restored = []
+        for entry in self.load_manifest(run_id)['files']:
+            file_path = entry['path'] if target_dir is None else os.path.join(target_dir, entry['taf_file'])
+            data = self.get_object(entry['sha256'])
+            if hashlib.sha256(data).hexdigest() != entry['sha256']:
+                raise ValueError(f"Backup of {entry['taf_file']} in run {run_id} is corrupted")
+            self.write_atomic(file_path, data)
+            restored.append(file_path)
+        return restored
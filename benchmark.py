@@ -0,0 +1,224 @@
+# This module contains the benchmark runner for the TAF update, PDF search and PDF-TAF comparison (run on a corpus from corpus_generator.py)
+import os
+import io
+import sys
+import json
+import time
+import shutil
+import argparse
+import platform
+import tempfile
+import statistics
+import tracemalloc
+import contextlib
+from file_handling import FileManager
+from taf_index import TafIndex
+from corpus_generator import CorpusGenerator
+
+class Benchmark:
+    """One benchmark: run is timed, reset (if given) puts the corpus back afterwards without being timed. items and total_bytes describe the work of one run for the throughput."""
+    def __init__(self, name, run, items, total_bytes, reset=None):
+        self.name = name
+        self.run = run
+        self.items = items
+        self.total_bytes = total_bytes
+        self.reset = reset
+
+class BenchmarkRunner:
+    """This class times the application's entry points headlessly on a generated corpus. Every benchmark is run repeat times and the median is kept, then run once more under
+    tracemalloc for the peak memory of this process (the PDF search workers are separate processes and not included). The application's console output is discarded while a benchmark runs."""
+    def __init__(self, corpus_dir, repeat=3, measure_memory=True, compare_sample=100):
+        """Reads the corpus manifest (corpus.json). compare_sample is the number of programs compared by the comparison benchmarks."""
+        self.corpus_dir = corpus_dir
+        self.repeat = repeat
+        self.measure_memory = measure_memory
+        self.compare_sample = compare_sample
+        with open(os.path.join(corpus_dir, 'corpus.json'), 'r') as file:
+            self.manifest = json.load(file)
+        self.geo_dir = os.path.join(corpus_dir, self.manifest['geo_dir'])
+        self.taf_dir = os.path.join(corpus_dir, self.manifest['taf_dir'])
+        self.tmt_dir = os.path.join(corpus_dir, self.manifest['tmt_dir'])
+        self.work_dir = None # Backups and indexes of the run, deleted when the run finishes
+
+    @staticmethod
+    def directory_bytes(directory, extension):
+        """Returns (number of files, total bytes) of the files with the extension in a directory."""
+        count = total = 0
+        with os.scandir(directory) as entries:
+            for entry in entries:
+                if entry.name.lower().endswith(extension):
+                    count += 1
+                    total += entry.stat().st_size
+        return count, total
+
+    def get_file_manager(self):
+        """Returns a FileManager for the corpus with its backups and indexes in the work directory."""
+        with contextlib.redirect_stdout(io.StringIO()):
+            return FileManager(self.taf_dir, self.geo_dir, os.path.join(self.work_dir, 'backups'), self.work_dir)
+
+    def get_benchmarks(self, names=None):
+        """Returns the list of Benchmarks for the corpus (all of them, or only the given names, so the others aren't set up). The comparison benchmarks need PyMuPDF
+        and are skipped with a note if it isn't installed, the PDF benchmarks are only included if the corpus has PDFs."""
+        wanted = lambda name: not names or name in names
+        file_manager = self.get_file_manager()
+        taf_count, taf_bytes = self.directory_bytes(self.taf_dir, '.taf')
+        part_num = self.manifest['update_part']
+
+        def update_tafs():
+            """Updates every TAF referencing the most used part to a new revision (the GEO doesn't exist so the check is overridden, like answering Y)."""
+            file_manager.read_and_update_taf_files(part_num, 'ZZ', None, None, True)
+
+        def restore_tafs():
+            """Puts the TAFs changed by the update back from the backup store."""
+            file_manager.restore_backup_run(file_manager.backup_run.run_id)
+
+        def build_index():
+            """Builds the part to TAF index from scratch (what the first update after installing does)."""
+            db_path = os.path.join(self.work_dir, 'taf_index_build.db')
+            if os.path.exists(db_path):
+                os.remove(db_path)
+            index = TafIndex(self.taf_dir, db_path)
+            index.refresh()
+            index.close()
+
+        benchmarks = []
+        if wanted('taf_index_build'):
+            benchmarks.append(Benchmark('taf_index_build', build_index, taf_count, taf_bytes))
+        if wanted('taf_update'):
+            # The update benchmark measures an update with the index already built, like every update after the first
+            with contextlib.redirect_stdout(io.StringIO()):
+                file_manager.taf_index.refresh()
+            benchmarks.append(Benchmark('taf_update', update_tafs, taf_count, taf_bytes, restore_tafs))
+        pdf_names = [name for name in ('compare_native', 'compare_cached', 'pdf_search', 'compare_pdf') if wanted(name)]
+        if pdf_names and not CorpusGenerator.fitz_available():
+            print(f"PyMuPDF is not installed, skipping {', '.join(pdf_names)}.")
+            return benchmarks
+        pdf_count, pdf_bytes = self.directory_bytes(self.tmt_dir, '.pdf')
+        programs = sorted(name[:-4] for name in os.listdir(self.tmt_dir) if name.lower().endswith('.tmt'))[:self.compare_sample]
+
+        def compare(use_native):
+            """Returns the function comparing the sample programs with their TAFs, reading the parts from the PDFs or from the native files."""
+            from pdf_taf_checker import ComparePdfTaf # Needs PyMuPDF, so it's only imported when the comparison benchmarks are set up
+            def run():
+                for program in programs:
+                    ComparePdfTaf(os.path.join(self.tmt_dir, program + '.pdf'), file_manager, None, None, use_native).compare_pdf_taf()
+            return run
+        if wanted('compare_native'):
+            benchmarks.append(Benchmark('compare_native', compare(True), len(programs), 0))
+
+        def compare_cached():
+            """Returns the function comparing the sample programs again through the GUI's memoised ComparisonWorker (the first, untimed pass fills its cache)."""
+            from pdf_taf_checker import ComparisonWorker
+            worker = ComparisonWorker(file_manager)
+            def run():
+                for program in programs:
+                    worker.compare(os.path.join(self.tmt_dir, program + '.pdf'), True)
+            with contextlib.redirect_stdout(io.StringIO()):
+                run()
+            return run
+        if wanted('compare_cached'):
+            benchmarks.append(Benchmark('compare_cached', compare_cached(), len(programs), 0))
+        if pdf_count:
+            def search_pdfs():
+                """Searches every PDF for the most used part without the text cache."""
+                from PDF_module import PdfSearcher
+                PdfSearcher(part_num, self.tmt_dir).search_in_directory(lambda result: None)
+            if wanted('pdf_search'):
+                benchmarks.append(Benchmark('pdf_search', search_pdfs, pdf_count, pdf_bytes))
+            if wanted('compare_pdf'):
+                benchmarks.append(Benchmark('compare_pdf', compare(False), len(programs), 0))
+        return benchmarks
+
+    def time_benchmark(self, benchmark):
+        """Runs a benchmark repeat times (plus once under tracemalloc) and returns its result dictionary."""
+        runs = []
+        for _ in range(self.repeat):
+            with contextlib.redirect_stdout(io.StringIO()):
+                start = time.perf_counter()
+                benchmark.run()
+                runs.append(time.perf_counter() - start)
+                if benchmark.reset is not None:
+                    benchmark.reset()
+        seconds = statistics.median(runs)
+        result = {'seconds': round(seconds, 4), 'runs': [round(run, 4) for run in runs], 'items': benchmark.items, 'bytes': benchmark.total_bytes,
+                  'items_per_s': round(benchmark.items / seconds, 1) if seconds else None,
+                  'mb_per_s': round(benchmark.total_bytes / 1e6 / seconds, 2) if seconds and benchmark.total_bytes else None}
+        if self.measure_memory:
+            with contextlib.redirect_stdout(io.StringIO()):
+                tracemalloc.start()
+                try:
+                    benchmark.run()
+                    result['peak_memory_mb'] = round(tracemalloc.get_traced_memory()[1] / 1e6, 2)
+                finally:
+                    tracemalloc.stop()
+                    if benchmark.reset is not None:
+                        benchmark.reset()
+        return result
+
+    def run(self, names=None):
+        """Runs the benchmarks (all of them, or only the given names) and returns the results dictionary that is saved as JSON."""
+        self.work_dir = tempfile.mkdtemp(prefix='taf_benchmark_')
+        try:
+            results = {}
+            for benchmark in self.get_benchmarks(names):
+                print(f"Running {benchmark.name}...")
+                results[benchmark.name] = self.time_benchmark(benchmark)
+                print(f"    {results[benchmark.name]['seconds']:.3f} s, {results[benchmark.name]['items_per_s']} items/s")
+        finally:
+            shutil.rmtree(self.work_dir, ignore_errors=True)
+            self.work_dir = None
+        return {'created': time.strftime('%Y-%m-%d %H:%M:%S'), 'python': platform.python_version(), 'platform': platform.platform(), 'cpu_count': os.cpu_count(),
+                'repeat': self.repeat, 'corpus': self.manifest, 'results': results}
+
+def compare_with_baseline(results, baseline, tolerance=0.2):
+    """Compares the results with a baseline (an earlier results file). Returns (lines, regressions) where lines describe every benchmark in both
+    and regressions lists the benchmarks more than tolerance (0.2 = 20%) slower or using more peak memory than the baseline."""
+    lines, regressions = [], []
+    if baseline.get('corpus', {}).get('seed') != results['corpus'].get('seed') or baseline.get('corpus', {}).get('tafs') != results['corpus'].get('tafs'):
+        lines.append("Warning: the baseline was run on a different corpus.")
+    for name, result in results['results'].items():
+        old = baseline.get('results', {}).get(name)
+        if old is None:
+            lines.append(f"{name}: no baseline")
+            continue
+        ratio = result['seconds'] / old['seconds'] if old['seconds'] else 1.0
+        line = f"{name}: {result['seconds']:.3f} s vs {old['seconds']:.3f} s ({(ratio - 1) * 100:+.1f}%)"
+        regressed = ratio > 1 + tolerance
+        if 'peak_memory_mb' in result and old.get('peak_memory_mb'):
+            memory_ratio = result['peak_memory_mb'] / old['peak_memory_mb']
+            line += f", peak {result['peak_memory_mb']:.1f} MB vs {old['peak_memory_mb']:.1f} MB ({(memory_ratio - 1) * 100:+.1f}%)"
+            regressed = regressed or memory_ratio > 1 + tolerance
+        if regressed:
+            regressions.append(name)
+            line += " REGRESSION"
+        lines.append(line)
+    return lines, regressions
+
+def main(argv=None):
+    """Command line entry point. Returns 1 if a benchmark regressed against the baseline so it can be used in scripts."""
+    parser = argparse.ArgumentParser(description="Benchmark the TAF update, PDF search and PDF-TAF comparison on a corpus from corpus_generator.py")
+    parser.add_argument("corpus_dir", help="corpus directory (with corpus.json)")
+    parser.add_argument("--output", metavar="JSON", help="file to save the results in")
+    parser.add_argument("--baseline", metavar="JSON", help="earlier results to compare with")
+    parser.add_argument("--tolerance", type=float, default=0.2, help="allowed slowdown against the baseline before it counts as a regression (0.2 = 20%%)")
+    parser.add_argument("--repeat", type=int, default=3, help="timed runs per benchmark (the median is kept)")
+    parser.add_argument("--no-memory", action="store_true", help="skip the tracemalloc run")
+    parser.add_argument("--only", nargs="+", metavar="NAME", help="only run these benchmarks (taf_index_build, taf_update, compare_native, compare_cached, pdf_search, compare_pdf)")
+    args = parser.parse_args(argv)
+
+    results = BenchmarkRunner(args.corpus_dir, args.repeat, not args.no_memory).run(args.only)
+    if args.output:
+        with open(args.output, 'w') as file:
+            json.dump(results, file, indent=1)
+        print(f"Results written to {args.output}")
+    if args.baseline:
+        with open(args.baseline, 'r') as file:
+            lines, regressions = compare_with_baseline(results, json.load(file), args.tolerance)
+        for line in lines:
+            print(line)
+        if regressions:
+            return 1
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
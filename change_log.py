@@ -0,0 +1,65 @@
+# This module contains all code related to the change logs of the TAF updates
+import os
+import json
+import time
+from instrumentation import instrumentation
+
+class ChangeLog:
+    """This class buffers the change log entries of one update run and writes them in a single flush. The run directory gets the usual change_log.txt (same text format as always)
+    and a change_log.jsonl with one JSON object per change (run id, time, file, part, old and new revision, duration of the run).
+    The JSON lines are also appended to the history file shared by all runs so part histories can be looked up without reading every run's log."""
+    def __init__(self, run_id, run_dir, history_path):
+        """Passes the run id, the run directory and the path of the shared history file (JSON Lines) to the class."""
+        self.run_id = run_id
+        self.run_dir = run_dir
+        self.history_path = history_path
+        self.start = time.time()
+        self.entries = [] # (time, taf_file, part_num, new_revision, old_revision)
+
+    def add(self, taf_file, part_num, revision, old_ver):
+        """Adds an entry to the log. Nothing is written until flush."""
+        self.entries.append((time.time(), taf_file, part_num, revision, old_ver))
+
+    def flush(self):
+        """Writes the buffered entries: one append to the history file, then the run's JSON Lines and text logs (each written in one go). The buffer is emptied."""
+        if not self.entries:
+            return
+        duration = round(time.time() - self.start, 3)
+        timestamps = {} # Every entry of a run is logged within a few seconds so each second is only formatted once
+        text_lines, json_lines = [], []
+        for entry_time, taf_file, part_num, revision, old_ver in self.entries:
+            second = int(entry_time)
+            if second not in timestamps:
+                timestamps[second] = time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(second))
+            timestamp = timestamps[second]
+            text_lines.append(f"{timestamp} - 'Modified: {taf_file} - Part Number: {part_num} - New Revision: {revision} - Old Revision: {old_ver}'\n") # Writes the date, time, taf, part, and new revision to the log file
+            json_lines.append(json.dumps({'run_id': self.run_id, 'time': timestamp, 'file': taf_file, 'part': part_num, 'old_revision': old_ver, 'new_revision': revision, 'duration': duration}) + '\n')
+
+        # The history is written first. If the run is interrupted before its own logs are written the recovery logs it again and the duplicate history lines are ignored by the queries.
+        with instrumentation.span('log.write'):
+            with open(self.history_path, 'a', encoding='utf-8') as history_file:
+                history_file.write(''.join(json_lines))
+            with open(os.path.join(self.run_dir, 'change_log.jsonl'), 'a', encoding='utf-8') as json_file:
+                json_file.write(''.join(json_lines))
+            with open(os.path.join(self.run_dir, 'change_log.txt'), 'a') as log_file:
+                log_file.write(''.join(text_lines))
+        self.entries = []
+
+def read_history(history_path):
+    """Returns the list of entries (dictionaries) in a history file, without duplicates, oldest first. Lines that can't be read (for example cut off by a crash) are skipped."""
+    entries = []
+    seen = set()
+    try:
+        with open(history_path, 'r', encoding='utf-8') as history_file:
+            for line in history_file:
+                try:
+                    entry = json.loads(line)
+                except ValueError:
+                    continue
+                key = (entry.get('run_id'), entry.get('file'), entry.get('part'))
+                if key not in seen:
+                    seen.add(key)
+                    entries.append(entry)
+    except FileNotFoundError:
+        pass
+    return entries
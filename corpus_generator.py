@@ -0,0 +1,184 @@
+# This module contains the generator of the synthetic TAF/GEO/TMT/PDF corpus used by the benchmarks
+import os
+import re
+import sys
+import json
+import random
+import shutil
+import argparse
+from taf_model import parse_taf
+
+TEMPLATE_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'TEST_TAFS')
+GEO_TEMPLATE = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'TEST_GEOS', 'HEX-P1-9005-00_02.GEO')
+TEMPLATE_NAME = 'BCL002' # TAF, TMT and technology protocol of the same program, used as the templates of every generated program
+REVISIONS = ['01', '02', '03', '04', 'A', 'B'] # Numbered (design) revisions first, then lettered (production) ones
+
+class ProgramTemplate:
+    """One template file (TAF, TMT or technology protocol). The GEO names of the template parts are replaced with the parts of each generated program,
+    so everything else in the file (headers, placements, machining data) is kept as TruTops wrote it."""
+    def __init__(self, file_path, template_parts):
+        """Reads the template file. template_parts is the list of part names (GEO name without extension) in the template program."""
+        with open(file_path, 'rb') as file:
+            self.data = file.read()
+        self.template_parts = template_parts
+        self.pattern = re.compile(b'|'.join(re.escape(part.encode('latin-1') + b'.GEO') for part in sorted(template_parts, key=len, reverse=True)), flags=re.IGNORECASE)
+
+    def render(self, parts):
+        """Returns the template with the template parts replaced by parts (same order, cycled if there are fewer)."""
+        names = {template_part.lower().encode('latin-1') + b'.geo': (parts[index % len(parts)] + '.GEO').encode('latin-1')
+                 for index, template_part in enumerate(self.template_parts)}
+        return self.pattern.sub(lambda match: names[match.group(0).lower()], self.data)
+
+class CorpusGenerator:
+    """This class generates a reproducible benchmark corpus from the sample files: a GEO directory with several revisions of every part, a TAF directory with a technology protocol
+    for every program and a TMT directory with the TMT and PDF of every program. Programs mostly use the latest GEO revision; some use an older one (newer GEO exists) and some PDFs
+    have a different revision than their TAF, so the comparison sees every state. The same seed always gives the same corpus. corpus.json describes it for the benchmark runner."""
+    def __init__(self, output_dir, tafs=2000, geos=5000, programs=200, seed=1, template_name=TEMPLATE_NAME, link_geos=True):
+        """Sets the output directory and the size of the corpus. programs is the number of TAFs that also get a TMT, PDF and technology protocol.
+        With link_geos every GEO is a hard link to the GEO template (the application only lists the GEO directory), which keeps a 100k GEO corpus small."""
+        self.output_dir = output_dir
+        self.taf_count = tafs
+        self.geo_count = geos
+        self.program_count = min(programs, tafs)
+        self.random = random.Random(seed)
+        self.seed = seed
+        self.link_geos = link_geos
+        self.geo_dir = os.path.join(output_dir, 'GEO')
+        self.taf_dir = os.path.join(output_dir, 'TAF')
+        self.tmt_dir = os.path.join(output_dir, 'TMT')
+        self.template_parts = parse_taf(os.path.join(TEMPLATE_DIR, template_name + '.TAF')).get_parts()
+        self.taf_template = ProgramTemplate(os.path.join(TEMPLATE_DIR, template_name + '.TAF'), self.template_parts)
+        self.tmt_template = ProgramTemplate(os.path.join(TEMPLATE_DIR, template_name + '.TMT'), self.template_parts)
+        self.protocol_template = ProgramTemplate(os.path.join(TEMPLATE_DIR, template_name + '.doc'), self.template_parts)
+        self.revisions = {} # Part number -> list of generated revisions, oldest first
+
+    def generate(self):
+        """Writes the whole corpus and returns the manifest (also written to corpus.json)."""
+        for directory in (self.geo_dir, self.taf_dir, self.tmt_dir):
+            os.makedirs(directory, exist_ok=True)
+        self.generate_geos()
+        references = self.generate_programs()
+        update_part = max(sorted(references), key=lambda part: references[part]) # Part referenced by the most TAFs, used for the update and search benchmarks
+        manifest = {'seed': self.seed, 'geo_dir': 'GEO', 'taf_dir': 'TAF', 'tmt_dir': 'TMT',
+                    'geos': self.geo_count, 'tafs': self.taf_count, 'programs': self.program_count, 'pdfs': self.program_count if self.fitz_available() else 0,
+                    'update_part': update_part, 'update_part_tafs': references[update_part]}
+        with open(os.path.join(self.output_dir, 'corpus.json'), 'w') as file:
+            json.dump(manifest, file, indent=1)
+        return manifest
+
+    def generate_geos(self):
+        """Creates geo_count GEO files spread over parts with one to four revisions each."""
+        written = 0
+        number = 0
+        while written < self.geo_count:
+            number += 1
+            part = f"BEN-P{number % 10}-{number:05d}-00"
+            revisions = REVISIONS[:self.random.randint(1, 4)]
+            if self.random.random() < 0.3:
+                revisions = revisions[:-1] + ['A'] # Released parts have a lettered revision
+            revisions = revisions[:self.geo_count - written]
+            self.revisions[part] = revisions
+            for revision in revisions:
+                self.write_geo(os.path.join(self.geo_dir, f"{part}_{revision}.GEO"))
+            written += len(revisions)
+
+    def write_geo(self, geo_path):
+        """Creates one GEO from the GEO template."""
+        if os.path.exists(geo_path):
+            return
+        if self.link_geos:
+            try:
+                os.link(GEO_TEMPLATE, geo_path)
+                return
+            except OSError:
+                self.link_geos = False # Hard links aren't supported on this drive, copy instead
+        shutil.copyfile(GEO_TEMPLATE, geo_path)
+
+    def pick_parts(self):
+        """Returns the part names (with revisions) of one program. Most parts use their latest revision and about one in ten an older one."""
+        parts = []
+        for part in self.random.sample(sorted(self.revisions), len(self.template_parts)):
+            revisions = self.revisions[part]
+            revision = revisions[-1] if len(revisions) == 1 or self.random.random() < 0.9 else self.random.choice(revisions[:-1])
+            parts.append(f"{part}_{revision}")
+        return parts
+
+    def generate_programs(self):
+        """Writes the TAFs and, for the first program_count of them, the technology protocol, TMT and PDF. Returns a dictionary of part number -> number of TAFs referencing it."""
+        references = {}
+        write_pdf = self.get_pdf_writer()
+        for number in range(1, self.taf_count + 1):
+            name = f"BENCH_{number:06d}"
+            parts = self.pick_parts()
+            for part in parts:
+                part_num = part.rsplit('_', 1)[0]
+                references[part_num] = references.get(part_num, 0) + 1
+            # Lowercase extension because the comparison looks for <program>.taf and the benchmarks may run on a case-sensitive file system
+            with open(os.path.join(self.taf_dir, name + '.taf'), 'wb') as file:
+                file.write(self.taf_template.render(parts))
+            if number > self.program_count:
+                continue
+
+            # The program (TMT and PDF) occasionally has a different revision than its TAF
+            program_parts = list(parts)
+            if self.random.random() < 0.1:
+                index = self.random.randrange(len(program_parts))
+                part_num = program_parts[index].rsplit('_', 1)[0]
+                program_parts[index] = f"{part_num}_{self.random.choice(REVISIONS)}"
+            with open(os.path.join(self.taf_dir, name + '.doc'), 'wb') as file:
+                file.write(self.protocol_template.render(program_parts))
+            with open(os.path.join(self.tmt_dir, name + '.TMT'), 'wb') as file:
+                file.write(self.tmt_template.render(program_parts))
+            if write_pdf is not None:
+                write_pdf(os.path.join(self.tmt_dir, name + '.pdf'), name, program_parts)
+        return references
+
+    @staticmethod
+    def fitz_available():
+        """Returns True if PyMuPDF is installed, which is needed to write the PDFs."""
+        try:
+            import fitz # Only needed for the PDFs
+            return True
+        except ImportError:
+            return False
+
+    def get_pdf_writer(self):
+        """Returns the function that writes the PDF of a program, or None (after a warning) if PyMuPDF isn't installed."""
+        if not self.fitz_available():
+            print("PyMuPDF is not installed, no PDFs are generated.")
+            return None
+        import fitz
+
+        def write_pdf(pdf_path, name, parts):
+            """Writes a setup sheet like the TruTops printout: a cover page, one line per part with its GEO path and quantity, and a tool table without GEO references."""
+            document = fitz.open()
+            page = document.new_page()
+            page.insert_text((50, 60), f"Program {name}\nSheet 1\n", fontsize=12)
+            quantities = random.Random(f"{self.seed}-{name}") # Separate generator so the rest of the corpus is the same with or without PyMuPDF
+            lines = [f"{index + 1}  T:\\Workfiles\\User1\\GEO\\{part}.GEO  Qty {quantities.randint(1, 12)}" for index, part in enumerate(parts)]
+            page.insert_text((50, 120), "\n".join(lines), fontsize=9)
+            document.new_page().insert_text((50, 60), "\n".join(f"Tool {tool}  Laser cut  {tool * 0.5:.1f} mm" for tool in range(1, 30)), fontsize=9)
+            document.save(pdf_path)
+            document.close()
+        return write_pdf
+
+def main(argv=None):
+    """Command line entry point. Example (the full-size corpus): python corpus_generator.py bench_corpus --tafs 50000 --geos 100000 --programs 5000"""
+    parser = argparse.ArgumentParser(description="Generate a synthetic TAF/GEO/TMT/PDF corpus for the benchmarks from the sample files")
+    parser.add_argument("output_dir", help="directory to write the corpus into")
+    parser.add_argument("--tafs", type=int, default=2000, help="number of TAF files")
+    parser.add_argument("--geos", type=int, default=5000, help="number of GEO files")
+    parser.add_argument("--programs", type=int, default=200, help="number of programs with a TMT, PDF and technology protocol")
+    parser.add_argument("--seed", type=int, default=1, help="random seed (the same seed gives the same corpus)")
+    parser.add_argument("--copy-geos", action="store_true", help="copy the GEO template instead of hard linking it")
+    args = parser.parse_args(argv)
+    if os.path.exists(os.path.join(args.output_dir, 'corpus.json')):
+        print(f"{args.output_dir} already contains a corpus.")
+        return 1
+    generator = CorpusGenerator(args.output_dir, args.tafs, args.geos, args.programs, args.seed, link_geos=not args.copy_geos)
+    manifest = generator.generate()
+    print(json.dumps(manifest, indent=1))
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
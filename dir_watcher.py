@@ -0,0 +1,120 @@
+# This module contains the background watcher that keeps the GEO, TAF and TMT listings up to date
+import os
+import threading
+from instrumentation import instrumentation
+
+ADDED, REMOVED, MODIFIED = 'added', 'removed', 'modified' # Event kinds
+
+class WatchedDirectory:
+    """One directory watched by the DirectoryWatcher. files is the latest snapshot (file name -> (modification time, size)) and is None until the first scan
+    has been published, which is only after on_start has returned. Once files is set the subscriber has caught up with the directory."""
+    def __init__(self, directory, match, callback, on_start=None):
+        self.directory = directory
+        self.match = match # Function returning True for the file names to watch
+        self.callback = callback # Called with the list of (kind, name, stat_result) events of each scan that found changes
+        self.on_start = on_start # Called once after the first scan so the subscriber can catch up with anything that changed before the watcher started
+        self.files = None
+        self.error = None # Last listing error, so a disconnected share is only reported once
+
+    def get_names(self):
+        """Returns the sorted list of file names in the latest snapshot, or None if the directory hasn't been scanned yet (or its subscriber is still catching up)."""
+        files = self.files # The snapshot is replaced (never changed in place) by the watcher thread so it can be read from any thread
+        return None if files is None else sorted(files)
+
+class DirectoryWatcher:
+    """This class polls directories in a background thread and publishes added, removed and modified files to the subscribers of each directory.
+    It lists each directory with os.scandir and compares the modification time and size of every file with the previous snapshot, which works on network shares
+    without native change notifications (and on Windows the listing already includes the file stats). Callbacks run on the watcher thread, so GUI subscribers have to hand the events to the Tk thread."""
+    def __init__(self, interval=5.0):
+        """Sets the number of seconds between scans."""
+        self.interval = interval
+        self.watched = []
+        self.poll_lock = threading.Lock() # Held while a directory is scanned and its subscriber called, so unwatch can wait for it
+        self.stop_event = threading.Event()
+        self.thread = None
+
+    def watch(self, directory, match, callback, on_start=None):
+        """Adds a directory to the watcher and returns its WatchedDirectory. See WatchedDirectory for the arguments."""
+        watched = WatchedDirectory(directory, match, callback, on_start)
+        self.watched.append(watched)
+        return watched
+
+    def unwatch(self, watched):
+        """Removes a WatchedDirectory from the watcher (for example when the directories are changed). Waits for a scan that is running,
+        so the subscriber is never called again once unwatch returns and can be closed."""
+        with self.poll_lock:
+            if watched in self.watched:
+                self.watched.remove(watched)
+
+    def start(self):
+        """Starts the watcher thread."""
+        if self.thread is None:
+            self.thread = threading.Thread(target=self.run, daemon=True)
+            self.thread.start()
+
+    def stop(self):
+        """Stops the watcher thread. Called when the application closes."""
+        self.stop_event.set()
+        if self.thread is not None:
+            self.thread.join(timeout=self.interval + 1)
+            self.thread = None
+
+    def run(self):
+        """Scans every watched directory until the watcher is stopped."""
+        while not self.stop_event.is_set():
+            for watched in list(self.watched):
+                with self.poll_lock:
+                    if watched in self.watched: # Skip directories unwatched since the loop started
+                        with instrumentation.profile_thread():
+                            self.poll(watched)
+            self.stop_event.wait(self.interval)
+
+    @staticmethod
+    def scan(watched):
+        """Returns the snapshot (file name -> (stat_result, signature)) of a watched directory."""
+        files = {}
+        with instrumentation.span('watch.scan'), os.scandir(watched.directory) as entries:
+            for entry in entries:
+                if watched.match(entry.name) and entry.is_file():
+                    stat_result = entry.stat()
+                    files[entry.name] = (stat_result, (stat_result.st_mtime_ns, stat_result.st_size))
+        return files
+
+    def poll(self, watched):
+        """Scans a watched directory once and publishes the differences with the previous snapshot. Returns the list of events."""
+        try:
+            scanned = self.scan(watched)
+        except OSError as e:
+            if str(e) != watched.error:
+                print(f"Error watching {watched.directory}: {e}")
+                watched.error = str(e)
+            return [] # Keep the old snapshot until the directory is back
+        watched.error = None
+        previous = watched.files
+        files = {name: signature for name, (_, signature) in scanned.items()}
+
+        # The first scan is the baseline. The subscriber refreshes itself once instead of getting an event for every file.
+        # The snapshot is only published after that, so nobody relies on the watcher while the subscriber is still catching up.
+        if previous is None:
+            if watched.on_start is not None:
+                self.notify(watched.on_start)
+            watched.files = files
+            return []
+        watched.files = files
+        events = [(REMOVED, name, None) for name in previous if name not in scanned]
+        for name, (stat_result, signature) in scanned.items():
+            if name not in previous:
+                events.append((ADDED, name, stat_result))
+            elif previous[name] != signature:
+                events.append((MODIFIED, name, stat_result))
+        if events:
+            self.notify(watched.callback, events)
+        return events
+
+    @staticmethod
+    def notify(callback, *args):
+        """Calls a subscriber. Errors are printed so one failing subscriber doesn't stop the watcher."""
+        try:
+            callback(*args)
+        except Exception as e:
+            print(f"Error handling directory changes: {e}")
@@ -1,14 +1,63 @@
 # This module contains all code related to TAF management and reading
 import re 
 import os
-import shutil
-import datetime
+import csv
+import hashlib
+from concurrent.futures import ThreadPoolExecutor
+from taf_index import TafIndex
+from protocol_index import ProtocolIndex
+from geo_catalogue import GeoCatalogue
+from backup_store import BackupStore
+from change_log import ChangeLog, read_history
+from taf_model import parse_taf, read_geo_revisions, find_geo_revisions, splice_revisions
+from instrumentation import instrumentation
+
+SYNC_BATCH = 256 # Staged TAFs kept open at once until they are flushed to disk together (keeps the commit well under the open file limit)
 class ConfigFileNotFoundError(Exception):
     """Exception raised when the config file is not found."""
     pass
 class ConfigFileWrongDir(Exception):
     """Exception raised when the config file is not found."""
     pass
+def load_revision_list(file_path):
+    """Reads a change order CSV with part number and new revision columns and returns a dictionary of part -> revision.
+    Blank lines, lines starting with # and a header row are skipped. Single digit revisions get a leading 0 like the other inputs."""
+    revisions = {}
+    with open(file_path, 'r', newline='') as file:
+        for row in csv.reader(file):
+            row = [cell.strip() for cell in row]
+            if len(row) < 2 or not row[0] or row[0].startswith('#'):
+                continue
+            if row[0].lower().startswith('part') and row[1].lower().startswith('rev'):
+                continue # Header row
+            revisions[row[0]] = re.sub(r"^(\d)$", r"0\1", row[1])
+    return revisions
+
+class PlannedTaf:
+    """One TAF of an UpdatePlan. signature is the (modification time, size) the edits were found at and edits is the list of (line_no, start, end, part_num, old_revision) from taf_model.find_geo_revisions."""
+    def __init__(self, taf_file, file_path, signature, edits):
+        self.taf_file = taf_file
+        self.file_path = file_path
+        self.signature = signature
+        self.edits = edits
+    
+    def old_versions(self):
+        """Returns the dictionary of part -> old revision for the TAF (the last one if a part is in the TAF with different revisions)."""
+        return {part_num: old_revision for _, _, _, part_num, old_revision in self.edits}
+
+class UpdatePlan:
+    """This class holds the result of a dry run (FileManager.plan_taf_updates): the revisions to apply, the parts without a GEO for their new revision and the planned edits of every TAF.
+    Nothing is changed until the plan is passed to FileManager.apply_update_plan, which writes exactly these edits without scanning the directory again."""
+    def __init__(self, revisions, missing_geos):
+        self.revisions = revisions
+        self.missing_geos = missing_geos
+        self.tafs = [] # PlannedTaf for every TAF with at least one edit, in TAF order
+    
+    def get_edits(self):
+        """Returns the list of (taf_file, line_no, part_num, old_revision, new_revision) planned edits."""
+        return [(planned_taf.taf_file, line_no, part_num, old_revision, self.revisions[part_num])
+                for planned_taf in self.tafs for line_no, _, _, part_num, old_revision in planned_taf.edits]
+
 class ConfigManager:
     def __init__(self, file_name='config.txt'):
         """This class implements the configuration manager. It initializes or uses the existing configuration file in the AppData folder."""
@@ -115,8 +164,10 @@ class ConfigManager:
         return self.get_tmt_dir()
     
 class FileManager:
-    def __init__(self, taf_dir, geo_dir, backup_base_dir):
-        """Initializes the FileManager with the TAF and GEO directories and the backup directory. Creates the backup directory if it doesn't exist."""
+    def __init__(self, taf_dir, geo_dir, backup_base_dir, index_dir=None, compress_backups=True):
+        """Initializes the FileManager with the TAF and GEO directories and the backup directory. Creates the backup directory if it doesn't exist.
+        If an index directory is given (normally the app directory from the ConfigManager) the part to TAF index is stored there and used for directory updates.
+        Backups go into a content-addressed BackupStore in the backup directory, gzip compressed unless compress_backups is False."""
         self.taf_dir = taf_dir
         self.geo_dir = geo_dir
         self.backup_base_dir = backup_base_dir
@@ -125,11 +176,34 @@ class FileManager:
         # Ensure the backup_base_dir exists
         if not os.path.exists(self.backup_base_dir):
             os.makedirs(self.backup_base_dir)
+        self.compress_backups = compress_backups
+        self.backup_store = BackupStore(self.backup_base_dir, compress_backups)
+        self.backup_run = None # BackupRun of the update being applied
+        self.change_log = None # ChangeLog of the update being applied
+        self.geo_catalogue = None
         self.get_geo_list()
+        self.geo_watch = None # WatchedDirectory of the GEO directory once start_watching is called
+        self.taf_watch = None # WatchedDirectory of the TAF directory once start_watching is called
+        
+        # Open the persistent part to TAF index and the technology protocol index if an index directory was given
+        self.taf_index = None
+        self.protocol_index = None
+        if index_dir is not None:
+            self.taf_index = TafIndex(self.taf_dir, os.path.join(index_dir, 'taf_index.db'))
+            self.protocol_index = ProtocolIndex(self.taf_dir, os.path.join(index_dir, 'protocol_index.db'))
+        self.protocol_watch = None # WatchedDirectory of the protocols once start_watching is called
+        
+        # Finish or undo any update that was interrupted last time
+        self.recover_interrupted_updates()
     
     def get_geo_list(self):
+        """Returns the list of GEO files. The GEO catalogue is created on the first call and afterwards only re-lists the directory when it has changed."""
         try:
-            self.geo_list = [file for file in os.listdir(self.geo_dir) if file.endswith('.GEO')] # Get the list of GEO files (only needs to run once at init to save time)
+            if self.geo_catalogue is None:
+                self.geo_catalogue = GeoCatalogue(self.geo_dir)
+            else:
+                self.geo_catalogue.refresh()
+            self.geo_list = self.geo_catalogue.get_geo_list()
         except FileNotFoundError:
             print(f"Error: The GEO directory {self.geo_dir} was not found.")
             exit(1)
@@ -138,13 +212,49 @@ class FileManager:
             exit(1)
         return self.geo_list
             
+    def start_watching(self, watcher):
+        """Subscribes the GEO catalogue, the TAF index and the protocol index to a DirectoryWatcher so they are kept current in the background. The watcher's snapshot of the TAF directory is then used by search_for_tafs."""
+        self.geo_watch = watcher.watch(self.geo_dir, lambda name: name.endswith('.GEO'), self.on_geo_events, self.get_geo_list)
+        self.taf_watch = watcher.watch(self.taf_dir, lambda name: name.lower().endswith('.taf'), self.on_taf_events, self.taf_index.refresh if self.taf_index is not None else None)
+        if self.protocol_index is not None:
+            self.protocol_watch = watcher.watch(self.taf_dir, ProtocolIndex.is_protocol, self.protocol_index.apply_events, self.protocol_index.refresh)
+    
+    def stop_watching(self, watcher):
+        """Removes the GEO, TAF and protocol watches of this FileManager from the DirectoryWatcher (when the directories are changed). Once it returns the watcher no longer calls the indexes, so they can be closed."""
+        for watched in (self.geo_watch, self.taf_watch, self.protocol_watch):
+            if watched is not None:
+                watcher.unwatch(watched)
+        self.geo_watch = self.taf_watch = self.protocol_watch = None
+    
+    def close(self):
+        """Closes the part and protocol index databases."""
+        for index in (self.taf_index, self.protocol_index):
+            if index is not None:
+                index.close()
+    
+    def on_geo_events(self, events):
+        """Applies GEO directory changes from the watcher to the GEO catalogue and the GEO list."""
+        self.geo_catalogue.apply_events(events)
+        self.geo_list = self.geo_catalogue.get_geo_list()
+    
+    def on_taf_events(self, events):
+        """Applies TAF directory changes from the watcher to the part index."""
+        if self.taf_index is not None:
+            self.taf_index.apply_events(events)
+    
     def set_backup_dir(self, backup_dir):
         """Sets the backup directory"""
         self.backup_base_dir = backup_dir
+        self.backup_store = BackupStore(backup_dir, self.compress_backups)
     def search_for_tafs(self):
-        """Search directory for .TAF files"""
+        """Search directory for .TAF files. When the directory is watched (see start_watching) the watcher's latest snapshot is used instead of listing it again."""
+        if self.taf_watch is not None:
+            taf_list = self.taf_watch.get_names()
+            if taf_list is not None:
+                return taf_list
         try:
-            taf_list = [file for file in os.listdir(self.taf_dir) if file.lower().endswith('.taf')] # Get all TAF files
+            with instrumentation.span('taf.list'):
+                taf_list = sorted(file for file in os.listdir(self.taf_dir) if file.lower().endswith('.taf')) # Get all TAF files (sorted so updates and logs are in the same order every run)
             return taf_list
         except FileNotFoundError:
             print("TAF directory not found")
@@ -153,111 +263,304 @@ class FileManager:
             print("Can't search for .TAF files in this directory due to lack of permission")
             exit(1)
     def create_backup_dir(self):
-        """Creates a new backup directory, incrementing the count for successive runs"""
-        # Find the highest existing backup directory number and add one
-        existing_backups = [d for d in os.listdir(self.backup_base_dir) if os.path.isdir(os.path.join(self.backup_base_dir, d))]
-        if existing_backups:
-            latest_backup = max([int(d.split('_')[-1]) for d in existing_backups if d.startswith('backup_') and d.split('_')[-1].isdigit()], default=0)
-        else:
-            latest_backup = 0
-        new_backup_dir = os.path.join(self.backup_base_dir, f'backup_{latest_backup + 1}')
-        os.makedirs(new_backup_dir, exist_ok=True)
-        return new_backup_dir
-    def copy_tafs_to_backup(self, file_path):
-        """Copy the taf files to the backup folder before changing them"""
-        shutil.copy(file_path, self.current_backup_dir) # Copies the files
+        """Starts a new run in the backup store and returns its directory (manifest and change log). The run id is taken from the store's counter instead of listing the backup directory."""
+        self.backup_run = self.backup_store.start_run()
+        self.change_log = ChangeLog(self.backup_run.run_id, self.backup_run.run_dir, self.get_history_path())
+        return self.backup_run.run_dir
+    def copy_tafs_to_backup(self, file_path, data=None):
+        """Back up a TAF file before changing it and return the hash of the backed up contents. data is the contents if they have already been read, so the file is read and hashed only once."""
+        if data is None:
+            with open(file_path, 'rb') as file:
+                data = file.read()
+        return self.backup_run.add(file_path, data) # Only stored if this version isn't in the backup store yet
+    def restore_backup_run(self, run_id, target_dir=None):
+        """Puts back the TAFs changed by an update run (see BackupStore.restore_run). Returns the list of restored file paths."""
+        restored = self.backup_store.restore_run(run_id, target_dir)
+        if self.taf_index is not None:
+            for file_path in restored:
+                if os.path.normpath(os.path.dirname(file_path)) == os.path.normpath(self.taf_dir):
+                    self.taf_index.index_file(os.path.basename(file_path)) # Keep the index current even if the modification time didn't change
+        return restored
     def search_for_geo(self, geo_name):
         """Searches for a geo file that matches the given name"""
-        for name in self.geo_list: # Iterate through the list of GEO files to check if the part exists
-            if name.lower() in geo_name.lower(): # Check if a part exists
-                return True
-        return False
-    def read_and_update_taf_files(self, part_num, replace_version, taf_files = None, save_dir = None, override = False):
-        """Reads each .TAF file, updates lines matching a pattern, and writes changes back."""
-        
-        # Create backup directory 1 number higher than previous. Don't call on override as dir should already exist
-        if not override:
-            self.current_backup_dir = self.create_backup_dir()
+        return self.geo_catalogue.exists(geo_name) # Dictionary lookups in the GEO catalogue instead of going through the whole list
+    def scan_taf_file(self, file_path, geo_pattern):
+        """Checks a TAF file for GEO paths matching the geo_pattern (compiled bytes regex, see build_geo_pattern) without changing anything.
+        The TAF is memory-mapped and never decoded (see taf_model.find_geo_revisions). Only the revision in the GEO file name is ever replaced, never an underscore in the folders.
+        Returns (stat_result, edits) where edits is the list of (line_no, start, end, part_num, old_revision) revisions to replace."""
+        with instrumentation.span('taf.scan'):
+            stat_result, edits = read_geo_revisions(file_path, geo_pattern)
+        instrumentation.count('taf.files_scanned')
+        instrumentation.count('taf.bytes_read', stat_result.st_size)
+        if edits:
+            instrumentation.count('taf.files_matched')
+        return stat_result, edits
+    
+    def read_planned_taf(self, planned_taf, geo_pattern):
+        """Reads a planned TAF and returns its contents. If the TAF changed since it was planned its edits are found again so nothing is written at stale offsets.
+        Returns None if the matching paths were removed since the plan was made."""
+        with open(planned_taf.file_path, 'rb') as file:
+            stat_result = os.fstat(file.fileno())
+            data = file.read()
+        if (stat_result.st_mtime_ns, stat_result.st_size) != planned_taf.signature:
+            planned_taf.edits = find_geo_revisions(data, geo_pattern)
+            if not planned_taf.edits:
+                return None
+        return data
+    
+    def commit_taf_file(self, planned_taf, final_path, revisions, geo_pattern):
+        """Backs up the original TAF and writes it with the planned revisions replaced through a temporary file next to the final path (the commit without a journal)."""
+        data = self.read_planned_taf(planned_taf, geo_pattern)
+        if data is None:
+            return
+        temp_write_path = final_path + '.tmp'  # Temporary file path
+        self.copy_tafs_to_backup(planned_taf.file_path, data) # Back up the unmodified file incase of accidental change
+        with instrumentation.span('taf.write'), open(temp_write_path, 'wb') as temp_file:
+            temp_file.write(splice_revisions(data, planned_taf.edits, revisions))
+        os.replace(temp_write_path, final_path) # Move the updated temporary file to the final path
+    
+    def stage_taf_file(self, planned_taf, final_path, revisions, geo_pattern, open_files):
+        """Backs up the original TAF and writes the updated contents to the temporary file next to the final path. The temporary file is left open in open_files
+        so apply_update_plan can flush every staged file to disk in one pass through the handles that wrote them, and it isn't renamed here.
+        Returns the journal entry of the TAF (paths, hashes of the old and new contents and the (part, new, old) changes) or None if there is nothing to write."""
+        data = self.read_planned_taf(planned_taf, geo_pattern)
+        if data is None:
+            return None
+        new_data = splice_revisions(data, planned_taf.edits, revisions)
+        old_sha256 = self.copy_tafs_to_backup(planned_taf.file_path, data) # Back up the unmodified file incase of accidental change
+        temp_file = open(final_path + '.tmp', 'wb')
+        open_files.append(temp_file) # Closed by apply_update_plan, even if the staging fails
+        with instrumentation.span('taf.write'):
+            temp_file.write(new_data)
+            temp_file.flush()
+        return {'taf_file': planned_taf.taf_file, 'path': final_path, 'temp': final_path + '.tmp', 'old_sha256': old_sha256, 'new_sha256': hashlib.sha256(new_data).hexdigest(),
+                'changes': [[part_num, revisions[part_num], old_ver] for part_num, old_ver in planned_taf.old_versions().items()]}
+    
+    def build_geo_pattern(self, part_nums, as_bytes=False):
+        """Builds one regex matching a GEO path for any of the part numbers. Longer part numbers come first so the most specific part wins when one is a prefix of another.
+        With as_bytes the pattern is compiled for bytes (latin-1, the encoding of the TAF files) so it can search memory-mapped TAFs directly."""
+        alternatives = '|'.join(re.escape(part_num) for part_num in sorted(part_nums, key=len, reverse=True)) # Convert any special characters to characters that are safe to use in regex pattern
+        pattern = rf"(?P<part>{alternatives})_[^\r\n]*\.GEO"  # Pattern to match the GEO file name (the path can't go past the end of the line)
+        return re.compile(pattern.encode('latin-1') if as_bytes else pattern)
+    
+    def find_missing_geos(self, revisions):
+        """Returns the parts of the revisions dictionary (part -> new revision) without a GEO for the new revision."""
+        self.geo_catalogue.refresh() # Pick up GEOs added since the last update
+        with instrumentation.span('geo.lookup'):
+            return [part_num for part_num, revision in revisions.items() if not self.search_for_geo(part_num + '_' + revision + '.GEO')]
+    
+    def plan_taf_updates(self, revisions, taf_files = None, workers = None):
+        """Works out every edit an update would make without changing anything (no backup directory is created). revisions is a dictionary of part -> new revision.
+        The TAFs are scanned once by a thread pool (most of the time is network latency), using the part index to skip TAFs that don't reference the parts.
+        workers sets the number of threads (None uses the ThreadPoolExecutor default, 1 runs everything on the calling thread). Returns an UpdatePlan that apply_update_plan can commit without scanning again."""
+        plan = UpdatePlan(revisions, self.find_missing_geos(revisions))
+        if not revisions:
+            return plan
         
-        updated_taf_file_info = []
-        if self.search_for_geo(part_num + '_' + replace_version + '.GEO') or override:
-            part_num_escaped = re.escape(part_num)  # Convert any special characters to characters that are safe to use in regex pattern
-            geo_pattern = rf"{part_num_escaped}_.*\.GEO"  # Pattern to match the GEO file name
-            
-            # Check if a taf file was given during function call
-            if taf_files is None:
+        # Check if a taf file was given during function call. The index only returns the TAFs that reference the parts.
+        if taf_files is None:
+            if self.taf_index is not None:
+                # The index is only refreshed here if the watcher isn't keeping it current (or hasn't caught up with the directory yet, see WatchedDirectory)
+                watched = self.taf_watch is not None and self.taf_watch.get_names() is not None
+                taf_files = self.taf_index.find_tafs(list(revisions), self.build_geo_pattern(revisions), not watched)
+            else:
                 taf_files = self.search_for_tafs()
-                
-            # Check if an alternate save directory was passed during function call (can be used for debugging)
-            if save_dir is None:
-                save_dir = self.taf_dir
-
-            # Gets the version number from the file name. The part after the last _ is the version number.
-            version_pattern = r"_([^_]*)\."
+        
+        file_paths = [os.path.join(self.taf_dir, taf_file) for taf_file in taf_files] # Combine the files with the file path in a system safe way
+        geo_pattern = self.build_geo_pattern(revisions, as_bytes=True)
+        
+        def scan(file_path):
+            with instrumentation.profile_thread(): # Profiles the pool threads while profiling (a no-op on a thread that is already profiled)
+                return self.scan_taf_file(file_path, geo_pattern)
+        
+        # Check every TAF. map keeps the results in the same order as taf_files.
+        if workers == 1:
+            scan_results = list(map(scan, file_paths))
+        else:
+            with ThreadPoolExecutor(max_workers=workers) as executor:
+                scan_results = list(executor.map(scan, file_paths))
+        for taf_file, file_path, (stat_result, edits) in zip(taf_files, file_paths, scan_results):
+            if edits:
+                plan.tafs.append(PlannedTaf(taf_file, file_path, (stat_result.st_mtime_ns, stat_result.st_size), edits))
+        return plan
+    
+    def apply_update_plan(self, plan, save_dir = None, workers = None, journaled = True):
+        """Commits an UpdatePlan from plan_taf_updates and returns the list of (taf_file, part_num, new_revision, old_revision) tuples.
+        A new backup run is started and the planned TAFs are backed up and written in parallel. The changes are then logged and the index is updated in TAF order.
+        With journaled (the default) the commit is a transaction. Every TAF is first staged to a temporary file and the staged files are flushed to disk in one pass.
+        An intent journal is then written to the backup run and the temporary files are renamed in a tight loop. An interrupted commit is rolled back
+        (nothing renamed yet) or forward (journal written) by recover_interrupted_updates the next time a FileManager is created."""
+        if not plan.tafs:
+            return [] # Nothing to write, so no backup run is created
+        
+        # Check if an alternate save directory was passed during function call (can be used for debugging)
+        if save_dir is None:
+            save_dir = self.taf_dir
+        self.current_backup_dir = self.create_backup_dir() # Create backup directory 1 number higher than previous
+        geo_pattern = self.build_geo_pattern(plan.revisions, as_bytes=True)
+        
+        # Work out where each TAF is written
+        def final_path(planned_taf):
+            if save_dir == self.taf_dir:
+                return planned_taf.file_path  # Overwrite the original file
+            return os.path.join(save_dir, planned_taf.taf_file) # Save to new directory (can be used for debugging or testing without overwriting original files)
+        
+        def run_all(function, items):
+            """Runs the function on every item in the thread pool (or on this thread with one worker) and returns the results in order."""
+            if workers == 1:
+                return list(map(function, items))
+            def profiled(item):
+                with instrumentation.profile_thread():
+                    return function(item)
+            with ThreadPoolExecutor(max_workers=workers) as executor:
+                return list(executor.map(profiled, items))
+        
+        if journaled:
+            # Record the temporary files first so a staging run that is interrupted can be cleaned up
+            self.backup_run.write_journal('staging', [{'taf_file': planned_taf.taf_file, 'path': final_path(planned_taf), 'temp': final_path(planned_taf) + '.tmp'} for planned_taf in plan.tafs])
+            entries = []
+            try:
+                # Stage a batch, then flush the whole batch to disk through the handles that wrote it (fsync is per file on every platform, so the batch is synced in parallel)
+                for start in range(0, len(plan.tafs), SYNC_BATCH):
+                    open_files = []
+                    try:
+                        entries += [entry for entry in run_all(lambda planned_taf: self.stage_taf_file(planned_taf, final_path(planned_taf), plan.revisions, geo_pattern, open_files),
+                                                               plan.tafs[start:start + SYNC_BATCH]) if entry is not None]
+                        with instrumentation.span('taf.fsync'):
+                            run_all(lambda temp_file: os.fsync(temp_file.fileno()), open_files)
+                    finally:
+                        for temp_file in open_files:
+                            temp_file.close()
+            except Exception:
+                # No TAF was changed yet, so the staging is undone straight away instead of on the next start
+                for planned_taf in plan.tafs:
+                    try:
+                        os.remove(final_path(planned_taf) + '.tmp')
+                    except FileNotFoundError:
+                        pass
+                self.backup_run.finish_journal()
+                raise
+            self.backup_run.save(fsync=True) # Manifest of the backed up TAFs so the run can be restored
             
-            # Iterate through all the files in the taf_files list
-            for taf_file in taf_files:
-                found_indicator = False  # Indicator for whether the TAF was changed
-                file_path = os.path.join(self.taf_dir, taf_file) # Combine the file with the file path in a system safe way
-                temp_write_path = file_path + '.tmp'  # Temporary file path
-                
-                # Open the taf file and temporary file
-                try:
-                    with open(file_path, 'r') as file, open(temp_write_path, 'w') as temp_file:
-                        print(f"Reading TAF file: {file_path}") # Print to console for debugging
-                        
-                        # Iterate over every line in the file
-                        for line in file:
-                            if re.search(geo_pattern, line):  # Find matches to the pattern
-                                old_ver = re.search(version_pattern, line).group(1)
-                                line = re.sub(version_pattern, f"_{replace_version}.", line)  # Replace the revision
-                                print("Found match")
-                                found_indicator = True
-                                
-                            temp_file.write(line)  # Write the line to the temporary file
-                except FileNotFoundError:
-                    print("TAF file not found")
-                    return False, None
-                # Check if the file had any matches   
-                if found_indicator:
-                    # Determine the final path for the updated file
-                    if save_dir == self.taf_dir:
-                        final_path = file_path  # Overwrite the original file
-                    else:
-                        final_path = os.path.join(save_dir, taf_file) # Save to new directory (can be used for debugging or testing without overwriting original files)
-                        
-                    self.copy_tafs_to_backup(file_path) # Copy the unmodified files to a backup folder incase of accidental change
-                    os.replace(temp_write_path, final_path) # Move the updated temporary file to the final path
-                    self.write_change_log(taf_file, part_num, replace_version, old_ver) # Write the changed file to the log
-                    updated_taf_file_info.append((taf_file, part_num, replace_version, old_ver)) # Append the file to the list of updated files
-                    
-                # Remove the temp file if it doesn't get changed from the original
-                else:
-                    os.remove(temp_write_path)
-            return [False, updated_taf_file_info] # Successfully updated TAF files
+            # Intent journal: from here on the commit is rolled forward if it is interrupted
+            self.backup_run.write_journal('commit', entries)
+            for entry in entries:
+                os.replace(entry['temp'], entry['path'])
         else:
-            return [True, None] # GEO is missing
+            run_all(lambda planned_taf: self.commit_taf_file(planned_taf, final_path(planned_taf), plan.revisions, geo_pattern), plan.tafs)
+            self.backup_run.save() # Manifest of the backed up TAFs so the run can be restored
+        
+        # Log the changes and update the index on this thread in TAF order
+        updated_taf_file_info = []
+        for planned_taf in plan.tafs:
+            if self.taf_index is not None and final_path(planned_taf) == planned_taf.file_path:
+                self.taf_index.index_file(planned_taf.taf_file) # Keep the index current even if the modification time didn't change
+            for part_num, old_ver in planned_taf.old_versions().items():
+                self.write_change_log(planned_taf.taf_file, part_num, plan.revisions[part_num], old_ver) # Write the changed file to the log
+                updated_taf_file_info.append((planned_taf.taf_file, part_num, plan.revisions[part_num], old_ver)) # Append the file to the list of updated files
+        self.change_log.flush() # One write per log file for the whole run
+        if journaled:
+            self.backup_run.finish_journal()
+        return updated_taf_file_info
+    
+    def recover_interrupted_updates(self):
+        """Finishes or undoes the journaled commits that were interrupted (for example by a share disconnecting or the program closing). Called when the FileManager is created.
+        A run stopped while staging is rolled back by deleting its temporary files (no TAF was changed yet). A run stopped after its intent journal was written is rolled forward:
+        every staged TAF that is complete (hash matches the journal) is renamed into place and the run's change log is written if it wasn't yet. Returns the list of (run_id, action) tuples."""
+        recovered = []
+        for journal in self.backup_store.pending_journals():
+            run_id = journal['run_id']
+            if journal['state'] == 'commit':
+                self.current_backup_dir = self.backup_store.get_run_dir(run_id)
+                self.change_log = ChangeLog(run_id, self.current_backup_dir, self.get_history_path())
+                logged = os.path.exists(os.path.join(self.current_backup_dir, 'change_log.jsonl')) # The log was flushed before the interruption
+                for entry in journal['files']:
+                    if os.path.exists(entry['temp']):
+                        with open(entry['temp'], 'rb') as file:
+                            complete = hashlib.sha256(file.read()).hexdigest() == entry['new_sha256']
+                        if complete:
+                            os.replace(entry['temp'], entry['path'])
+                        else:
+                            os.remove(entry['temp']) # Not renamed yet so the original TAF is still in place
+                            print(f"Recovery: staged copy of {entry['taf_file']} is incomplete, the TAF was left unchanged")
+                            continue
+                    if self.taf_index is not None and os.path.normpath(os.path.dirname(entry['path'])) == os.path.normpath(self.taf_dir):
+                        self.taf_index.index_file(entry['taf_file'])
+                    if not logged:
+                        for part_num, revision, old_ver in entry['changes']:
+                            self.write_change_log(entry['taf_file'], part_num, revision, old_ver)
+                self.change_log.flush()
+                action = 'rolled forward'
+            else:
+                for entry in journal['files']:
+                    if os.path.exists(entry['temp']):
+                        os.remove(entry['temp'])
+                action = 'rolled back'
+            self.backup_store.finish_journal(run_id)
+            print(f"Recovered interrupted update run {run_id}: {action}")
+            recovered.append((run_id, action))
+        return recovered
+    
+    def read_and_update_taf_files(self, part_num, replace_version, taf_files = None, save_dir = None, override = False, workers = None):
+        """Reads each .TAF file, updates lines matching a pattern, and writes changes back. See plan_taf_updates for how the work is split between threads.
+        Returns [True, None] without changing anything (or creating a backup directory) if the GEO is missing and override is False."""
+        try:
+            plan = self.plan_taf_updates({part_num: replace_version}, taf_files, workers) # The plan checks the GEO catalogue once
+            if plan.missing_geos and not override:
+                return [True, None] # GEO is missing
+            updated_taf_file_info = self.apply_update_plan(plan, save_dir, workers)
+        except FileNotFoundError:
+            print("TAF file not found")
+            return False, None
+        return [False, updated_taf_file_info] # Successfully updated TAF files
+    
+    def read_and_update_taf_files_bulk(self, revisions, taf_files = None, save_dir = None, override = False, workers = None):
+        """Updates many parts at once from a dictionary of part -> new revision (for example loaded from a change order with load_revision_list).
+        All TAFs are scanned once with a single combined pattern and every change goes into one backup directory and change log.
+        Returns [missing_geos, updated_files]. If any GEO is missing and override is False nothing is changed and updated_files is None."""
+        missing_geos = []
+        try:
+            plan = self.plan_taf_updates(revisions, taf_files, workers)
+            missing_geos = plan.missing_geos
+            if missing_geos and not override:
+                return [missing_geos, None] # Let the caller confirm before anything (including the backup directory) is created
+            if not revisions:
+                return [missing_geos, []]
+            updated_taf_file_info = self.apply_update_plan(plan, save_dir, workers)
+        except FileNotFoundError:
+            print("TAF file not found")
+            return [missing_geos, None]
+        return [missing_geos, updated_taf_file_info]
                 
     def write_change_log(self, taf_file, part_num, revision, old_ver):
-        """Writes an entry to the change log"""
-        log_file_path = os.path.join(self.current_backup_dir, 'change_log.txt')
-        with open(log_file_path, 'a') as log_file:
-            timestamp = datetime.datetime.now().strftime('%Y-%m-%d %H:%M:%S')
-            log_file.write(f"{timestamp} - 'Modified: {taf_file} - Part Number: {part_num} - New Revision: {revision} - Old Revision: {old_ver}'\n") # Writes the date, time, taf, part, and new revision to the log file
+        """Adds an entry to the change log of the current run. The entries are written together when the run finishes (see ChangeLog.flush)."""
+        self.change_log.add(taf_file, part_num, revision, old_ver)
+    def get_history_path(self):
+        """Returns the path of the change history shared by all update runs (JSON Lines in the backup directory)."""
+        return os.path.join(self.backup_base_dir, 'history.jsonl')
+    def get_part_history(self, part_num):
+        """Returns the change history entries (run_id, time, file, part, old_revision, new_revision, duration) of a part number (case and spaces ignored), oldest first."""
+        part = part_num.replace(" ", "").lower()
+        return [entry for entry in read_history(self.get_history_path()) if entry['part'].replace(" ", "").lower() == part]
+    def find_runs_for_part(self, part_num):
+        """Returns the sorted list of update run ids that changed a part number. The runs can be restored with restore_backup_run."""
+        return sorted({entry['run_id'] for entry in self.get_part_history(part_num)})
+    def find_protocol_parts(self, search_string):
+        """Returns a list of (program, part, quantity) for every part in the technology protocols containing the search string (see ProtocolIndex.search).
+        The index is only refreshed here if the watcher isn't keeping it current (or hasn't caught up with the directory yet). Returns an empty list if there is no protocol index."""
+        if self.protocol_index is None:
+            return []
+        if self.protocol_watch is None or self.protocol_watch.get_names() is None:
+            self.protocol_index.refresh()
+        return self.protocol_index.search(search_string)
+
     def get_all_parts(self, taf_name):
         """Returns all parts in a provided TAF file"""
         file_path = os.path.join(self.taf_dir, taf_name) # Combine the file with the file path in a system safe way
-        geo_pattern = re.compile(r"GEO\\(?:.*\\)?([^\\]+)\.GEO")  # Pattern to get the part number
         try:
-            # Open the TAF and get all the parts
-            with open(file_path, 'r') as file:
-                print(f"Reading TAF file: {file_path}") # Print to console for debugging
-                matches = []
-                for line in file:
-                    match = geo_pattern.search(line)
-                    if match:
-                        matches.append(match.group(1)) # Append the part number to the list
-                return matches
+            # Parse the TAF and get the part name of every part record
+            with instrumentation.span('taf.read'):
+                return parse_taf(file_path).get_parts()
         except FileNotFoundError:
             print("TAF file not found")
-            return False
\ No newline at end of file
+            return False
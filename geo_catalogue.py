@@ -0,0 +1,135 @@
+# This module contains all code related to the GEO catalogue (cached listing of the GEO directory)
+import os
+import bisect
+import threading
+from instrumentation import instrumentation
+
+MISSING_REVISION = "Missing Revision" # Revision used for GEO files without an underscore
+
+def parse_geo_name(geo_name):
+    """Splits a GEO file name into the normalized part number (no spaces, lowercase) and the uppercase revision after the last underscore."""
+    geo_noex = geo_name.rsplit('.', 1)[0] # Remove the extension
+    geo_split = geo_noex.rsplit('_', 1)  # Split at the first underscore from the right
+
+    # Check there was a split (meaning there was an underscore in the part number indicating a revision)
+    if len(geo_split) == 2:
+        return geo_split[0].replace(" ", "").lower(), geo_split[1].upper()
+    return geo_split[0].replace(" ", "").lower(), MISSING_REVISION
+
+def revision_key(revision):
+    """Returns the ordering key of a revision. Lettered (production) revisions are newer than numbered (design) revisions.
+    Returns None for missing revisions and formats that can't be compared (for example B3 or A2-T1)."""
+    if revision.isalpha():
+        return (1, revision.upper())
+    try:
+        number = int(revision)
+    except ValueError:
+        return None
+    return (0, number) if number >= 0 else None
+
+def revision_sort_key(revision):
+    """Sort key for the revision lists. Missing and unsupported revisions sort before every real revision."""
+    if revision == MISSING_REVISION:
+        return (-2, '')
+    return revision_key(revision) or (-1, revision)
+
+class GeoCatalogue:
+    """This class implements a cached catalogue of the GEO directory. Every file name is parsed once into (part number, revision) and kept in a dictionary of part number -> sorted revision list,
+    so existence checks and latest revision lookups don't need to go through the whole listing. The catalogue is only re-listed when the directory modification time changes.
+    It can also be kept current by a DirectoryWatcher (see apply_events), so every method holds the catalogue lock."""
+    def __init__(self, geo_dir):
+        """Passes the GEO directory to the class and lists it."""
+        self.geo_dir = geo_dir
+        self.geo_names = set() # GEO file names as they are on disk
+        self.lower_names = {} # Lowercase GEO file name -> number of files with that name, for the existence check
+        self.revisions = {} # Normalized part number -> revisions sorted oldest to newest
+        self.dir_mtime_ns = None
+        self.version = 0 # Incremented every time the catalogue changes so results based on it can be cached
+        self.lock = threading.RLock() # The watcher thread changes the catalogue while the Tk thread reads it
+        self.refresh()
+
+    def refresh(self):
+        """Re-lists the GEO directory if its modification time has changed. Only the added and removed files are parsed. Returns True if the catalogue changed."""
+        dir_mtime_ns = os.stat(self.geo_dir).st_mtime_ns
+        if dir_mtime_ns == self.dir_mtime_ns:
+            return False
+
+        with instrumentation.span('geo.list'), os.scandir(self.geo_dir) as entries:
+            listed = {entry.name for entry in entries if entry.name.endswith('.GEO')}
+        with self.lock:
+            self.dir_mtime_ns = dir_mtime_ns
+            added, removed = listed - self.geo_names, self.geo_names - listed
+            for geo_name in removed:
+                self.remove(geo_name)
+            for geo_name in added:
+                self.add(geo_name)
+        return bool(added or removed)
+
+    def apply_events(self, events):
+        """Applies the (kind, name, stat_result) events of a DirectoryWatcher watching the GEO directory. Modified GEOs don't change the catalogue."""
+        with self.lock:
+            for kind, geo_name, _ in events:
+                if kind == 'added':
+                    self.add(geo_name)
+                elif kind == 'removed':
+                    self.remove(geo_name)
+
+    def add(self, geo_name):
+        """Adds a GEO file to the catalogue."""
+        with self.lock:
+            if geo_name in self.geo_names:
+                return
+            self.geo_names.add(geo_name)
+            self.lower_names[geo_name.lower()] = self.lower_names.get(geo_name.lower(), 0) + 1
+            part, revision = parse_geo_name(geo_name)
+            bisect.insort_left(self.revisions.setdefault(part, []), revision, key=revision_sort_key) # Insert left so a revision already listed stays the latest on a tie (03 and 3)
+            self.version += 1
+
+    def remove(self, geo_name):
+        """Removes a GEO file from the catalogue."""
+        with self.lock:
+            if geo_name not in self.geo_names:
+                return
+            self.geo_names.discard(geo_name)
+            self.lower_names[geo_name.lower()] -= 1
+            if not self.lower_names[geo_name.lower()]:
+                del self.lower_names[geo_name.lower()]
+            part, revision = parse_geo_name(geo_name)
+            revisions = self.revisions.get(part, [])
+            if revision in revisions:
+                revisions.remove(revision)
+            if not revisions:
+                self.revisions.pop(part, None)
+            self.version += 1
+
+    def get_geo_list(self):
+        """Returns the list of GEO file names."""
+        with self.lock:
+            return sorted(self.geo_names)
+
+    def exists(self, geo_name):
+        """Checks if a GEO file name is contained in the given name (case insensitive). This is the same check search_for_geo has always done, but only the substrings ending in .geo are looked up."""
+        lower_name = geo_name.lower()
+        end = lower_name.find('.geo')
+        with self.lock:
+            while end != -1:
+                end += 4
+                for start in range(end):
+                    if lower_name[start:end] in self.lower_names:
+                        return True
+                end = lower_name.find('.geo', end - 3)
+        return False
+
+    def get_revisions(self, part):
+        """Returns the revisions of a part number, oldest to newest. Missing and unsupported revisions come first."""
+        with self.lock:
+            return list(self.revisions.get(part.replace(" ", "").lower(), [])) # Copy so the list can't change while the caller uses it
+
+    def latest_revision(self, part):
+        """Returns the latest revision of a part number. Returns '-2' if the GEO only exists without a revision and '-1' if there is no GEO or the revision format is unsupported."""
+        revisions = self.get_revisions(part)
+        if not revisions:
+            return '-1'
+        if revision_key(revisions[-1]) is not None:
+            return revisions[-1]
+        return '-2' if revisions[0] == MISSING_REVISION else '-1'
@@ -0,0 +1,239 @@
+# This module contains the lightweight instrumentation (timed spans and counters) of the hot paths
+import os
+import json
+import time
+import threading
+import pstats
+import cProfile
+
+class NullSpan:
+    """Span returned while the instrumentation is disabled. One shared instance is used so a disabled span costs a method call and a flag check."""
+    __slots__ = ()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        return False
+
+NULL_SPAN = NullSpan()
+
+class Span:
+    """Times one block of code (used as a context manager) and adds the time to its span in the Instrumentation when the block ends."""
+    __slots__ = ('instrumentation', 'name', 'start')
+
+    def __init__(self, instrumentation, name):
+        self.instrumentation = instrumentation
+        self.name = name
+        self.start = None
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.instrumentation.add_time(self.name, time.perf_counter() - self.start)
+        return False
+
+class ThreadProfile:
+    """Profiles one block of work on a job or worker thread with its own cProfile profile (cProfile only sees the thread it was enabled on) and adds the stats
+    to the Instrumentation when the block ends (see Instrumentation.profile_thread)."""
+    __slots__ = ('instrumentation', 'profile')
+
+    def __init__(self, instrumentation):
+        self.instrumentation = instrumentation
+        self.profile = cProfile.Profile()
+
+    def __enter__(self):
+        self.profile.enable()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.profile.disable()
+        self.instrumentation.add_thread_profile(self.profile)
+        return False
+
+class CollectedStats:
+    """Holds the stats dictionary of profiles collected in a worker process so pstats can load it like a profile."""
+    def __init__(self, stats):
+        self.stats = stats
+
+    def create_stats(self):
+        """Nothing to do, the stats were created in the worker."""
+        pass
+
+class Instrumentation:
+    """This class collects timed spans (directory listings, file reads, regex scans, PDF extraction, GEO lookups and writes) and counters (files scanned and matched, bytes read)
+    for a run. It is off by default, in which case span returns a shared no-op span and count returns straight away, so the calls can stay in the hot loops.
+    Worker processes collect their own data for each batch (see worker_data) and the Tk/main process merges it. Optionally a cProfile profile of the calling thread is recorded as well,
+    plus one for every block run under profile_thread on the job threads and in the worker processes, so export_pstats covers the searches, comparisons and audits too."""
+    def __init__(self):
+        """Creates the disabled instrumentation."""
+        self.enabled = False
+        self.lock = threading.Lock() # Spans end on the Tk, watcher and job threads
+        self.profile = None
+        self.profiling = False # Profile the job threads and workers as well (see profile_thread)
+        self.profiled_threads = set() # Threads with a profile running, so a nested profile_thread doesn't replace it
+        self.pid = os.getpid() # Changes in a forked worker process (see follow)
+        self.reset()
+
+    def enable(self, profile=False):
+        """Starts collecting. With profile the calling thread is also profiled with cProfile, and so are the job threads and workers (see export_pstats)."""
+        self.enabled = True
+        if profile and self.profile is None:
+            self.profiling = True
+            self.profile = cProfile.Profile()
+            self.profile.enable()
+            with self.lock:
+                self.profiled_threads.add(threading.get_ident())
+
+    def disable(self):
+        """Stops collecting. The data collected so far is kept until reset."""
+        self.enabled = False
+        if self.profile is not None:
+            self.profile.disable()
+
+    def reset(self):
+        """Drops the collected data and the profile and starts a new run."""
+        with self.lock:
+            self.spans = {} # Name -> [count, total seconds, longest seconds]
+            self.counters = {} # Name -> total
+            self.thread_stats = None # pstats.Stats of the profiles of the job threads and workers
+            self.started = time.time()
+        self.profiling = False
+        if self.profile is not None:
+            self.profile.disable()
+            self.profile = None
+            with self.lock:
+                self.profiled_threads.clear()
+
+    def span(self, name):
+        """Returns a context manager timing the block under name."""
+        if not self.enabled:
+            return NULL_SPAN
+        return Span(self, name)
+
+    def profile_thread(self):
+        """Returns a context manager profiling the block on the calling thread while profiling is on (a no-op otherwise, or if the thread is already profiled).
+        Used around the work of the job threads and worker batches. The stats of a block are only included in export_pstats once it has ended."""
+        if not self.profiling:
+            return NULL_SPAN
+        thread_id = threading.get_ident()
+        with self.lock:
+            if thread_id in self.profiled_threads:
+                return NULL_SPAN
+            self.profiled_threads.add(thread_id)
+        return ThreadProfile(self)
+
+    def add_thread_profile(self, profile):
+        """Adds a finished profile of a job thread (see ThreadProfile) to the profile of the run."""
+        with self.lock:
+            self.profiled_threads.discard(threading.get_ident())
+            self.add_stats(profile)
+
+    def add_stats(self, profile):
+        """Adds a profile (anything pstats.Stats can load) to the stats of the job threads and workers. Called with the lock held."""
+        if self.thread_stats is None:
+            self.thread_stats = pstats.Stats(profile)
+        else:
+            self.thread_stats.add(profile)
+
+    def worker_settings(self):
+        """Returns the (enabled, profiling) settings sent with every batch so a worker process follows this process (see follow)."""
+        return self.enabled, self.profiling
+
+    def follow(self, settings):
+        """Applies the worker_settings of the main process in a worker process. A worker forked from the main process first drops the data, profile and lock it inherited."""
+        if self.pid != os.getpid():
+            self.pid = os.getpid()
+            self.lock = threading.Lock() # Could have been held by another thread when the process was forked
+            self.profiled_threads = set()
+            self.reset()
+        self.enabled, self.profiling = settings
+
+    def add_time(self, name, seconds, count=1):
+        """Adds time to a span (for work that isn't a single block, like the pages of a PDF that are yielded one at a time)."""
+        if not self.enabled:
+            return
+        with self.lock:
+            stats = self.spans.get(name)
+            if stats is None:
+                stats = self.spans[name] = [0, 0.0, 0.0]
+            stats[0] += count
+            stats[1] += seconds
+            if seconds > stats[2]:
+                stats[2] = seconds
+
+    def count(self, name, amount=1):
+        """Adds to a counter."""
+        if not self.enabled:
+            return
+        with self.lock:
+            self.counters[name] = self.counters.get(name, 0) + amount
+
+    def to_dict(self):
+        """Returns the collected data as a dictionary (what export_json writes)."""
+        with self.lock:
+            spans = {name: {'count': count, 'seconds': round(total, 6), 'max_seconds': round(longest, 6)} for name, (count, total, longest) in sorted(self.spans.items())}
+            return {'started': time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(self.started)), 'elapsed': round(time.time() - self.started, 3),
+                    'spans': spans, 'counters': dict(sorted(self.counters.items()))}
+
+    def worker_data(self):
+        """Returns the spans, counters and profile stats collected in a worker process since the last call and resets them, or None if the instrumentation is disabled.
+        The result is sent back with the batch results and merged into the main process with merge."""
+        if not self.enabled:
+            return None
+        data = self.to_dict()
+        data['profile'] = self.thread_stats.stats if self.thread_stats is not None else None
+        self.reset()
+        return data
+
+    def merge(self, data):
+        """Adds the data of a worker process (see worker_data) to this process."""
+        if not self.enabled or data is None:
+            return
+        with self.lock:
+            for name, span in data['spans'].items():
+                stats = self.spans.get(name)
+                if stats is None:
+                    stats = self.spans[name] = [0, 0.0, 0.0]
+                stats[0] += span['count']
+                stats[1] += span['seconds']
+                stats[2] = max(stats[2], span['max_seconds'])
+            for name, amount in data['counters'].items():
+                self.counters[name] = self.counters.get(name, 0) + amount
+            if data.get('profile'):
+                self.add_stats(CollectedStats(data['profile']))
+
+    def summary(self):
+        """Returns the per-run summary as a list of lines: one line per span (slowest first) and one per counter."""
+        data = self.to_dict()
+        lines = [f"Run started {data['started']}, {data['elapsed']:.1f} s ago"]
+        for name, span in sorted(data['spans'].items(), key=lambda item: item[1]['seconds'], reverse=True):
+            average = span['seconds'] / span['count'] * 1000 if span['count'] else 0.0
+            lines.append(f"{name:<22} {span['count']:>8} x  {span['seconds']:>9.3f} s total  {average:>9.3f} ms avg  {span['max_seconds'] * 1000:>9.3f} ms max")
+        for name, amount in data['counters'].items():
+            lines.append(f"{name:<22} {amount:>8}")
+        return lines
+
+    def export_json(self, file_path):
+        """Writes the collected data to a JSON file."""
+        with open(file_path, 'w') as file:
+            json.dump(self.to_dict(), file, indent=1)
+
+    def export_pstats(self, file_path):
+        """Writes the cProfile profile of the calling thread combined with the profiles of the job threads and workers in the pstats format (open it with pstats.Stats or snakeviz).
+        Raises ValueError if profiling wasn't enabled."""
+        if self.profile is None and self.thread_stats is None:
+            raise ValueError("Profiling was not enabled for this run.")
+        stats = pstats.Stats()
+        if self.profile is not None:
+            stats.add(self.profile) # Stops the profile
+        with self.lock:
+            if self.thread_stats is not None:
+                stats.add(self.thread_stats)
+        stats.dump_stats(file_path)
+        if self.enabled and self.profile is not None:
+            self.profile.enable()
+
+instrumentation = Instrumentation() # The instrumentation of this process, shared by every module
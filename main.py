@@ -1,4 +1,7 @@
 from file_handling import *
+from pdf_audit import PdfAudit
+from instrumentation import instrumentation
+import argparse
 
 # This module runs the TAF updated in a command line window
 
@@ -9,8 +12,60 @@ def check_for_single_number(input_number):
     else:
         return input_number
     
+# Update every part in a change order CSV (part number, new revision) in one pass. The planned edits are listed before anything is changed.
+def bulk_update(file_manager, csv_path):
+    revisions = load_revision_list(csv_path)
+    print(f"Loaded {len(revisions)} part revisions from {csv_path}")
+    plan = file_manager.plan_taf_updates(revisions)
+    for taf_file, line_no, part_num, old_revision, new_revision in plan.get_edits():
+        print(f"Planned: {taf_file} (line {line_no}) - Part: {part_num}, Old Ver: {old_revision}, New Ver: {new_revision}")
+    
+    # Some GEOs don't exist, the user is prompted to confirm they want to proceed with the modifications
+    if plan.missing_geos:
+        print("The following GEOs do not exist:")
+        for part_num in plan.missing_geos:
+            print(f"    {part_num}_{revisions[part_num]}.GEO")
+    if input('Are you sure you wan\'t to update? (Y/N): ').upper() != 'Y':
+        print("Finished without modifications.")
+        return
+    for taf_file, part_num, new_revision, old_revision in file_manager.apply_update_plan(plan):
+        print(f"Updated: {taf_file} - Part: {part_num}, Old Ver: {old_revision}, New Ver: {new_revision}")
+
+# Update one part to a new revision in the whole directory or in the given TAF files. The TAFs are scanned once and the same plan is applied if the user confirms a missing GEO.
+def update_part(file_manager, part_number, new_revision, taf_files=None, save_dir=None):
+    try:
+        plan = file_manager.plan_taf_updates({part_number: new_revision}, taf_files)
+    except FileNotFoundError:
+        print("TAF file not found")
+        return
+    
+    # If the GEO doesn't exist the user is prompted to confirm they want to proceed with the modifications
+    if plan.missing_geos and input('The GEO does not exist, are you sure you wan\'t to update? (Y/N): ').upper() != 'Y':
+        print("Finished without modifications.")
+        return
+    try:
+        updated_files = file_manager.apply_update_plan(plan, save_dir)
+    except OSError as error:
+        print(f"The update failed: {error}")
+        return
+    for taf_file, part_num, new_revision, old_revision in updated_files:
+        print(f"Updated: {taf_file} - Part: {part_num}, Old Ver: {old_revision}, New Ver: {new_revision}")
+
+# Compare every PDF in the TMT directory with its TAF and write the CSV and HTML reports into output_dir. Nothing is changed.
+def audit(config, output_dir, processes=None):
+    try:
+        audit = PdfAudit(config.get_tmt_dir(), config.get_taf_dir(), config.get_geo_dir(), os.path.join(config.app_dir, 'pdf_text_cache.db'))
+    except (ValueError, ConfigFileNotFoundError, ConfigFileWrongDir) as error:
+        print(error)
+        return
+    report = audit.run(processes=processes, progress=lambda done, total: print(f"Audited {done}/{total} PDFs"))
+    for line in report.summary():
+        print(line)
+    csv_path, html_path = report.write_reports(output_dir)
+    print(f"Reports written to {csv_path} and {html_path}")
+
 # Main function
-def main():
+def main(bulk_csv=None):
     config = ConfigManager('config.txt') # Create a config from the config.txt in the current working directory
     try:
         geo_dir = config.get_geo_dir() # Get the directory for the GEO files from the config
@@ -20,7 +75,12 @@ def main():
         print(error)
         input("Press any key to close")
         exit(1)
-    file_manager = FileManager(taf_dir, geo_dir, backup_dir) # Create the file manager at the configured directories
+    file_manager = FileManager(taf_dir, geo_dir, backup_dir, config.app_dir) # Create the file manager at the configured directories. The part index is kept in the app directory.
+    
+    # Run a whole change order instead of the interactive loop if a CSV was given
+    if bulk_csv is not None:
+        bulk_update(file_manager, bulk_csv)
+        return
     
     # Run the main loop of the program until the user requests to end it
     mainLoop = True
@@ -32,16 +92,7 @@ def main():
         
         # Checks if the user wants to update the whole directory or just one TAF file
         if specific_file == 'Y':
-            status = file_manager.read_and_update_taf_files(part_number, new_revision, None)
-            
-            # If the status variable was returned as True then the GEO doesn't exist. 
-            # The user is prompted to confirm they want to proceed with the modifications.
-            if status:
-                # Run the update function again overiding the existance check if the user wants to continue
-                if input('The GEO does not exist, are you sure you wan\'t to update? (Y/N): ').upper() == 'Y':
-                    file_manager.read_and_update_taf_files(part_number, new_revision, None, None, True)
-                else:
-                    print("Finished without modifications.")
+            update_part(file_manager, part_number, new_revision)
                     
         # This runs if the user specified they only want to update specific TAF files
         else:
@@ -52,7 +103,7 @@ def main():
                 taf_file = input('Enter the name of the TAF file: ')
                 if not taf_file.lower().endswith('.taf'):
                     taf_file += '.TAF'
-                file_manager.read_and_update_taf_files(part_number, new_revision, [taf_file], "TAF_Temp")
+                update_part(file_manager, part_number, new_revision, [taf_file], "TAF_Temp")
                 if input('Would you like to update more TAFs? (Y/N): ').strip().upper() == 'N':
                     cont = False
         # Check if there are other files the user wants to update
@@ -61,4 +112,26 @@ def main():
 
 # Check the script is being run as the main file
 if __name__ == "__main__":
-    main()
\ No newline at end of file
+    parser = argparse.ArgumentParser(description="Update the GEO revisions in the TAF directory")
+    parser.add_argument("--bulk", metavar="CSV", help="change order CSV with part number and new revision columns to update in one pass")
+    parser.add_argument("--audit", metavar="DIR", help="compare every PDF in the TMT directory with its TAF and write the CSV and HTML reports into DIR")
+    parser.add_argument("--workers", type=int, help="number of worker processes for the audit (default one per CPU core)")
+    parser.add_argument("--instrument", metavar="JSON", help="time the hot paths, print the run summary at the end and write it to JSON")
+    parser.add_argument("--profile", metavar="PSTATS", help="also profile the run with cProfile and write the pstats file")
+    args = parser.parse_args()
+    if args.instrument is not None or args.profile is not None:
+        instrumentation.enable(args.profile is not None)
+    if args.audit is not None:
+        audit(ConfigManager('config.txt'), args.audit, args.workers)
+    else:
+        main(args.bulk)
+    
+    # Print and export the run summary if the run was instrumented
+    if instrumentation.enabled:
+        instrumentation.disable()
+        for line in instrumentation.summary():
+            print(line)
+        if args.instrument is not None:
+            instrumentation.export_json(args.instrument)
+        if args.profile is not None:
+            instrumentation.export_pstats(args.profile)
\ No newline at end of file
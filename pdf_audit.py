@@ -0,0 +1,198 @@
+# This module contains the whole-directory PDF-TAF audit and its summary report
+import os
+import csv
+import html
+import time
+import datetime
+import multiprocessing
+from PDF_module import build_pdf_batches, WorkerThroughput
+from pdf_taf_checker import ComparePdfTaf, classify_result
+from geo_catalogue import GeoCatalogue
+from taf_model import parse_taf
+from instrumentation import instrumentation
+
+class AuditTafManager:
+    """Stands in for the FileManager in the audit worker processes. ComparePdfTaf only needs get_all_parts and the GEO catalogue, so the workers don't open the backup store or TAF index."""
+    def __init__(self, taf_dir, geo_dir):
+        """Passes the TAF directory to the class and lists the GEO directory once."""
+        self.taf_dir = taf_dir
+        self.geo_catalogue = GeoCatalogue(geo_dir)
+
+    def get_all_parts(self, taf_name):
+        """Returns all parts in a provided TAF file, or False if it doesn't exist (same as FileManager.get_all_parts)."""
+        try:
+            return parse_taf(os.path.join(self.taf_dir, taf_name)).get_parts()
+        except FileNotFoundError:
+            return False
+
+audit_managers = {} # One AuditTafManager per (TAF, GEO) directory in each worker process so the GEO catalogue is only listed once per worker
+
+def audit_pdf_batch(task):
+    """Compares a batch of PDFs with their TAFs in a worker process. task is ((taf_dir, geo_dir, cache_path, use_native, instrumentation settings), pdf_paths, total_bytes) from PdfAudit.get_tasks.
+    Returns (results, (pid, files, bytes, seconds, instrumentation data)) where results is a list of (pdf_path, comparison results or False if there is no TAF, error text or None)."""
+    (taf_dir, geo_dir, cache_path, use_native, instrumentation_settings), pdf_paths, total_bytes = task
+    instrumentation.follow(instrumentation_settings) # Follow the main process
+    manager = audit_managers.get((taf_dir, geo_dir))
+    if manager is None:
+        manager = audit_managers[(taf_dir, geo_dir)] = AuditTafManager(taf_dir, geo_dir)
+    start = time.perf_counter()
+    results = []
+    with instrumentation.profile_thread():
+        for pdf_path in pdf_paths:
+            try:
+                results.append((pdf_path, ComparePdfTaf(pdf_path, manager, cache_path, None, use_native).compare_pdf_taf(), None))
+            except Exception as e:
+                results.append((pdf_path, None, str(e))) # One unreadable PDF doesn't stop the audit
+    return results, (os.getpid(), len(pdf_paths), total_bytes, time.perf_counter() - start, instrumentation.worker_data())
+
+class AuditReport:
+    """Results of a PdfAudit. rows holds (pdf_file, result) for every compared part, where result is the ComparePdfTaf tuple, and the colours are worked out with classify_result
+    exactly like the comparison tab shows them. PDFs without a TAF and PDFs that couldn't be compared are listed separately."""
+    STATUS_NAMES = {'green': 'Match', 'orange': 'Missing revision', 'red': 'Mismatch'}
+
+    def __init__(self, tmt_dir):
+        """Creates an empty report for the TMT directory."""
+        self.tmt_dir = tmt_dir
+        self.rows = []
+        self.missing_tafs = [] # PDF files without a TAF of the same name
+        self.errors = [] # (pdf_file, error text)
+        self.pdf_count = 0
+        self.throughput = WorkerThroughput()
+        self.elapsed = 0.0
+
+    def add(self, pdf_path, results, error):
+        """Adds the results of one PDF (see audit_pdf_batch)."""
+        pdf_file = os.path.basename(pdf_path)
+        self.pdf_count += 1
+        if error is not None:
+            self.errors.append((pdf_file, error))
+        elif results is False:
+            self.missing_tafs.append(pdf_file)
+        else:
+            self.rows.extend((pdf_file, result) for result in results)
+
+    def sort(self):
+        """Sorts the rows by PDF and part so the report doesn't depend on the order the workers finished in."""
+        self.rows.sort(key=lambda row: (row[0].lower(), row[1][0].lower()))
+        self.missing_tafs.sort(key=str.lower)
+        self.errors.sort(key=lambda error: error[0].lower())
+
+    def get_counts(self):
+        """Returns a dictionary with the number of parts of each background colour (green, orange, red) and GEO state colour (blue, purple, white)."""
+        counts = {'green': 0, 'orange': 0, 'red': 0, 'blue': 0, 'purple': 0, 'white': 0}
+        for _, result in self.rows:
+            bg_color, fg_color, _ = classify_result(result)
+            counts[bg_color] += 1
+            counts[fg_color] = counts.get(fg_color, 0) + 1
+        return counts
+
+    def summary(self):
+        """Returns the summary of the audit as a list of lines (counts, missing TAFs, errors and the worker throughput)."""
+        counts = self.get_counts()
+        rate = self.pdf_count / self.elapsed if self.elapsed else 0.0
+        lines = [f"Audited {self.pdf_count} PDFs ({len(self.rows)} parts) in {self.elapsed:.1f} s ({rate:.1f} PDFs/s)",
+                 f"Match: {counts['green']}, Missing revision: {counts['orange']}, Mismatch: {counts['red']}",
+                 f"Newer or outdated GEO: {counts['blue']}, GEO missing or without revision: {counts['purple']}",
+                 f"PDFs without a TAF: {len(self.missing_tafs)}, PDFs with errors: {len(self.errors)}"]
+        return lines + self.throughput.summary()
+
+    def get_table(self):
+        """Returns the rows of the report as lists of text (see write_csv for the columns)."""
+        table = []
+        for pdf_file, result in self.rows:
+            part, _, _, pdf_before, taf_after, pdf_after, geo_state = result
+            bg_color, fg_color, _ = classify_result(result)
+            table.append([pdf_file, part, self.STATUS_NAMES[bg_color], taf_after, pdf_after if pdf_before != "Part not found" else pdf_before, geo_state, bg_color, fg_color])
+        return table
+
+    def write_csv(self, file_path):
+        """Writes every compared part to a CSV file, followed by the PDFs without a TAF and the PDFs with errors."""
+        with open(file_path, 'w', newline='') as file:
+            writer = csv.writer(file)
+            writer.writerow(['PDF', 'TAF Part', 'Status', 'TAF Revision', 'Program Revision', 'GEO State', 'Colour', 'GEO Colour'])
+            writer.writerows(self.get_table())
+            for pdf_file in self.missing_tafs:
+                writer.writerow([pdf_file, '', 'TAF not found', '', '', '', 'red', ''])
+            for pdf_file, error in self.errors:
+                writer.writerow([pdf_file, '', f'Error: {error}', '', '', '', 'red', ''])
+
+    def write_html(self, file_path):
+        """Writes the report as an HTML page with the summary and a table coloured like the comparison tab. Green rows are left out so the problems stand out."""
+        created = datetime.datetime.now().strftime('%Y-%m-%d %H:%M:%S')
+        lines = ['<!DOCTYPE html>', '<html><head><meta charset="utf-8"><title>PDF-TAF Audit</title>',
+                 '<style>body{font-family:Arial,sans-serif} table{border-collapse:collapse} td,th{border:1px solid #999;padding:4px 8px;text-align:left}</style></head><body>',
+                 f'<h1>PDF-TAF Audit</h1><p>{html.escape(self.tmt_dir)}<br>{created}</p>', '<ul>']
+        lines += [f'<li>{html.escape(line)}</li>' for line in self.summary()]
+        lines += ['</ul>', '<table><tr><th>PDF</th><th>TAF Part</th><th>Status</th><th>TAF Revision</th><th>Program Revision</th><th>GEO State</th></tr>']
+        for row in self.get_table():
+            if row[6] == 'green' and row[7] == 'white':
+                continue # Nothing to check
+            cells = ''.join(f'<td>{html.escape(str(value))}</td>' for value in row[:6])
+            lines.append(f'<tr style="background:{row[6]};color:{row[7]}">{cells}</tr>')
+        for pdf_file in self.missing_tafs:
+            lines.append(f'<tr style="background:red;color:white"><td>{html.escape(pdf_file)}</td><td colspan="5">TAF not found</td></tr>')
+        for pdf_file, error in self.errors:
+            lines.append(f'<tr style="background:red;color:white"><td>{html.escape(pdf_file)}</td><td colspan="5">Error: {html.escape(error)}</td></tr>')
+        lines.append('</table></body></html>')
+        with open(file_path, 'w', encoding='utf-8') as file:
+            file.write('\n'.join(lines))
+
+    def write_reports(self, output_dir):
+        """Writes the CSV and HTML reports into output_dir with a timestamp in their names. Returns (csv_path, html_path)."""
+        os.makedirs(output_dir, exist_ok=True)
+        stamp = datetime.datetime.now().strftime('%Y%m%d_%H%M%S')
+        csv_path = os.path.join(output_dir, f'pdf_taf_audit_{stamp}.csv')
+        html_path = os.path.join(output_dir, f'pdf_taf_audit_{stamp}.html')
+        self.write_csv(csv_path)
+        self.write_html(html_path)
+        return csv_path, html_path
+
+class PdfAudit:
+    """This class compares every PDF in the TMT directory with the TAF of the same name, like clicking through the comparison tab one PDF at a time.
+    The PDFs are batched by size (see build_pdf_batches) and compared in the worker processes, each with its own GEO catalogue, and the results are collected into an AuditReport."""
+    def __init__(self, tmt_dir, taf_dir, geo_dir, cache_path=None, use_native=False):
+        """Passes the directories to the class. cache_path is the optional PDF text cache and with use_native the parts are read from the technology protocols or TMT programs when there are any (see ComparePdfTaf)."""
+        self.tmt_dir = tmt_dir
+        self.taf_dir = taf_dir
+        self.geo_dir = geo_dir
+        self.cache_path = cache_path
+        self.use_native = use_native
+
+    def get_pdf_files(self):
+        """Returns the sorted paths of the PDFs in the TMT directory (the same PDFs the comparison tab lists)."""
+        return sorted(os.path.join(self.tmt_dir, name) for name in os.listdir(self.tmt_dir) if name.endswith('.pdf'))
+
+    def get_tasks(self, pdf_files):
+        """Returns the audit_pdf_batch tasks for the PDFs."""
+        settings = (self.taf_dir, self.geo_dir, self.cache_path, self.use_native, instrumentation.worker_settings())
+        return [(settings, batch, batch_bytes) for batch, batch_bytes in build_pdf_batches(pdf_files)]
+
+    def run(self, worker_pool=None, processes=None, cancel_event=None, progress=None):
+        """Runs the audit and returns the AuditReport. The application's WorkerPool is used if one is given, otherwise a pool with the given number of processes is started for the audit.
+        progress is called with (pdfs_done, total) after every batch. Once the cancel_event is set no new batches are started and the report only covers the finished ones."""
+        start = time.perf_counter()
+        report = AuditReport(self.tmt_dir)
+        pdf_files = self.get_pdf_files()
+        tasks = self.get_tasks(pdf_files)
+
+        # Use the application's pool if there is one, otherwise start new multiprocessing pool
+        if worker_pool is not None:
+            batch_results = worker_pool.imap_unordered(audit_pdf_batch, tasks, cancel_event)
+        else:
+            pool = multiprocessing.Pool(processes)
+            batch_results = pool.imap_unordered(audit_pdf_batch, tasks)
+        try:
+            for results, batch_stats in batch_results:
+                report.throughput.add(*batch_stats)
+                for result in results:
+                    report.add(*result)
+                if progress is not None:
+                    progress(report.pdf_count, len(pdf_files))
+                if worker_pool is None and cancel_event is not None and cancel_event.is_set():
+                    break
+        finally:
+            if worker_pool is None:
+                pool.terminate()
+        report.sort()
+        report.elapsed = time.perf_counter() - start
+        return report
@@ -0,0 +1,56 @@
+# This module contains all code related to caching the extracted text of the TMT PDF files
+import os
+import sqlite3
+
+class PdfTextCache:
+    """This class implements a persistent cache of the whitespace-free page text of PDF files, keyed on the file path, modification time and size.
+    With fast extraction the stored text starts at the first GEO reference of the page, which is all the GEO searches need.
+    Entries are filled lazily by PdfSearcher.search_pdf and are replaced automatically when the PDF changes, so repeat searches don't need to open the PDF.
+    The cache is an SQLite database in WAL mode so the search worker processes can all read and write it at the same time."""
+    def __init__(self, db_path):
+        """Opens (or creates) the cache database at db_path."""
+        self.db_path = db_path
+        self.connection = sqlite3.connect(db_path, timeout=30, check_same_thread=False)
+        self.connection.execute("PRAGMA journal_mode=WAL")
+        self.connection.executescript("""
+            CREATE TABLE IF NOT EXISTS files (path TEXT PRIMARY KEY, mtime_ns INTEGER, size INTEGER);
+            CREATE TABLE IF NOT EXISTS pages (path TEXT, page_num INTEGER, text TEXT, PRIMARY KEY (path, page_num));
+        """)
+        self.connection.commit()
+
+    def close(self):
+        """Close the connection to the cache database."""
+        self.connection.close()
+
+    def get_pages(self, file_path, stat_result=None):
+        """Returns the cached list of page texts for the PDF, or None if it isn't cached or the cached entry is stale (stale entries are removed)."""
+        if stat_result is None:
+            stat_result = os.stat(file_path)
+        row = self.connection.execute("SELECT mtime_ns, size FROM files WHERE path = ?", (file_path,)).fetchone()
+        if row is None:
+            return None
+        if row != (stat_result.st_mtime_ns, stat_result.st_size):
+            self.remove(file_path) # The PDF has changed since it was cached
+            return None
+        return [text for (text,) in self.connection.execute("SELECT text FROM pages WHERE path = ? ORDER BY page_num", (file_path,))]
+
+    def put_pages(self, file_path, stat_result, pages):
+        """Stores the page texts of the PDF with the stat signature they were extracted from."""
+        with self.connection:
+            self.connection.execute("DELETE FROM pages WHERE path = ?", (file_path,))
+            self.connection.executemany("INSERT INTO pages VALUES (?, ?, ?)", [(file_path, page_num, text) for page_num, text in enumerate(pages)])
+            self.connection.execute("INSERT OR REPLACE INTO files VALUES (?, ?, ?)", (file_path, stat_result.st_mtime_ns, stat_result.st_size))
+
+    def remove(self, file_path):
+        """Removes a PDF from the cache."""
+        with self.connection:
+            self.connection.execute("DELETE FROM pages WHERE path = ?", (file_path,))
+            self.connection.execute("DELETE FROM files WHERE path = ?", (file_path,))
+
+    def prune(self, file_paths, directory):
+        """Removes the cached PDFs in the directory that aren't in file_paths any more (deleted or renamed)."""
+        existing = set(file_paths)
+        prefix = os.path.join(directory, '')
+        for (path,) in self.connection.execute("SELECT path FROM files").fetchall():
+            if path.startswith(prefix) and path not in existing:
+                self.remove(path)
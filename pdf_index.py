@@ -0,0 +1,162 @@
+# This module contains all code related to the part index of the TMT PDF directory
+import os
+import re
+import sqlite3
+import multiprocessing
+import threading
+import time
+from PDF_module import PdfSearcher, build_pdf_batches
+from instrumentation import instrumentation
+
+# Matches one GEO reference in the whitespace-free page text. Group 1 is everything after the GEO folder (sub folders and the part with its revision).
+REF_PATTERN = re.compile(r"GEO\\(.*?)\.GEO", flags=re.IGNORECASE | re.DOTALL)
+
+def extract_pdf_refs(file_path, cache_path=None):
+    """Returns (file_path, stat_result, refs) where refs is a list of (page_num, ref) for every GEO reference in the PDF. refs is None if the PDF couldn't be read.
+    This is a module level function so it can be sent to the worker processes."""
+    searcher = PdfSearcher(None, os.path.dirname(file_path), cache_path)
+    try:
+        stat_result = os.stat(file_path)
+        instrumentation.count('pdf.files_scanned')
+        instrumentation.count('pdf.bytes_read', stat_result.st_size)
+        refs = [(page_num, ref) for page_num, text in enumerate(searcher.get_page_texts(file_path)) for ref in REF_PATTERN.findall(text)]
+    except Exception as e:
+        print(f"Error processing {file_path}: {e}")
+        stat_result, refs = None, None
+    return file_path, stat_result, refs
+
+def extract_pdf_refs_batch(task):
+    """Runs extract_pdf_refs on a batch of PDFs in a worker process. task is ((cache_path, instrumentation settings), file_paths, total_bytes) with the batches from build_pdf_batches.
+    Returns (results, (pid, files, bytes, seconds, instrumentation data)) so the throughput of each worker can be reported."""
+    (cache_path, instrumentation_settings), file_paths, total_bytes = task
+    instrumentation.follow(instrumentation_settings) # Follow the main process
+    start = time.perf_counter()
+    with instrumentation.profile_thread():
+        results = [extract_pdf_refs(file_path, cache_path) for file_path in file_paths]
+    return results, (os.getpid(), len(file_paths), total_bytes, time.perf_counter() - start, instrumentation.worker_data())
+
+class PdfPartIndex:
+    """This class implements an index of every GEO reference in every PDF of the TMT directory (part -> list of (pdf, page)).
+    Each PDF is only read when it is added or its modification time or size changes, and deleted PDFs are dropped, so searches are answered from the index instead of reading every PDF."""
+    def __init__(self, directory, db_path, cache_path=None):
+        """Passes the TMT directory, the index database path and the optional PDF text cache path (used when a PDF has to be read) to the class."""
+        self.directory = directory
+        self.db_path = db_path
+        self.cache_path = cache_path
+        self.lock = threading.Lock() # The index is used from the search job thread and the Tk thread
+        self.connection = sqlite3.connect(db_path, check_same_thread=False)
+        self.connection.executescript("""
+            CREATE TABLE IF NOT EXISTS files (path TEXT PRIMARY KEY, mtime_ns INTEGER, size INTEGER);
+            CREATE TABLE IF NOT EXISTS refs (path TEXT, page INTEGER, ref TEXT, ref_lower TEXT, part_lower TEXT);
+            CREATE INDEX IF NOT EXISTS refs_path ON refs (path);
+            CREATE INDEX IF NOT EXISTS refs_part ON refs (part_lower);
+        """)
+        self.connection.commit()
+
+    def close(self):
+        """Close the connection to the index database."""
+        self.connection.close()
+
+    def list_pdfs(self):
+        """Returns the list of PDF files in the TMT directory (including sub folders like search_in_directory)."""
+        return [os.path.join(root, file)
+                for root, _, files in os.walk(self.directory)
+                for file in files if file.endswith(".pdf")]
+
+    def store(self, file_path, stat_result, refs):
+        """Replaces the references of one PDF in the index."""
+        rows = [(file_path, page_num, ref, ref.lower(), ref.rsplit('\\', 1)[-1].lower()) for page_num, ref in refs]
+        with self.lock, self.connection:
+            self.connection.execute("DELETE FROM refs WHERE path = ?", (file_path,))
+            self.connection.executemany("INSERT INTO refs VALUES (?, ?, ?, ?, ?)", rows)
+            self.connection.execute("INSERT OR REPLACE INTO files VALUES (?, ?, ?)", (file_path, stat_result.st_mtime_ns, stat_result.st_size))
+
+    def remove(self, file_path):
+        """Removes a PDF from the index."""
+        with self.lock, self.connection:
+            self.connection.execute("DELETE FROM refs WHERE path = ?", (file_path,))
+            self.connection.execute("DELETE FROM files WHERE path = ?", (file_path,))
+
+    def find_changed(self, pdf_files):
+        """Returns the list of PDFs that are new or have changed since they were indexed. PDFs that were deleted from the directory are removed from the index."""
+        prefix = os.path.join(self.directory, '')
+        with self.lock:
+            indexed = {path: (mtime_ns, size) for path, mtime_ns, size in self.connection.execute("SELECT path, mtime_ns, size FROM files") if path.startswith(prefix)}
+        changed = []
+        for file_path in pdf_files:
+            try:
+                stat_result = os.stat(file_path)
+            except FileNotFoundError:
+                continue
+            if indexed.pop(file_path, None) != (stat_result.st_mtime_ns, stat_result.st_size):
+                changed.append(file_path)
+
+        # Anything left over was deleted from the directory
+        for file_path in indexed:
+            self.remove(file_path)
+        return changed
+
+    def index_changed(self, changed, pool=None, cancel_event=None, throughput=None):
+        """Reads the changed PDFs and stores their references. Yields (file_path, refs) as each PDF is finished so callers can stream results.
+        With a pool the PDFs are sent in size-ordered batches (see build_pdf_batches) and the batch stats are added to the throughput (a WorkerThroughput) if one is given.
+        The cancel_event is only supported with a WorkerPool."""
+        if pool is None:
+            batch_results = (([extract_pdf_refs(file_path, self.cache_path)], None) for file_path in changed)
+        else:
+            tasks = [((self.cache_path, instrumentation.worker_settings()), batch, batch_bytes) for batch, batch_bytes in build_pdf_batches(changed)]
+            if cancel_event is not None:
+                batch_results = pool.imap_unordered(extract_pdf_refs_batch, tasks, cancel_event)
+            else:
+                batch_results = pool.imap_unordered(extract_pdf_refs_batch, tasks)
+        for results, batch_stats in batch_results:
+            if throughput is not None and batch_stats is not None:
+                throughput.add(*batch_stats)
+            elif batch_stats is not None:
+                instrumentation.merge(batch_stats[4])
+            for file_path, stat_result, refs in results:
+                if refs is not None: # Unreadable PDFs are tried again on the next update
+                    self.store(file_path, stat_result, refs)
+                yield file_path, refs or []
+
+    def update(self, pdf_files=None, worker_pool=None):
+        """Brings the index up to date with the TMT directory. New and changed PDFs are read in parallel (in the application's WorkerPool if one is given), deleted PDFs are removed.
+        Returns the number of PDFs that were read."""
+        if pdf_files is None:
+            pdf_files = self.list_pdfs()
+        changed = self.find_changed(pdf_files)
+
+        # Only start worker processes when there are enough PDFs to make it worth it
+        if worker_pool is not None and changed:
+            for _ in self.index_changed(changed, worker_pool):
+                pass
+        elif len(changed) > 4:
+            with multiprocessing.Pool() as pool:
+                for _ in self.index_changed(changed, pool):
+                    pass
+        else:
+            for _ in self.index_changed(changed):
+                pass
+        return len(changed)
+
+    @staticmethod
+    def refs_match(refs, search_string):
+        """Checks if any of the (page_num, ref) references contains the search string, using the same rules as search."""
+        search = re.sub(r'\s+', '', search_string).lower()
+        return any(search in ref.lower() for _, ref in refs)
+
+    def search(self, search_string, prefix=False):
+        """Returns the sorted list of PDFs with a GEO reference containing the search string (case insensitive, whitespace ignored).
+        With prefix=True only part names starting with the search string match."""
+        search = re.sub(r'\s+', '', search_string).lower()
+        escaped = search.replace('\\', '\\\\').replace('%', '\\%').replace('_', '\\_') # Escape the LIKE wildcards
+        with self.lock:
+            if prefix:
+                rows = self.connection.execute("SELECT DISTINCT path FROM refs WHERE part_lower LIKE ? ESCAPE '\\'", (escaped + '%',)).fetchall()
+            else:
+                rows = self.connection.execute("SELECT DISTINCT path FROM refs WHERE ref_lower LIKE ? ESCAPE '\\'", ('%' + escaped + '%',)).fetchall()
+        return sorted(path for (path,) in rows)
+
+    def get_locations(self, part):
+        """Returns the list of (pdf, page) tuples referencing a part (name with revision, case insensitive)."""
+        with self.lock:
+            return self.connection.execute("SELECT path, page FROM refs WHERE part_lower = ? ORDER BY path, page", (part.replace(" ", "").lower(),)).fetchall()
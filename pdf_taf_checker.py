@@ -1,5 +1,13 @@
 # This module contains all code related to PDF-TAF comparisons
 from PDF_module import PdfSearcher
+from tmt_parser import parse_tmt, find_tmt_for_pdf
+from protocol_parser import parse_protocol, find_protocol
+import os
+import queue
+import threading
+from collections import OrderedDict
+from geo_catalogue import MISSING_REVISION, revision_key
+from instrumentation import instrumentation
 import re
 
 # Check if string is number (positive or negative)
@@ -9,132 +17,314 @@ def is_number(s):
         return True
     except ValueError:
         return False
+
+def split_revision(part):
+    """Splits a part name at the last underscore into (part number, revision). The revision is "Missing Revision" if there is no underscore."""
+    split = part.rsplit('_', 1)  # Split at the first underscore from the right
+    if len(split) == 2:
+        return split[0], split[1]
+    return split[0], MISSING_REVISION
+
+def pdf_revision_key(revision):
+    """Returns the ordering key of a program (PDF or TMT) revision for get_geo_state: (0, n) for whole numbers (negative included), (1, uppercase) for lettered revisions,
+    (2, None) for other text that reads as a number (1.5, inf) and None for anything else (including "Missing Revision")."""
+    try:
+        return (0, int(revision))
+    except ValueError:
+        pass
+    if is_number(revision):
+        return (2, None)
+    if revision.isalpha():
+        return (1, revision.upper())
+    return None
+
+def get_geo_state(latest_geo_rev, pdf_revision):
+    """Returns the GEO state text of a part from the latest GEO revision (GeoCatalogue.latest_revision) and the revision in the program.
+    Lettered (production) GEO revisions are newer than any numbered (design) revision. Letters are compared with letters and numbers with numbers."""
+    # -2 means the GEO has no revision and -1 means no GEO (or an unsupported revision format)
+    if latest_geo_rev == '-2':
+        return "GEO missing revision"
+    if latest_geo_rev == '-1':
+        return "No GEO found or unsupported revision format"
+    geo_key, pdf_key = revision_key(latest_geo_rev), pdf_revision_key(pdf_revision)
     
+    # Work out if the GEO is newer (1), the same (0) or older (-1) than the program. None means the revisions can't be compared.
+    order = None
+    if geo_key is not None and pdf_key is not None:
+        if geo_key[0] == 1 and pdf_key[0] != 1:
+            order = 1 # A lettered GEO is newer than any numbered revision
+        elif geo_key[0] == pdf_key[0]:
+            order = (geo_key[1] > pdf_key[1]) - (geo_key[1] < pdf_key[1])
+    if order == 1:
+        return f"Newer GEO exists. Revision is {latest_geo_rev}"
+    if order == 0:
+        return f"Program contains latest GEO: {latest_geo_rev}"
+    # Catch the case where the GEO is outdated (indicates the file has been deleted)
+    return f"Latest GEO revision is only: {latest_geo_rev}"
+    
+# Text colour of each GEO state (regex on the state text -> colour)
+GEO_STATE_COLORS = {
+    'GEO missing revision': 'purple',
+    'No GEO found':         'purple',
+    r'Newer GEO.*':         'blue',
+    r'Latest GEO revision is.*': 'blue',
+    r'Program contains latest.*': 'white',
+}
+
+def get_color_based_on_geo_state(geo_state):
+    """Returns the text colour of a GEO state (see GEO_STATE_COLORS)."""
+    for pattern, color in GEO_STATE_COLORS.items():
+        if re.search(pattern, geo_state):
+            return color
+    return 'white'
+
+def classify_result(result):
+    """Returns (bg_color, fg_color, text) for one comparison result tuple. This is how the comparison tab shows the result and how the audit counts it.
+    The background is green when the TAF and program revisions match, orange when both are missing the revision and red otherwise. The text colour comes from the GEO state."""
+    (part_number, match,
+        taf_before_underscore, pdf_before_underscore,
+        taf_after_underscore, pdf_after_underscore,
+        geo_state) = result
+
+    if (match
+        and taf_after_underscore != MISSING_REVISION
+        and pdf_after_underscore != MISSING_REVISION):
+        bg_color = 'green'
+        text = (f"{part_number}\n"
+                f"Revision: {pdf_after_underscore}\n"
+                f"GEO State: {geo_state}")
+
+    elif (match
+        and taf_after_underscore == MISSING_REVISION
+        and pdf_after_underscore == MISSING_REVISION):
+        bg_color = 'orange'
+        text = (f"{part_number}\n"
+                f"TAF & PDF Missing Revision\n"
+                f"GEO State: {geo_state}")
+
+    else:
+        bg_color = 'red'
+        if pdf_before_underscore == "Part not found":
+            text = (f"{part_number}\n"
+                    f"PDF: {pdf_before_underscore}, "
+                    f"TAF: {taf_before_underscore}_{taf_after_underscore}\n"
+                    f"GEO State: {geo_state}")
+        elif taf_after_underscore != "Missing TAF":
+            text = (f"{part_number}\n"
+                    f"PDF: {pdf_before_underscore}_{pdf_after_underscore}, "
+                    f"TAF: {taf_before_underscore}_{taf_after_underscore}\n"
+                    f"GEO State: {geo_state}")
+        else:
+            text = (f"{part_number}\n"
+                    f"PDF: {pdf_before_underscore}_{pdf_after_underscore}, "
+                    f"TAF: {taf_before_underscore}\n"
+                    f"GEO State: {geo_state}")
+    return bg_color, get_color_based_on_geo_state(geo_state), text
+
 class ComparePdfTaf():
     """This class implements the comparison of PDF and TAF files. It uses the PdfSearcher class to search for parts in the PDF file and the FileManager class to get all parts from the TAF file. 
     The comparison is done by matching the parts before and after the underscore in the part number. If the parts before the underscore match, the parts after the underscore are compared. 
     If both parts match, the comparison result is stored as True, otherwise it is stored as False. If the TAF file is not found, the comparison result is stored as False. 
     The comparison results are stored in a list of tuples, where each tuple contains the TAF part number, the comparison result, the part number before the underscore in the TAF file, the part number before the underscore in the PDF file, 
     the part number after the underscore in the TAF file, and the part number after the underscore in the PDF file."""
-    def __init__(self, pdf_path, taf_manager):
-        """Initializes the ComparePdfTaf class with the path to the PDF file and the FileManager object."""
-        self.taf_parts, self.pdf_parts, self.geo_parts = [], [], [] # Create the blank lists
+    def __init__(self, pdf_path, taf_manager, cache_path=None, worker_pool=None, use_native=False):
+        """Initializes the ComparePdfTaf class with the path to the PDF file and the FileManager object. cache_path is the optional PDF text cache (see PdfTextCache).
+        If the application's WorkerPool is given the PDF text is extracted in one of its (already warm) workers.
+        With use_native the parts are read from the native TruTops files when there are any, which avoids extracting the PDF text: first the technology protocol (.doc)
+        next to the TAF or the PDF and then the TMT program next to the PDF (both with the same name)."""
+        self.taf_parts, self.pdf_parts = [], [] # Create the blank lists
         self.pdf_path = pdf_path
-        print(f"PDF path: {self.pdf_path}") # Debug print statement
         self.taf_manager = taf_manager
+        self.cache_path = cache_path
+        self.worker_pool = worker_pool
+        self.use_native = use_native
+
+    def get_taf_name(self):
+        """Returns the name of the TAF with the same name as the PDF."""
+        pattern = r".*[/\\](.*)\.[^.]+$" # Pattern to match filename to replace extension
+        return re.sub(pattern, r"\1.taf", self.pdf_path) # Replace the extension with .taf
+
+    def get_native_sources(self):
+        """Returns (protocol_path, tmt_path) of the native files of the program, each None if it doesn't exist."""
+        protocol_path = find_protocol(self.taf_manager.taf_dir, self.pdf_path) or find_protocol(os.path.dirname(self.pdf_path), self.pdf_path)
+        return protocol_path, find_tmt_for_pdf(self.pdf_path)
+
+    def get_signature(self):
+        """Returns what the comparison result depends on: the modification times of the PDF, the TAF and (with use_native) the protocol and TMT, the GEO catalogue version and use_native.
+        A result can be reused as long as the signature is the same (see ComparisonCache)."""
+        def get_mtime(file_path):
+            try:
+                return os.stat(file_path).st_mtime_ns if file_path is not None else None
+            except OSError:
+                return None
+        geo_catalogue = self.taf_manager.geo_catalogue
+        geo_catalogue.refresh()
+        native_mtimes = tuple(get_mtime(file_path) for file_path in self.get_native_sources()) if self.use_native else ()
+        return (get_mtime(self.pdf_path), get_mtime(os.path.join(self.taf_manager.taf_dir, self.get_taf_name())), native_mtimes, geo_catalogue.version, self.use_native)
+
+    def get_program_parts(self):
+        """Returns the parts of the program. When use_native is set they come from the technology protocol or the TMT file if one exists, otherwise from the PDF text."""
+        if self.use_native:
+            # The protocol is only a few KB. It is skipped if TruTops cut off any of the part names in it.
+            protocol_path, tmt_path = self.get_native_sources()
+            if protocol_path is not None:
+                try:
+                    with instrumentation.span('protocol.read'):
+                        protocol = parse_protocol(protocol_path)
+                    if protocol.complete:
+                        return protocol.get_parts()
+                except OSError as e:
+                    print(f"Error reading {protocol_path}: {e}")
+
+            if tmt_path is not None:
+                try:
+                    with instrumentation.span('tmt.read'):
+                        return parse_tmt(tmt_path).get_parts()
+                except OSError as e:
+                    print(f"Error reading {tmt_path}, using the PDF instead: {e}")
+
+        # PdfSearcher doesn't require search string because it is looking for all matches to internal regex pattern. This creates a new PDFSearcher instance and searches the PDF file for all parts.
+        searcher = PdfSearcher(None, self.pdf_path, self.cache_path)
+        if self.worker_pool is not None:
+            return self.worker_pool.apply(searcher.search_pdf, (self.pdf_path, True))
+        return searcher.search_pdf(self.pdf_path, True)
 
     def compare_pdf_taf(self):
         """Check all parts in a PDF with the TAF of the same name. Returns list of tuples: (taf_part, is_match (T/F), taf_before_underscore, pdf_before_underscore, taf_after_underscore, pdf_after_underscore) is the tuple format"""
         comparison_results = []  # This list will store the tuples with the comparison results
-        pattern = r".*[/\\](.*)\.[^.]+$" # Pattern to match filename to replace extension
-        taf_name = re.sub(pattern, r"\1.taf", self.pdf_path) # Replace the extension with .taf
-        self.taf_parts = self.taf_manager.get_all_parts(taf_name) # Get all parts from the TAF file
+        self.taf_parts = self.taf_manager.get_all_parts(self.get_taf_name()) # Get all parts from the TAF file
         
         # Check the TAF file exists
         if self.taf_parts is False:
                return False
         
-        # PdfSearcher doesn't require search string because it is looking for all matches to internal regex pattern. This creates a new PDFSearcher instance and searches the PDF file for all parts.
-        searcher = PdfSearcher(None, self.pdf_path)
-        self.pdf_parts = searcher.search_pdf(self.pdf_path, True)
+        self.pdf_parts = self.get_program_parts()
+        
+        geo_catalogue = self.taf_manager.geo_catalogue
+        geo_catalogue.refresh() # Only re-lists the GEO directory if it has changed
         
-        self.geo_parts = self.taf_manager.get_geo_list() # Get all parts from the GEO file
+        # Split and normalize every PDF part once. The first PDF part with a part number is the one compared, like the original search through the list.
+        pdf_lookup = {}
+        for pdf_part in self.pdf_parts:
+            pdf_before_underscore, pdf_after_underscore = split_revision(pdf_part)
+            pdf_lookup.setdefault(pdf_before_underscore.replace(" ", "").lower(), (pdf_before_underscore, pdf_after_underscore))
+        latest_revisions = {} # Latest GEO revision of each part number, looked up once
         
-        # Compare each part in the TAF with each part in the PDF
+        # Compare each part in the TAF with the PDF part with the same part number
         for taf_part in self.taf_parts:
-            taf_split = taf_part.rsplit('_', 1)  # Split at the first underscore from the right
-            print(f"TAF Split: {taf_split}") # Debug print
+            taf_before_underscore, taf_after_underscore = split_revision(taf_part)
             
-            # Check there was a split (meaning there was an underscore in the part number indicating a revision)
-            if len(taf_split) == 2:
-                taf_before_underscore, taf_after_underscore = taf_split  # Separate into before and after underscore
-            # No underscore in the part number so set the after underscore to "Missing Revision"
+            # If there is a matching part number, check the revisions. Otherwise the PDF part number is set to "Part not found".
+            pdf_match = pdf_lookup.get(taf_before_underscore.replace(" ", "").lower())
+            if pdf_match is not None:
+                pdf_before_underscore, pdf_after_underscore = pdf_match
+                is_match = taf_after_underscore == pdf_after_underscore # Check if the parts after the underscore match
             else:
-                taf_before_underscore = taf_split[0]
-                taf_after_underscore = "Missing Revision"
-
-            found_match = False
-            # Iterate over PDF for each part in the TAF
-            for pdf_part in self.pdf_parts:
-                pdf_split = pdf_part.rsplit('_', 1)  # Split at the first underscore from the right
-                
-                # Check there was a split (meaning there was an underscore in the part number indicating a revision)
-                if len(pdf_split) == 2:
-                    pdf_before_underscore, pdf_after_underscore = pdf_split  # Separate into before and after underscore
-                # No underscore in the part number so set the after underscore to "Missing Revision"
-                else:
-                    pdf_before_underscore = pdf_split[0]
-                    pdf_after_underscore = "Missing Revision"
-                    
-                # Check if the parts before the underscore match
-                processed_taf = taf_before_underscore.replace(" ", "").lower() # Remove the spaces and convert to lowercase
-                processed_pdf = pdf_before_underscore.replace(" ", "").lower()
-                is_match = processed_taf == processed_pdf
-                
-                # If there is a matching part number, check the revisions and end loop.
-                if is_match:
-                    is_match = taf_after_underscore == pdf_after_underscore # Check if the parts after the underscore match
-                    print(f"TAF After _: {taf_after_underscore}, PDF After _: {pdf_after_underscore}")
-                    found_match = True
-                    break # Found a match
-                
-            # If no match was found, set the PDF part number to "Part not found". This occurs if the bottom of the PDF file is found without is_match being set
-            if found_match == False:
+                is_match = False
                 pdf_before_underscore = "Part not found"
                 pdf_after_underscore = " "
-            latest_geo_rev = '-1' # Initialize the latest revision number. Negative numbers should never appear in the GEO file under normal circumstances.
-            for geo in self.geo_parts:
-                geo_noex = geo.rsplit('.', 1)[0] # Remove the extension
-                geo_split = geo_noex.rsplit('_', 1)  # Split at the first underscore from the right
-                
-                # Check there was a split (meaning there was an underscore in the part number indicating a revision)
-                if len(geo_split) == 2:
-                    geo_before_underscore, geo_after_underscore = geo_split  # Separate into before and after underscore
-                    geo_after_underscore = geo_after_underscore.upper() # Convert to uppercase
-                # No underscore in the part number so set the after underscore to "Missing Revision"
-                else:
-                    geo_before_underscore = geo_split[0]
-                    geo_after_underscore = "Missing Revision"
-                
-                 # Check if the parts before the underscore match
-                processed_geo = geo_before_underscore.replace(" ", "").lower() # Remove the spaces and convert to lowercase
-                processed_pdf = pdf_before_underscore.replace(" ", "").lower()
-                geo_is_match = processed_geo == processed_pdf
-                
-                # Check if the parts after the underscore match and ensure the geo after the underscore is not missing a revision
-                if geo_is_match and geo_after_underscore != "Missing Revision":
-                    print(f"GEO: {geo_after_underscore}")
-                    if (geo_after_underscore.isalpha() and latest_geo_rev.isalpha() and geo_after_underscore.upper() > latest_geo_rev.upper())\
-                        or (is_number(geo_after_underscore) and is_number(latest_geo_rev) and int(geo_after_underscore) > int(latest_geo_rev))\
-                        or (geo_after_underscore.isalpha() and is_number(latest_geo_rev)):
-                        latest_geo_rev = geo_after_underscore
-                # If GEO is missing a revision, set the latest_geo_rev to -2. If the latest_geo_rev is already -2, keep it as -2.
-                elif geo_is_match and geo_after_underscore == "Missing Revision" and (latest_geo_rev == '-1' or latest_geo_rev == '-2'):
-                    latest_geo_rev = "-2"
-        
-            # Check if the latest_geo_rev was missing a revision
-            if latest_geo_rev == '-2':
-                pdf_geo_state = "GEO missing revision"
-            # Check if the part number match was found
-            elif latest_geo_rev == '-1':
-                pdf_geo_state = "No GEO found or unsupported revision format"
-            # Check if the GEO is a letter and the PDF is a number or if the revision in the GEO is higher than the PDF. This indicates that there is a newer version of the GEO.
-            elif (latest_geo_rev.isalpha() and is_number(pdf_after_underscore))\
-                or (is_number(latest_geo_rev) and is_number(pdf_after_underscore) and int(latest_geo_rev) > int(pdf_after_underscore))\
-                or (latest_geo_rev.isalpha() and pdf_after_underscore.isalpha() and latest_geo_rev.upper() > pdf_after_underscore.upper()):
-                pdf_geo_state = f"Newer GEO exists. Revision is {latest_geo_rev}"
-            # Check if the GEO matches the PDF
-            elif (is_number(latest_geo_rev) and is_number(pdf_after_underscore) and int(latest_geo_rev) == int(pdf_after_underscore)) or \
-                (latest_geo_rev.isalpha() and pdf_after_underscore.isalpha() and latest_geo_rev.upper() == pdf_after_underscore.upper()):
-                pdf_geo_state = f"Program contains latest GEO: {latest_geo_rev}"
-                print(f"Not found.... GEO: {latest_geo_rev} PDF: {pdf_after_underscore}")
-            # Catch the case where the GEO is outdated (indicates the file has been deleted)
-            else:
-                pdf_geo_state = f"Latest GEO revision is only: {latest_geo_rev}"
-                        
-                
+            
+            # Look up the latest revision of the part in the GEO catalogue and work out the state of the program
+            if pdf_before_underscore not in latest_revisions:
+                with instrumentation.span('geo.lookup'):
+                    latest_revisions[pdf_before_underscore] = geo_catalogue.latest_revision(pdf_before_underscore)
+            pdf_geo_state = get_geo_state(latest_revisions[pdf_before_underscore], pdf_after_underscore)
+            
             # Store the comparison result along with parts before and after the underscore as a list of tuples
             comparison_results.append((taf_part, is_match, taf_before_underscore, pdf_before_underscore, taf_after_underscore, pdf_after_underscore, pdf_geo_state))
 
+        instrumentation.count('compare.parts', len(comparison_results))
         return comparison_results # Return list of tuples
- 
\ No newline at end of file
+ 
+class ComparisonCache:
+    """This class memoises comparison results by PDF path. Each result is stored with the signature of the comparison (see ComparePdfTaf.get_signature) and is only returned
+    while the signature is the same, so an edited PDF, TAF or native file or a changed GEO directory is compared again. The least recently used results are dropped after max_entries."""
+    def __init__(self, max_entries=256):
+        """Creates the empty cache."""
+        self.max_entries = max_entries
+        self.entries = OrderedDict() # (pdf_path, use_native) -> (signature, results)
+        self.lock = threading.Lock()
+
+    def get(self, comparer, signature):
+        """Returns the cached results of the comparer's PDF if they were compared with the same signature, otherwise None."""
+        with self.lock:
+            entry = self.entries.get((comparer.pdf_path, comparer.use_native))
+            if entry is None or entry[0] != signature:
+                return None
+            self.entries.move_to_end((comparer.pdf_path, comparer.use_native))
+            return entry[1]
+
+    def put(self, comparer, signature, results):
+        """Stores the results of a comparison."""
+        with self.lock:
+            self.entries[(comparer.pdf_path, comparer.use_native)] = (signature, results)
+            self.entries.move_to_end((comparer.pdf_path, comparer.use_native))
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+
+class ComparisonWorker:
+    """This class runs the PDF-TAF comparisons on a background thread so the Tk main loop never waits for a PDF, TAF or GEO listing. The selected PDF is compared first and then its neighbours
+    in the list are prefetched into the ComparisonCache, so moving through the programs shows cached results straight away. A new request replaces everything still pending.
+    Results of requested PDFs are put on the queue as ('result', pdf_path, results) or ('error', pdf_path, error), where results is False if the TAF wasn't found like compare_pdf_taf.
+    The GUI polls the queue with root.after."""
+    def __init__(self, taf_manager, cache_path=None, worker_pool=None, cache=None):
+        """Passes the FileManager, the PDF text cache path and the application's WorkerPool on to every ComparePdfTaf."""
+        self.taf_manager = taf_manager
+        self.cache_path = cache_path
+        self.worker_pool = worker_pool
+        self.cache = cache if cache is not None else ComparisonCache()
+        self.queue = queue.Queue()
+        self.pending = [] # (pdf_path, use_native, requested) to compare in order. Prefetches aren't requested, they only fill the cache.
+        self.condition = threading.Condition()
+        self.stopped = False
+        self.thread = threading.Thread(target=self.run, daemon=True)
+
+    def start(self):
+        """Start the comparison thread."""
+        self.thread.start()
+
+    def stop(self):
+        """Stop the thread after the comparison it is running."""
+        with self.condition:
+            self.stopped = True
+            self.pending = []
+            self.condition.notify()
+
+    def request(self, pdf_path, use_native, prefetch=()):
+        """Compares pdf_path (its result goes on the queue) and then prefetches the PDFs in prefetch. Anything still pending from an earlier request is dropped."""
+        with self.condition:
+            self.pending = [(pdf_path, use_native, True)] + [(prefetch_path, use_native, False) for prefetch_path in prefetch]
+            self.condition.notify()
+
+    def compare(self, pdf_path, use_native):
+        """Returns the comparison results of a PDF, from the cache if nothing it depends on has changed."""
+        comparer = ComparePdfTaf(pdf_path, self.taf_manager, self.cache_path, self.worker_pool, use_native)
+        signature = comparer.get_signature()
+        results = self.cache.get(comparer, signature)
+        if results is not None:
+            instrumentation.count('compare.cache_hits')
+            return results
+        with instrumentation.span('compare.run'):
+            results = comparer.compare_pdf_taf()
+        self.cache.put(comparer, signature, results)
+        return results
+
+    def run(self):
+        """Takes the pending comparisons one at a time until the worker is stopped."""
+        while True:
+            with self.condition:
+                while not self.pending and not self.stopped:
+                    self.condition.wait()
+                if self.stopped:
+                    return
+                pdf_path, use_native, requested = self.pending.pop(0)
+            try:
+                with instrumentation.profile_thread():
+                    results = self.compare(pdf_path, use_native)
+            except Exception as e:
+                print(f"Error comparing {pdf_path}: {e}")
+                if requested:
+                    self.queue.put(('error', pdf_path, e))
+                continue
+            if requested:
+                self.queue.put(('result', pdf_path, results))
@@ -0,0 +1,117 @@
+# This module contains all code related to the part index of the technology protocols
+import os
+import sqlite3
+import threading
+from protocol_parser import parse_protocol
+
+class ProtocolIndex:
+    """This class implements an on-disk index of the technology protocols (.doc) in the TAF directory: part -> programs with the nested quantity of the part in each.
+    The protocols are a few KB each, so keeping the index current is much cheaper than reading the PDFs or TMT programs. Each protocol is only read again when its modification time or size changes.
+    It can also be kept current by a DirectoryWatcher (see apply_events), so the database is only used while holding the index lock."""
+    def __init__(self, directory, db_path):
+        """Passes the directory with the protocols (the TAF directory) and the path of the index database to the class and creates the tables if they don't exist."""
+        self.directory = directory
+        self.db_path = db_path
+        self.connection = sqlite3.connect(db_path, check_same_thread=False)
+        self.lock = threading.RLock() # The watcher thread updates the index while searches read it
+
+        # files holds the stat signature and sheet counts of every indexed protocol, parts holds one row per part with its total quantity
+        self.connection.executescript("""
+            CREATE TABLE IF NOT EXISTS files (directory TEXT, name TEXT, mtime_ns INTEGER, size INTEGER, taf_path TEXT, nested INTEGER, produced INTEGER, blocked INTEGER, complete INTEGER, PRIMARY KEY (directory, name));
+            CREATE TABLE IF NOT EXISTS parts (directory TEXT, name TEXT, part TEXT, part_lower TEXT, base_lower TEXT, quantity INTEGER);
+            CREATE INDEX IF NOT EXISTS parts_part ON parts (directory, part_lower);
+            CREATE INDEX IF NOT EXISTS parts_base ON parts (directory, base_lower);
+            CREATE INDEX IF NOT EXISTS parts_name ON parts (directory, name);
+        """)
+        self.connection.commit()
+
+    def close(self):
+        """Close the connection to the index database."""
+        self.connection.close()
+
+    @staticmethod
+    def is_protocol(name):
+        """Returns True for technology protocol file names."""
+        return name.lower().endswith('.doc')
+
+    def index_file(self, name, stat_result=None):
+        """Reindexes a single protocol. The stat result can be passed in if it is already known (from os.scandir)."""
+        file_path = os.path.join(self.directory, name)
+        try:
+            if stat_result is None:
+                stat_result = os.stat(file_path)
+            protocol = parse_protocol(file_path)
+        except FileNotFoundError:
+            self.remove_file(name)
+            return
+        rows = [(self.directory, name, part, part.lower(), part.rsplit('_', 1)[0].lower(), quantity) for part, quantity in protocol.get_quantities().items()]
+
+        # Replace the previous entries for the file
+        with self.lock, self.connection:
+            self.connection.execute("DELETE FROM parts WHERE directory = ? AND name = ?", (self.directory, name))
+            self.connection.executemany("INSERT INTO parts VALUES (?, ?, ?, ?, ?, ?)", rows)
+            self.connection.execute("INSERT OR REPLACE INTO files VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                                    (self.directory, name, stat_result.st_mtime_ns, stat_result.st_size, protocol.taf_path, protocol.nested, protocol.produced, protocol.blocked, int(protocol.complete)))
+
+    def remove_file(self, name):
+        """Removes a protocol from the index."""
+        with self.lock, self.connection:
+            self.connection.execute("DELETE FROM parts WHERE directory = ? AND name = ?", (self.directory, name))
+            self.connection.execute("DELETE FROM files WHERE directory = ? AND name = ?", (self.directory, name))
+
+    def apply_events(self, events):
+        """Applies the (kind, name, stat_result) events of a DirectoryWatcher watching the protocol directory: added and modified protocols are reindexed and removed ones are dropped."""
+        for kind, name, stat_result in events:
+            if kind == 'removed':
+                self.remove_file(name)
+            else:
+                self.index_file(name, stat_result)
+
+    def refresh(self):
+        """Brings the index up to date with the directory. Only protocols with a changed modification time or size are read. Returns the number of protocols that were read."""
+        with self.lock:
+            indexed = {name: (mtime_ns, size) for name, mtime_ns, size in
+                       self.connection.execute("SELECT name, mtime_ns, size FROM files WHERE directory = ?", (self.directory,))}
+        read = 0
+        with os.scandir(self.directory) as entries:
+            for entry in entries:
+                if not self.is_protocol(entry.name) or not entry.is_file():
+                    continue
+                stat_result = entry.stat()
+                if indexed.pop(entry.name, None) != (stat_result.st_mtime_ns, stat_result.st_size):
+                    self.index_file(entry.name, stat_result) # New or changed protocol
+                    read += 1
+
+        # Anything left over was deleted from the directory
+        for name in indexed:
+            self.remove_file(name)
+        return read
+
+    def find_programs(self, part):
+        """Returns a list of (program, part, quantity) for every program that nests the part, sorted by program. part can be given with a revision (only that revision matches)
+        or without one (every revision matches). program is the protocol name without the extension, which is the name of its TAF."""
+        part = part.replace(" ", "").lower()
+        with self.lock:
+            rows = self.connection.execute("SELECT name, part, quantity FROM parts WHERE directory = ? AND (part_lower = ? OR base_lower = ?) ORDER BY name, part",
+                                           (self.directory, part, part)).fetchall()
+        return [(os.path.splitext(name)[0], part_name, quantity) for name, part_name, quantity in rows]
+
+    def search(self, search_string):
+        """Returns a list of (program, part, quantity) for every part containing the search string (case insensitive, whitespace ignored), sorted by program."""
+        search = ''.join(search_string.split()).lower()
+        escaped = search.replace('\\', '\\\\').replace('%', '\\%').replace('_', '\\_') # Escape the LIKE wildcards
+        with self.lock:
+            rows = self.connection.execute("SELECT name, part, quantity FROM parts WHERE directory = ? AND part_lower LIKE ? ESCAPE '\\' ORDER BY name, part",
+                                           (self.directory, '%' + escaped + '%')).fetchall()
+        return [(os.path.splitext(name)[0], part_name, quantity) for name, part_name, quantity in rows]
+
+    def get_program(self, program):
+        """Returns (counts, quantities) for a program (TAF or protocol name), where counts is (nested, produced, blocked) and quantities is a dictionary of part -> nested quantity.
+        Returns None if the program has no indexed protocol or its part names were cut off in the protocol."""
+        doc_name = os.path.splitext(os.path.basename(program))[0].lower() + '.doc'
+        with self.lock:
+            row = self.connection.execute("SELECT name, nested, produced, blocked FROM files WHERE directory = ? AND lower(name) = ? AND complete = 1", (self.directory, doc_name)).fetchone()
+            if row is None:
+                return None
+            rows = self.connection.execute("SELECT part, quantity FROM parts WHERE directory = ? AND name = ?", (self.directory, row[0])).fetchall()
+        return tuple(row[1:]), dict(rows)
@@ -0,0 +1,85 @@
+# This module contains all code related to reading the TruTops technology protocols (.doc) written next to the TAFs
+import os
+import re
+
+COUNTS_PATTERN = re.compile(r"nested\s*:\s*(\d+)\s+produced\s*:\s*(\d+)\s+blocked\s*:\s*(\d+)")
+
+class TechProtocol:
+    """This class holds what the comparison and search need from a technology protocol: the TAF path, the nested/produced/blocked counts of the sheet and every GEO path
+    of the "Part name | Number" table with its nested quantity. Long GEO paths are cut off at the front by TruTops ("...rkfiles\\GEO\\PART_01.GEO"), so complete is False
+    if a part name itself was cut off and the protocol can't be used as a part list."""
+    def __init__(self, file_path):
+        """Creates an empty protocol for the .doc file at file_path."""
+        self.file_path = file_path
+        self.taf_path = None # Path under "File name"
+        self.nested = None
+        self.produced = None
+        self.blocked = None
+        self.parts = [] # (geo_path, quantity) for every GEO in the table, in file order (a GEO can be listed more than once)
+        self.complete = True
+
+    @staticmethod
+    def get_part_name(geo_path):
+        """Returns the part name (GEO name without the folders, extension or whitespace) in the same format as TmtProgram.get_parts."""
+        return re.sub(r'\s+', '', re.split(r"[\\/]", geo_path)[-1].rsplit('.', 1)[0])
+
+    def get_parts(self):
+        """Returns the part names in the same format PdfSearcher.search_pdf returns them with all_parts."""
+        return [self.get_part_name(geo_path) for geo_path, _ in self.parts]
+
+    def get_quantities(self):
+        """Returns a dictionary of part name -> total nested quantity (parts listed more than once are added up)."""
+        quantities = {}
+        for geo_path, quantity in self.parts:
+            part = self.get_part_name(geo_path)
+            quantities[part] = quantities.get(part, 0) + quantity
+        return quantities
+
+def parse_protocol(file_path):
+    """Reads a technology protocol line by line and returns a TechProtocol. Reading stops at the end of the part table (#~1END) because the rest of the protocol
+    (machining, contours and collisions) has no part names."""
+    protocol = TechProtocol(file_path)
+    section = None # Heading of the section being read
+    in_table = False
+
+    # The protocols are written by TruTops on Windows so latin-1 is used to read every byte without errors
+    with open(file_path, 'r', encoding='latin-1') as file:
+        previous = ''
+        for line in file:
+            line = line.rstrip('\r\n')
+            stripped = line.strip()
+            cells = line.split('|') # Table rows are "name | number || coupling"
+            name = cells[0].strip()
+
+            # A heading is a line underlined with =====
+            if stripped and set(stripped) == {'='}:
+                section = previous
+            elif in_table:
+                if name == '#~1END':
+                    break
+                if len(cells) > 1 and name.upper().endswith('.GEO'):
+                    if name.startswith('...') and not re.search(r"[\\/]", name):
+                        protocol.complete = False # The part name itself was cut off
+                    try:
+                        quantity = int(cells[1])
+                    except ValueError:
+                        quantity = 0
+                    protocol.parts.append((name, quantity))
+            elif name == '#~1':
+                in_table = True
+            elif section == 'File name' and protocol.taf_path is None and stripped:
+                protocol.taf_path = stripped
+            elif protocol.nested is None:
+                counts = COUNTS_PATTERN.search(line)
+                if counts:
+                    protocol.nested, protocol.produced, protocol.blocked = (int(count) for count in counts.groups())
+            previous = stripped
+    return protocol
+
+def find_protocol(directory, name):
+    """Returns the path of the technology protocol of a TAF or program (the .doc with the same name in directory), or None if there isn't one."""
+    base_path = os.path.join(directory, os.path.splitext(os.path.basename(name))[0])
+    for extension in ('.doc', '.DOC', '.Doc'):
+        if os.path.isfile(base_path + extension):
+            return base_path + extension
+    return None
@@ -0,0 +1,140 @@
+# This module contains all code related to the persistent part to TAF index
+import os
+import re
+import sqlite3
+import threading
+from instrumentation import instrumentation
+
+class TafIndex:
+    """This class implements an on-disk index of the GEO references in every TAF file of a directory. Each TAF is only read again when its modification time or size changes,
+    so a revision update only has to open the TAF files that actually reference the requested part. The index is stored in an SQLite database (normally in the LaserAssistant app directory).
+    It can also be kept current by a DirectoryWatcher (see apply_events), so the database is only used while holding the index lock."""
+    def __init__(self, taf_dir, db_path):
+        """Passes the TAF directory and the path of the index database to the class and creates the tables if they don't exist."""
+        self.taf_dir = taf_dir
+        self.db_path = db_path
+        self.connection = sqlite3.connect(db_path, check_same_thread=False)
+        self.lock = threading.RLock() # The watcher thread updates the index while updates read it
+
+        # files holds the stat signature of every indexed TAF, refs holds one row per line that references a GEO file
+        self.connection.executescript("""
+            CREATE TABLE IF NOT EXISTS files (directory TEXT, name TEXT, mtime_ns INTEGER, size INTEGER, PRIMARY KEY (directory, name));
+            CREATE TABLE IF NOT EXISTS refs (directory TEXT, name TEXT, part TEXT, line_no INTEGER, offset INTEGER, line TEXT);
+            CREATE INDEX IF NOT EXISTS refs_part ON refs (directory, part);
+            CREATE INDEX IF NOT EXISTS refs_name ON refs (directory, name);
+        """)
+        self.connection.commit()
+
+    def close(self):
+        """Close the connection to the index database."""
+        self.connection.close()
+
+    @staticmethod
+    def get_base_part(line):
+        """Returns the lowercase part number (everything before the last underscore of the GEO name) referenced by a GEO path line."""
+        geo_name = re.split(r"[\\/]", line.strip())[-1] # Remove the folders from the path
+        geo_stem = geo_name.rsplit('.', 1)[0] # Remove the extension
+        return geo_stem.rsplit('_', 1)[0].replace(" ", "").lower()
+
+    def scan_file(self, file_path):
+        """Reads a TAF file and returns a list of (part, line_no, offset, line) tuples for every line that references a GEO file."""
+        refs = []
+        offset = 0
+        with open(file_path, 'rb') as file:
+            for line_no, raw_line in enumerate(file, 1):
+                if b'.GEO' in raw_line:
+                    line = raw_line.decode('latin-1').rstrip('\r\n') # latin-1 maps every byte so the line can always be decoded
+                    refs.append((self.get_base_part(line), line_no, offset, line))
+                offset += len(raw_line)
+        return refs
+
+    def index_file(self, taf_name, stat_result=None, commit=True):
+        """Reindexes a single TAF file. The stat result can be passed in if it is already known (from os.scandir). Without commit the caller commits (see refresh)."""
+        file_path = os.path.join(self.taf_dir, taf_name)
+        try:
+            if stat_result is None:
+                stat_result = os.stat(file_path)
+            with instrumentation.span('index.taf_read'):
+                refs = self.scan_file(file_path)
+            instrumentation.count('index.tafs_read')
+        except FileNotFoundError:
+            self.remove_file(taf_name, commit)
+            return
+
+        # Replace the previous entries for the file
+        with self.lock:
+            self.connection.execute("DELETE FROM refs WHERE directory = ? AND name = ?", (self.taf_dir, taf_name))
+            self.connection.executemany("INSERT INTO refs VALUES (?, ?, ?, ?, ?, ?)", [(self.taf_dir, taf_name, *ref) for ref in refs])
+            self.connection.execute("INSERT OR REPLACE INTO files VALUES (?, ?, ?, ?)", (self.taf_dir, taf_name, stat_result.st_mtime_ns, stat_result.st_size))
+            if commit:
+                self.connection.commit()
+
+    def remove_file(self, taf_name, commit=True):
+        """Removes a TAF file from the index. Without commit the caller commits (see refresh)."""
+        with self.lock:
+            self.connection.execute("DELETE FROM refs WHERE directory = ? AND name = ?", (self.taf_dir, taf_name))
+            self.connection.execute("DELETE FROM files WHERE directory = ? AND name = ?", (self.taf_dir, taf_name))
+            if commit:
+                self.connection.commit()
+
+    def apply_events(self, events):
+        """Applies the (kind, name, stat_result) events of a DirectoryWatcher watching the TAF directory: added and modified TAFs are reindexed and removed TAFs are dropped."""
+        for kind, taf_name, stat_result in events:
+            if kind == 'removed':
+                self.remove_file(taf_name)
+            else:
+                self.index_file(taf_name, stat_result)
+
+    def refresh(self):
+        """Brings the index up to date with the TAF directory. Only TAFs with a changed modification time or size are read and all their changes are committed in one transaction
+        (a commit per TAF made the first build of a large directory very slow). Returns the list of TAF files in the directory."""
+        with self.lock:
+            indexed = {name: (mtime_ns, size) for name, mtime_ns, size in
+                       self.connection.execute("SELECT name, mtime_ns, size FROM files WHERE directory = ?", (self.taf_dir,))}
+        taf_list = []
+
+        # os.scandir returns the file stats with the listing on Windows so checking the signature doesn't need an extra request per file
+        try:
+            with os.scandir(self.taf_dir) as entries:
+                for entry in entries:
+                    if not entry.name.lower().endswith('.taf') or not entry.is_file():
+                        continue
+                    taf_list.append(entry.name)
+                    stat_result = entry.stat()
+                    if indexed.pop(entry.name, None) != (stat_result.st_mtime_ns, stat_result.st_size):
+                        self.index_file(entry.name, stat_result, commit=False) # New or changed TAF
+
+            # Anything left over was deleted from the directory
+            for taf_name in indexed:
+                self.remove_file(taf_name, commit=False)
+        finally:
+            with self.lock:
+                self.connection.commit() # Keep what was indexed even if the listing failed part way
+        return taf_list
+
+    def find_tafs(self, part_nums, geo_pattern, refresh=True):
+        """Returns the sorted list of TAF files with a line matching the geo_pattern. The part numbers (or part number) are looked up in the indexed part column,
+        so only the lines referencing one of them are read from the database and checked with the regex.
+        With refresh the index is brought up to date first. Pass False when a DirectoryWatcher already keeps it current."""
+        if refresh:
+            self.refresh()
+        if isinstance(part_nums, str):
+            part_nums = [part_nums]
+        pattern = re.compile(geo_pattern)
+        taf_names = set()
+
+        # Look the part numbers up in groups to stay under the SQLite variable limit. The parts are stored like get_base_part returns them.
+        parts = sorted({part_num.replace(" ", "").lower() for part_num in part_nums})
+        for start in range(0, len(parts), 500):
+            group = parts[start:start + 500]
+            with self.lock, instrumentation.span('index.query'):
+                rows = self.connection.execute(f"SELECT name, line FROM refs WHERE directory = ? AND part IN ({', '.join('?' * len(group))})", (self.taf_dir, *group)).fetchall()
+            taf_names.update(name for name, line in rows if pattern.search(line))
+        return sorted(taf_names)
+
+    def lookup_part(self, part_num):
+        """Returns a list of (taf_name, line_no, offset) tuples for every reference to the part number (without revision)."""
+        self.refresh()
+        part = part_num.replace(" ", "").lower()
+        with self.lock:
+            return self.connection.execute("SELECT name, line_no, offset FROM refs WHERE directory = ? AND part = ? ORDER BY name, line_no", (self.taf_dir, part)).fetchall()
@@ -0,0 +1,191 @@
+# This module contains the in-memory model of a TAF (TruTops nest) file
+import os
+import re
+import mmap
+
+class TafSheet:
+    """Sheet header of a TAF (the #~TAFEL_NEU block) and the TAF path from the #~4 block."""
+    __slots__ = ('length', 'width', 'material', 'thickness', 'sheet_name', 'taf_path')
+
+    def __init__(self, length=None, width=None, material=None, thickness=None, sheet_name=None, taf_path=None):
+        self.length = length
+        self.width = width
+        self.material = material
+        self.thickness = thickness
+        self.sheet_name = sheet_name
+        self.taf_path = taf_path
+
+class TafPlacement:
+    """One placement of a part on the sheet: bounding box (x_min, y_min, x_max, y_max), flag and the 4x4 transform matrix (16 floats, row by row)."""
+    __slots__ = ('bbox', 'flag', 'matrix')
+
+    def __init__(self, bbox, flag, matrix):
+        self.bbox = bbox
+        self.flag = flag
+        self.matrix = matrix
+
+class TafPart:
+    """One part record (#~2 block) of a TAF. line_no is the line of the GEO path in the file."""
+    __slots__ = ('geo_path', 'index', 'flag', 'count', 'placements', 'line_no')
+
+    def __init__(self, geo_path, line_no):
+        self.geo_path = geo_path
+        self.line_no = line_no
+        self.index = None
+        self.flag = None
+        self.count = None
+        self.placements = []
+
+    @property
+    def file_name(self):
+        """GEO file name without the folders."""
+        return re.split(r"[\\/]", self.geo_path)[-1]
+
+    @property
+    def part_name(self):
+        """GEO file name without the folders or extension (part number and revision)."""
+        return self.file_name.rsplit('.', 1)[0]
+
+class TafFile:
+    """Parsed TAF file. It is only read, updates don't go through the model but patch the GEO revisions in the raw bytes (see find_geo_revisions and splice_revisions)."""
+    __slots__ = ('file_path', 'sheet', 'parts')
+
+    def __init__(self, file_path):
+        self.file_path = file_path
+        self.sheet = TafSheet()
+        self.parts = []
+
+    def get_parts(self):
+        """Returns the part names (GEO file name without extension) of every part record, in file order."""
+        return [part.part_name for part in self.parts]
+
+def parse_float_line(line):
+    """Returns the floats on a line of a TAF block."""
+    return tuple(float(value) for value in line.split())
+
+def parse_int(value):
+    """Returns the integer on a line of a TAF block, or None if it isn't one."""
+    try:
+        return int(value)
+    except ValueError:
+        return None
+
+def parse_placement(lines):
+    """Builds a TafPlacement from the lines between two ##~~ markers. Returns None if the record doesn't have the expected layout."""
+    try:
+        bbox = parse_float_line(lines[0]) + parse_float_line(lines[1])
+        matrix = sum((parse_float_line(line) for line in lines[3:7]), ())
+        return TafPlacement(bbox, int(lines[2]), matrix)
+    except (ValueError, IndexError):
+        return None
+
+def parse_taf_data(file_path, data):
+    """Parses the contents of a TAF into a TafFile. The blocks (#~N ... #~END) are read once, line by line."""
+    taf = TafFile(file_path)
+    block = None # Name of the block being read (the text after #~)
+    block_lines = [] # Lines of the block (or of the placement being read in a #~2 block)
+    part = None
+    position = 0
+    line_no = 0
+    size = len(data)
+
+    while position < size:
+        newline = data.find(b'\n', position)
+        end = size if newline == -1 else newline
+        next_position = end + 1
+        if end > position and data[end - 1:end] == b'\r':
+            end -= 1 # CRLF files
+        line = data[position:end].decode('latin-1')
+        line_no += 1
+
+        if line.startswith('#~') and not line.startswith('##~~'):
+            if line == '#~END':
+                if block == 'TAFEL_NEU':
+                    sheet_header(taf.sheet, block_lines)
+                elif block == '4' and len(block_lines) > 1:
+                    taf.sheet.taf_path = block_lines[1].strip()
+                block, part = None, None
+            elif block is None:
+                block = line[2:]
+            block_lines = []
+        elif block == '2':
+            if part is None:
+                # First line of a part record is the GEO path
+                part = TafPart(line.rstrip(), line_no)
+                taf.parts.append(part)
+            elif part.count is None:
+                # The GEO path is followed by the index, a flag and the number of placements
+                block_lines.append(line)
+                if len(block_lines) == 3:
+                    part.index, part.flag, part.count = (parse_int(value) for value in block_lines)
+                    if part.count is None:
+                        part.count = 0 # Keeps the following lines from being read as the header
+                    block_lines = []
+            elif line == '##~~':
+                placement = parse_placement(block_lines)
+                if placement is not None:
+                    part.placements.append(placement)
+                block_lines = []
+            else:
+                block_lines.append(line)
+        elif block is not None:
+            block_lines.append(line)
+        position = next_position
+    return taf
+
+def sheet_header(sheet, lines):
+    """Fills the sheet from the lines of the #~TAFEL_NEU block (count, length, width, blank line, material, thickness, another value, sheet name, ...)."""
+    values = [line.strip() for line in lines]
+    try:
+        sheet.length = float(values[1])
+        sheet.width = float(values[2])
+        sheet.material = values[4]
+        sheet.thickness = float(values[5])
+        sheet.sheet_name = values[7]
+    except (ValueError, IndexError):
+        pass # Unknown header layout, the sheet fields stay None
+
+def parse_taf(file_path):
+    """Reads a TAF file and returns the parsed TafFile."""
+    with open(file_path, 'rb') as file:
+        return parse_taf_data(file_path, file.read())
+
+def find_geo_revisions(buffer, geo_pattern):
+    """Finds the GEO revisions to replace in the contents of a TAF (bytes or a memory map) without decoding or parsing it. geo_pattern is a compiled bytes regex with a "part" group
+    (FileManager.build_geo_pattern encoded with latin-1). Only the text between the last underscore of the GEO file name and the extension is a revision (underscores in the folders are never touched).
+    Returns the list of (line_no, start, end, part_num, old_revision) edits in file order, where start and end are the byte offsets of the old revision."""
+    edits = []
+    line_no, counted = 1, 0
+    for match in geo_pattern.finditer(buffer):
+        # Find the GEO file name in the matched path and the revision in it
+        dot = match.end() - 4 # Start of .GEO
+        line_start = buffer.rfind(b'\n', 0, match.start()) + 1
+        name_start = max(buffer.rfind(b'\\', line_start, dot), buffer.rfind(b'/', line_start, dot)) + 1
+        underscore = buffer.rfind(b'_', max(name_start, line_start), dot)
+        if underscore == -1:
+            continue # No revision in the GEO file name to replace
+        line_no += buffer[counted:line_start].count(b'\n')
+        counted = line_start
+        edits.append((line_no, underscore + 1, dot, match.group('part').decode('latin-1'), buffer[underscore + 1:dot].decode('latin-1')))
+    return edits
+
+def splice_revisions(buffer, edits, revisions):
+    """Returns the contents of a TAF with the revisions of the edits (see find_geo_revisions) replaced by the new revision of their part from the revisions dictionary.
+    The result is built from slices of the original buffer so everything else, line endings included, is kept exactly."""
+    chunks = []
+    position = 0
+    for _, start, end, part_num, _ in edits:
+        chunks.append(buffer[position:start])
+        chunks.append(revisions[part_num].encode('latin-1'))
+        position = end
+    chunks.append(buffer[position:])
+    return b''.join(chunks)
+
+def read_geo_revisions(file_path, geo_pattern):
+    """Memory-maps a TAF and returns (stat_result, edits) with the edits from find_geo_revisions. Nothing is copied for TAFs without a match."""
+    with open(file_path, 'rb') as file:
+        stat_result = os.fstat(file.fileno())
+        if not stat_result.st_size:
+            return stat_result, [] # Empty files can't be mapped
+        with mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ) as buffer:
+            return stat_result, find_geo_revisions(buffer, geo_pattern)
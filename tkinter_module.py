@@ -1,12 +1,24 @@
 import tkinter as tk
 from tkinter import ttk, filedialog, messagebox, scrolledtext
 from file_handling import *
-from PDF_module import PdfSearcher
-from pdf_taf_checker import ComparePdfTaf
+from PDF_module import PdfSearcher, PdfSearchJob
+from worker_pool import WorkerPool
+from pdf_index import PdfPartIndex
+from pdf_taf_checker import ComparisonWorker, classify_result
+from pdf_audit import PdfAudit
+from dir_watcher import DirectoryWatcher, ADDED, REMOVED
+from instrumentation import instrumentation
+from virtual_list import VirtualList, IncrementalFilter
+import bisect
+import queue
+import threading
 import os, sys
 from sys import exit # Using this instead of typical exit because the program is run from a pyinstaller exe
 import re
 
+FILTER_DELAY_MS = 120 # Debounce of the PDF list filter
+PREFETCH_NEIGHBOURS = 2 # PDFs above and below the selected one that are compared in the background
+
 # This function checks if an input if just a single number. If it is it adds a leading 0
 def check_for_single_number(input_number):
     if re.match(r"^\d$", input_number): # Use regex to check for single digit number
@@ -37,16 +49,60 @@ class FileUpdaterGUI:
     """This is the GUI class for the file management application. It contains the setup for the window,tabs and the methods for the GUI features."""
     def __init__(self, root):
         """Assign the initialization variables and call the setup_gui method."""
-        self.active_button = None  # Attribute to keep track of the active PDF selection button
         self.pdf_files = [] # List of PDF files to maintain order
         self.root = root
         self.root.withdraw()
+        self.worker_pool = WorkerPool() # One pool for the life of the app, reused by every search and comparison
+        self.worker_pool.start() # Spawn and prewarm the workers in the background while the config loads
         self.config_manager = ConfigManager() # Open the config.txt file with the ConfigManager class
         self.load_config()
 
-        self.file_manager = FileManager(self.taf_dir, self.geo_dir, self.backup_dir) # Create a new FileManager instance using the directories from the config
+        self.file_manager = FileManager(self.taf_dir, self.geo_dir, self.backup_dir, self.config_manager.app_dir) # Create a new FileManager instance using the directories from the config (part index is kept in the app directory)
+        self.pdf_cache_path = os.path.join(self.config_manager.app_dir, 'pdf_text_cache.db') # Extracted PDF text is cached in the app directory so repeat searches don't reopen the PDFs
+        self.pdf_index = None # Part index of the TMT PDFs, created on the first search
+        self.selected_pdf = None # Path of the PDF whose comparison is shown (or being compared)
+        self.comparison_worker = ComparisonWorker(self.file_manager, self.pdf_cache_path, self.worker_pool) # Compares the selected PDF and prefetches its neighbours off the Tk thread
+        self.comparison_worker.start()
+        
+        # Keep the GEO catalogue, TAF index and PDF list current in the background. PDF changes are queued for the Tk thread (see poll_watch_events).
+        self.pdf_events = queue.Queue()
+        self.watcher = DirectoryWatcher()
+        self.file_manager.start_watching(self.watcher)
+        self.pdf_watch = self.watcher.watch(self.tmt_dir, lambda name: name.endswith('.pdf'), self.pdf_events.put)
+        self.watcher.start()
         self.root.deiconify()
         self.setup_gui() # Call the window setup method
+        self.root.protocol("WM_DELETE_WINDOW", self.on_close) # Shut the worker pool down when the window is closed
+        self.root.after(500, self.poll_watch_events)
+        self.root.after(50, self.poll_comparisons)
+        
+    def on_close(self):
+        """Stop any running search and the directory watcher, shut down the worker pool and close the window."""
+        self.cancel_pdf_search()
+        self.comparison_worker.stop()
+        self.watcher.stop()
+        self.worker_pool.shutdown()
+        self.root.destroy()
+        
+    def poll_watch_events(self):
+        """Applies the PDF changes found by the directory watcher to the PDF list. Runs on the Tk thread every half second because Tk widgets can only be changed from it."""
+        changed = False
+        while True:
+            try:
+                events = self.pdf_events.get_nowait()
+            except queue.Empty:
+                break
+            for kind, pdf_file, _ in events:
+                if kind == REMOVED and pdf_file in self.pdf_files:
+                    self.pdf_files.remove(pdf_file)
+                    changed = True
+                elif kind == ADDED and pdf_file not in self.pdf_files:
+                    bisect.insort(self.pdf_files, pdf_file)
+                    changed = True
+        if changed:
+            self.pdf_filter.set_items(self.pdf_files)
+            self.filter_pdf_list() # Redraw the list with the current filter
+        self.root.after(500, self.poll_watch_events)
         
     def select_directory_paths(self):
         """Open a file selector window for each directory path and save the selections to config.txt."""
@@ -83,6 +139,28 @@ class FileUpdaterGUI:
             messagebox.showerror("Error", f"{error}\nProbably needs run as admin to update config file")
             exit(1)
             
+    def change_directories(self):
+        """Lets the user select new directories, then moves the file manager, the directory watches and the comparison worker to them and refreshes the PDF list."""
+        directories = (self.geo_dir, self.taf_dir, self.tmt_dir, self.backup_dir)
+        self.select_directory_paths()
+        if (self.geo_dir, self.taf_dir, self.tmt_dir, self.backup_dir) == directories:
+            return # Cancelled or nothing changed
+        
+        # Stop watching the old directories and open the file manager (with its indexes) on the new ones. stop_watching waits for a scan that is running, so no more events reach the old indexes once they are closed.
+        self.file_manager.stop_watching(self.watcher)
+        self.watcher.unwatch(self.pdf_watch)
+        self.comparison_worker.stop()
+        self.file_manager.close()
+        self.file_manager = FileManager(self.taf_dir, self.geo_dir, self.backup_dir, self.config_manager.app_dir)
+        self.file_manager.start_watching(self.watcher)
+        self.pdf_events = queue.Queue() # Drop any events of the old TMT directory
+        self.pdf_watch = self.watcher.watch(self.tmt_dir, lambda name: name.endswith('.pdf'), self.pdf_events.put)
+        self.comparison_worker = ComparisonWorker(self.file_manager, self.pdf_cache_path, self.worker_pool)
+        self.comparison_worker.start()
+        self.selected_pdf = None
+        self.results_list.set_items([])
+        self.populate_pdf_list()
+
     def load_config(self):
         """Attempt to load the configuration from the config file."""
         config_loaded = False
@@ -130,11 +208,27 @@ class FileUpdaterGUI:
         menu_bar.add_cascade(label="File", menu=file_menu)
         
         # Add "Select New Directories" option to the "File" menu
-        file_menu.add_command(label="Select New Directories", command=lambda: [self.select_directory_paths(), self.populate_pdf_list(), self.file_manager.set_backup_dir(self.backup_dir)]) # Replaces the config directories and then refreshes PDF list
+        file_menu.add_command(label="Select New Directories", command=self.change_directories) # Replaces the config directories and then refreshes PDF list
+        
+        # Add the whole-directory PDF-TAF audit to the "File" menu
+        file_menu.add_command(label="Audit All PDFs...", command=self.start_pdf_audit)
         
         # Add exit option to the "File" menu
         file_menu.add_separator()
-        file_menu.add_command(label="Exit", command=self.root.quit)
+        file_menu.add_command(label="Exit", command=self.on_close)
+        
+        # Create the "Diagnostics" menu for timing the hot paths. Collecting is off by default.
+        self.instrument_var = tk.BooleanVar(value=False)
+        self.profile_var = tk.BooleanVar(value=False)
+        diagnostics_menu = tk.Menu(menu_bar, tearoff=0)
+        menu_bar.add_cascade(label="Diagnostics", menu=diagnostics_menu)
+        diagnostics_menu.add_checkbutton(label="Collect Timings", variable=self.instrument_var, command=self.toggle_instrumentation)
+        diagnostics_menu.add_checkbutton(label="Profile with cProfile (slower)", variable=self.profile_var, command=self.toggle_instrumentation)
+        diagnostics_menu.add_command(label="Show Run Summary", command=self.show_run_summary)
+        diagnostics_menu.add_command(label="Export Timings (JSON)...", command=lambda: self.export_instrumentation('json'))
+        diagnostics_menu.add_command(label="Export Profile (pstats)...", command=lambda: self.export_instrumentation('pstats'))
+        diagnostics_menu.add_separator()
+        diagnostics_menu.add_command(label="Start New Run", command=instrumentation.reset)
 
         # Setup Notebook (Tabs)
         self.notebook = ttk.Notebook(self.root)
@@ -175,6 +269,7 @@ class FileUpdaterGUI:
         # Buttons for selecting update mode
         tk.Button(input_frame, text="Update Whole Directory", command=self.update_directory, font=("Arial", 12), width=20).grid(row=2, column=0, padx=10, pady=30)
         tk.Button(input_frame, text="Update Specific TAFs", command=self.update_specific_files, font=("Arial", 12), width=20).grid(row=2, column=1, padx=10, pady=30)
+        tk.Button(input_frame, text="Bulk Update From CSV", command=self.update_from_change_order, font=("Arial", 12), width=20).grid(row=2, column=2, padx=10, pady=30)
 
         # Output text field
         self.debug_display = scrolledtext.ScrolledText(self.tab_taf_updater, font=("Arial", 10), height=8) # Place at bottom in of screen. Will resize with the window.
@@ -184,7 +279,7 @@ class FileUpdaterGUI:
         self.tab_taf_updater.grid_rowconfigure(1, weight=1)
 
     def update_directory(self):
-        """Calls read_and_update_taf_files and prompts user with message box if GEO file doesn't exist. Updates entire TAF directory."""
+        """Plans the update of the entire TAF directory, shows the planned edits and applies them once the user confirms (see confirm_and_apply_plan)."""
         
         # Get the input from the fields
         part_number = self.part_number_entry.get()
@@ -196,23 +291,10 @@ class FileUpdaterGUI:
         
         # Allowing blank revisions to be entered. Won't hurt anything and might be useful?
         new_revision = check_for_single_number(self.new_revision_entry.get())
-        
-        # Call the read_and_update_taf_files method with the input. Status will return True if the GEO doesn't exist.
-        status, updated_files = self.file_manager.read_and_update_taf_files(part_number, new_revision, None)
-        
-        # Prompt the user with a message box if the GEO doesn't exist
-        if status:
-            if messagebox.askyesno("Confirm Update", "The GEO does not exist. Are you sure you want to update?"):
-                _, updated_files = self.file_manager.read_and_update_taf_files(part_number, new_revision, None, None, True)
-                messagebox.showinfo("Finished", "Successfully updated directory!")
-        else:
-            messagebox.showinfo("Finished", "Successfully updated directory!")
-        
-        # Display updated files in the output display
-        self.display_updated_files(updated_files)
+        self.confirm_and_apply_plan({part_number: new_revision})
 
     def update_specific_files(self):
-        """Calls read_and_update_taf_files and prompts user with message box if GEO file doesn't exist. Updates specific TAF files."""
+        """Plans the update of the selected TAF files, shows the planned edits and applies them once the user confirms. The updated files are saved to TAF_Temp."""
         
         # Get the input from the fields
         part_number = self.part_number_entry.get()
@@ -222,20 +304,66 @@ class FileUpdaterGUI:
         files = filedialog.askopenfilenames(title="Select TAF files", initialdir=self.taf_dir, filetypes=(("TAF files", "*.taf"), ("All files", "*.*")))
 
         if files:  # Proceed only if files were selected
+            self.confirm_and_apply_plan({part_number: new_revision}, files, "TAF_Temp")
             
-            # Call the read_and_update_taf_files method with the input. Status will return True if the GEO doesn't exist. Files passed in as a list.
-            status, updated_files = self.file_manager.read_and_update_taf_files(part_number, new_revision, files, "TAF_Temp")
-            
-            # Prompt the user with a message box if the GEO doesn't exist
-            if status:
-                if messagebox.askyesno("Confirm Update", "The GEO does not exist. Are you sure you want to update?"):
-                    _, updated_files = self.file_manager.read_and_update_taf_files(part_number, new_revision, files, "TAF_Temp", True)
-                    messagebox.showinfo("Finished", "Successfully updated directory!")
-                else:
-                    messagebox.showinfo("Finished", "Successfully updated directory!")
-            
-            # Display updated files in the output display
-            self.display_updated_files(updated_files)
+    def update_from_change_order(self):
+        """Loads a change order CSV (part number, new revision) and updates every part in one pass over the TAF directory."""
+        
+        # Get the change order from a file ask window
+        csv_path = filedialog.askopenfilename(title="Select change order", filetypes=(("CSV files", "*.csv"), ("All files", "*.*")))
+        if not csv_path:
+            return
+        try:
+            revisions = load_revision_list(csv_path)
+        except (OSError, UnicodeDecodeError) as error:
+            messagebox.showerror("Error", f"Could not read the change order:\n{error}")
+            return
+        if not revisions:
+            messagebox.showwarning("Warning", "No part revisions were found in the change order.")
+            return
+        self.confirm_and_apply_plan(revisions)
+
+    def confirm_and_apply_plan(self, revisions, taf_files=None, save_dir=None):
+        """Runs a dry run of the update (one scan, nothing is changed), lists the planned edits in the output display and asks the user to confirm.
+        Missing GEOs are part of the same confirmation. The confirmed plan is applied as it is, without scanning the TAFs again."""
+        try:
+            plan = self.file_manager.plan_taf_updates(revisions, taf_files)
+        except FileNotFoundError as error:
+            messagebox.showerror("Error", f"TAF file not found:\n{error}")
+            return
+        self.display_update_plan(plan)
+        
+        # Check there is something to update
+        edits = plan.get_edits()
+        if not edits:
+            messagebox.showinfo("Finished", "No TAF files reference the part numbers. Nothing was updated.")
+            return
+        
+        # Ask the user to confirm the plan. Missing GEOs are listed first.
+        message = f"{len(edits)} GEO revisions in {len(plan.tafs)} TAF files will be updated (listed below the buttons)."
+        if plan.missing_geos:
+            missing_text = "\n".join(f"{part_num}_{revisions[part_num]}.GEO" for part_num in plan.missing_geos[:20])
+            if len(plan.missing_geos) > 20:
+                missing_text += f"\n... and {len(plan.missing_geos) - 20} more"
+            message = f"The following GEOs do not exist:\n{missing_text}\n\n{message}"
+        if not messagebox.askyesno("Confirm Update", f"{message}\n\nAre you sure you want to update?"):
+            return
+        try:
+            updated_files = self.file_manager.apply_update_plan(plan, save_dir)
+        except OSError as error:
+            # For example a TAF was deleted or locked since the plan was made. A failed staging is undone straight away and an interrupted commit is finished on the next start.
+            messagebox.showerror("Error", f"The update failed:\n{error}")
+            return
+        messagebox.showinfo("Finished", f"Successfully updated {len(plan.tafs)} TAF files!")
+        
+        # Display updated files in the output display
+        self.display_updated_files(updated_files)
+
+    def display_update_plan(self, plan):
+        """Display the planned edits of a dry run (TAF, line, part, old and new revision) in the output display."""
+        self.debug_display.delete(1.0, tk.END)  # Clear display first
+        for taf_file, line_no, part_num, old_revision, new_revision in plan.get_edits():
+            self.debug_display.insert(tk.END, f"Planned: {taf_file} (line {line_no}) - Part: {part_num}, Old Ver: {old_revision}, New Ver: {new_revision}\n")
             
     def display_updated_files(self, updated_files):
         """Display updated files in the output display. If no files were updated, display a message."""
@@ -257,29 +385,86 @@ class FileUpdaterGUI:
         self.search_string_entry = tk.Entry(self.tab_tmt_checker, font=("Arial", 12))
         self.search_string_entry.pack(pady=10)
         
-        # Create the search button
-        tk.Button(self.tab_tmt_checker, text="Search PDFs", command=self.start_pdf_search, font=("Arial", 12)).pack(pady=10)
+        # Create the search and cancel buttons side by side
+        button_frame = tk.Frame(self.tab_tmt_checker)
+        button_frame.pack(pady=10)
+        tk.Button(button_frame, text="Search PDFs", command=self.start_pdf_search, font=("Arial", 12)).pack(side="left", padx=5)
+        self.cancel_search_button = tk.Button(button_frame, text="Cancel", command=self.cancel_pdf_search, font=("Arial", 12), state="disabled")
+        self.cancel_search_button.pack(side="left", padx=5)
+        
+        # Progress of the running search (PDFs done / total)
+        self.search_progress = tk.Label(self.tab_tmt_checker, text="", font=("Arial", 10))
+        self.search_progress.pack()
         
         # Create the output display
         self.search_results = scrolledtext.ScrolledText(self.tab_tmt_checker, font=("Arial", 12), height=10)
         self.search_results.pack(fill=tk.BOTH, expand=True, padx=10, pady=10)
+        self.search_job = None # The running background search
 
     def start_pdf_search(self):
-        """Searches through the PDF files in the TMT directory for the search string provided by the user."""
+        """Searches through the PDF files in the TMT directory for the search string provided by the user. The search runs in the background and results are shown as they are found."""
         
         # Get the search string from the input field
         search_string = self.search_string_entry.get()
         
         # Check string actually exists
         if search_string:
+            self.cancel_pdf_search() # A new search replaces the one that is running
             self.search_results.delete(1.0, tk.END) # Clear output field
-            searcher = PdfSearcher(search_string, self.tmt_dir)  # Use the directory from config manager. Has to be created each time because of the multi-cored search
-            searcher.search_in_directory(self.update_search_results) # Call search in directory with callback to update the output field. This is done using multiprocessing (multicore) to speed up the search.
+            
+            # The technology protocols are indexed, so the programs (with the nested quantities) are shown straight away while the PDFs are searched
+            for program, part, quantity in self.file_manager.find_protocol_parts(search_string):
+                self.search_results.insert(tk.END, f"Protocol {program}: {part} x {quantity}\n")
+            searcher = PdfSearcher(search_string, self.tmt_dir, self.pdf_cache_path)  # Use the directory from config manager. The search itself runs in the app's worker pool.
+            
+            # (Re)open the part index if the TMT directory has changed
+            if self.pdf_index is None or self.pdf_index.directory != self.tmt_dir:
+                self.pdf_index = PdfPartIndex(self.tmt_dir, os.path.join(self.config_manager.app_dir, 'pdf_part_index.db'), self.pdf_cache_path)
+            
+            # Start the search on a background thread. Unchanged PDFs are answered from the index and new or changed PDFs are read using multiprocessing (multicore).
+            self.search_job = PdfSearchJob(searcher, self.pdf_index, self.worker_pool)
+            self.search_job.start()
+            self.search_total = 0
+            self.search_matches = 0
+            self.search_progress.config(text="Searching...")
+            self.cancel_search_button.config(state="normal")
+            self.root.after(50, self.poll_search_job, self.search_job)
         else:
             messagebox.showwarning("Warning", "Please provide a search string.")
             
+    def cancel_pdf_search(self):
+        """Cancel the running search (if there is one)."""
+        if self.search_job is not None:
+            self.search_job.cancel()
+            self.search_job = None
+            self.cancel_search_button.config(state="disabled")
+            self.search_progress.config(text=f"Search cancelled. {self.search_matches} matches found.")
+            
+    def poll_search_job(self, job):
+        """Move the messages from the search job's queue into the display. Reschedules itself until the job is finished or replaced by a new search."""
+        if job is not self.search_job:
+            return # This search was cancelled or replaced
+        while not job.queue.empty():
+            message, value = job.queue.get_nowait()
+            if message == 'total':
+                self.search_total = value
+            elif message == 'result':
+                self.search_matches += 1
+                self.update_search_results(value)
+            elif message == 'progress':
+                self.search_progress.config(text=f"Searched {value}/{self.search_total} PDFs, {self.search_matches} matches")
+            elif message == 'stats':
+                for line in value.summary():
+                    print(line) # Per-worker throughput for tuning the search
+            else:
+                self.search_progress.config(text=f"Search finished. {self.search_matches} matches in {self.search_total} PDFs.")
+                self.cancel_search_button.config(state="disabled")
+                self.search_job = None
+                return
+        self.root.after(50, self.poll_search_job, job)
+            
     def update_search_results(self, result):
-        """Add result to search results display. This is a callback function for the search_in_directory method."""
+        """Add result to search results display. This is called for every match the search job finds."""
         self.search_results.insert(tk.END, f"Match found in file: {result}\n") # Insert onto end of display
         self.search_results.yview(tk.END)
         
@@ -313,10 +498,7 @@ class FileUpdaterGUI:
         self.side_text.configure(wraplength=self.right_frame.winfo_width())
 
     def setup_scrollable_pdf_list(self):
-        """Creates the PDF selection canvas"""
-        # Create a canvas within the left_frame with a fixed width of 300 pixels
-        self.pdf_list_canvas = tk.Canvas(self.left_frame, width=300)
-        self.pdf_list_scrollbar = ttk.Scrollbar(self.left_frame, orient="vertical", command=self.pdf_list_canvas.yview) # Add scrollbar to the canvas
+        """Creates the PDF selection list"""
         pdf_text = tk.Label(self.left_frame, text="Select PDF File:                                     Results:", font=("Arial", 14, "bold"), pady=5) # Top labels
         pdf_text.pack(side="top", anchor="w") # Labels are placed at top left
         
@@ -330,45 +512,34 @@ class FileUpdaterGUI:
         search_label.pack(side="top", padx=10, pady=5)
         self.search_entry = tk.Entry(search_container, font=("Arial", 12))
         self.search_entry.pack(fill="x", expand=True)
-        self.search_entry.bind("<KeyRelease>", lambda event: self.filter_pdf_list()) # After every keystroke filter the PDF list
+        self.search_entry.bind("<KeyRelease>", lambda event: self.schedule_pdf_filter()) # Filter the PDF list once the user pauses typing
+        self.pdf_filter = IncrementalFilter(self.pdf_files)
+        self.pdf_filter_after = None # Pending filter of the debounce
         
-        # Configure the canvas to use the scrollbar
-        self.pdf_list_canvas.configure(yscrollcommand=self.pdf_list_scrollbar.set)
+        # Option to read the parts straight from the technology protocol or TMT program with the same name instead of extracting the PDF text
+        self.use_native_parts = tk.BooleanVar(value=False) # Off by default, so the parts are read from the PDF unless the user opts in
+        tk.Checkbutton(self.left_frame, text="Read parts from protocol/TMT when available", variable=self.use_native_parts, font=("Arial", 10)).pack(side="top", padx=10, anchor="w")
         
-        # Pack the canvas and the scrollbar closely together
-        self.pdf_list_canvas.pack(side="left", fill="y", expand=False)
-        self.pdf_list_scrollbar.pack(side="left", fill="y") 
-        
-        # Create an inner frame to hold the PDF buttons
-        self.pdf_list_frame = ttk.Frame(self.pdf_list_canvas)
-        self.pdf_list_canvas.create_window((0, 0), window=self.pdf_list_frame, anchor="nw", width=300)  # Set width of the window
-        
-        # Update the canvas' scroll region when the inner frame changes size
-        self.pdf_list_frame.bind("<Configure>", lambda e: self.pdf_list_canvas.configure(scrollregion=self.pdf_list_canvas.bbox("all")))
+        # The list only draws the visible PDFs, so a TMT directory with thousands of programs scrolls and filters as fast as a small one
+        self.pdf_list = VirtualList(self.left_frame, lambda pdf_file: ("gray90", "black", pdf_file), self.select_pdf, width=300, pady=4)
+        self.pdf_list.pack(fill="y", expand=False)
+        self.pdf_list_canvas = self.pdf_list.canvas
 
         # Thanks to Mikhail T. at https://stackoverflow.com/questions/17355902/tkinter-binding-mousewheel-to-scrollbar for this solution to bind to the current active widget for scrolling!
-        self.pdf_list_frame.bind('<Enter>', lambda event, canvas=self.pdf_list_canvas: self.bound_to_mousewheel(event, canvas))
-        self.pdf_list_frame.bind('<Leave>', lambda event, canvas=self.pdf_list_canvas: self.unbound_to_mousewheel(event, canvas))
+        self.pdf_list_canvas.bind('<Enter>', lambda event, canvas=self.pdf_list_canvas: self.bound_to_mousewheel(event, canvas))
+        self.pdf_list_canvas.bind('<Leave>', lambda event, canvas=self.pdf_list_canvas: self.unbound_to_mousewheel(event, canvas))
         
-    def filter_pdf_list(self, event=None):
-        """Filter pdf list based on search entry. This will hide any buttons that don't match the search string."""
-        query = self.search_entry.get().lower()  # Get the current search query and make it lowercase
-
-        # Clear current buttons
-        for widget in self.pdf_list_frame.winfo_children():
-            widget.destroy()
-
-        # If active button was among the destroyed, clear the reference
-        self.active_button = None
-
-        # Filter and display buttons based on the search query.
-        for pdf_file in self.pdf_files:
-            if query in pdf_file.lower():  # Check if query is part of the file name
-                btn = tk.Button(self.pdf_list_frame, text=pdf_file, relief="raised")
-                btn.pdf_file = pdf_file  # Attach pdf_file as an attribute of the button
-                btn.pack(fill="x")
-                btn.config(command=lambda b=btn, pdf=pdf_file: self.select_pdf(b, pdf))
+    def schedule_pdf_filter(self):
+        """Filters the PDF list FILTER_DELAY_MS after the last keystroke, so fast typing only filters once."""
+        if self.pdf_filter_after is not None:
+            self.root.after_cancel(self.pdf_filter_after)
+        self.pdf_filter_after = self.root.after(FILTER_DELAY_MS, self.filter_pdf_list)
 
+    def filter_pdf_list(self, event=None):
+        """Filter pdf list based on search entry. Only the PDFs containing the search string are shown."""
+        self.pdf_filter_after = None
+        with instrumentation.span('gui.filter'):
+            self.pdf_list.set_items(self.pdf_filter.filter(self.search_entry.get()))
 
     def bound_to_mousewheel(self, event, passed_canvas):
         """Event handler for binding the mouse wheel scroll event to the canvas."""
@@ -386,57 +557,120 @@ class FileUpdaterGUI:
 
     # https://www.tutorialspoint.com/python/tk_scrollbar.htm
     def setup_scrollable_results_frame(self):
-        """Setup frame to hold the results output"""
+        """Setup the list holding the results output"""
         
-        # Scrollable canvas set immediately to the right of the PDF list
-        self.canvas = tk.Canvas(self.left_frame)
-        scrollbar = ttk.Scrollbar(self.left_frame, orient="vertical", command=self.canvas.yview)
-        self.canvas.config(yscrollcommand=scrollbar.set)
-        self.canvas.pack(side="left", fill="both", expand=True)
-        scrollbar.pack(side="left", fill="y")
-
-        # Frame to hold the stack of results
-        self.results_frame = ttk.Frame(self.canvas)
-        self.canvas.create_window((0, 0), window=self.results_frame, anchor="nw")
-
-        # Allow results list to be resized with the window
-        self.results_frame.bind("<Configure>", lambda e: self.canvas.configure(scrollregion=self.canvas.bbox("all")))
+        # Scrollable list set immediately to the right of the PDF list. Like the PDF list it only draws the visible results.
+        self.results_list = VirtualList(self.left_frame, classify_result, lines=3, gap=10)
+        self.results_list.pack(fill="both", expand=True)
+        self.canvas = self.results_list.canvas
    
     def populate_pdf_list(self):
-        """Get all the PDF files in the TMT directory and add them to the PDF list frame."""
-            # First, clear all existing buttons in the frame
-        for widget in self.pdf_list_frame.winfo_children():
-            widget.destroy()
+        """Get all the PDF files in the TMT directory and show them (filtered by the search entry) in the PDF list."""
+        self.pdf_files = self.pdf_watch.get_names() if self.pdf_watch.directory == self.tmt_dir else None # Latest snapshot from the directory watcher
+        if self.pdf_files is None:
+            self.pdf_files = sorted(f for f in os.listdir(self.tmt_dir) if f.endswith('.pdf')) # Not scanned yet
+        self.pdf_filter.set_items(self.pdf_files)
+        self.filter_pdf_list()
             
-        self.pdf_files = [f for f in os.listdir(self.tmt_dir) if f.endswith('.pdf')]
-        
-        # Create button for each file
-        for pdf_file in self.pdf_files:
-            btn = tk.Button(self.pdf_list_frame, text=pdf_file, relief="raised")
-            btn.pack(fill="x")
-            btn.config(command=lambda b=btn, pdf=pdf_file: self.select_pdf(b, pdf))
+    def select_pdf(self, pdf_file):
+        """Called with a PDF file when it is selected in the PDF list. Compares it with the TAF in the background (see poll_comparisons) and prefetches the neighbouring PDFs."""
+        self.selected_pdf = os.path.join(self.tmt_dir, pdf_file) # Get TMT dir
+        self.results_list.set_items([]) # Clear the previous PDF's results while this one is compared
+        neighbours = [os.path.join(self.tmt_dir, neighbour) for neighbour in self.pdf_list.get_neighbours(pdf_file, PREFETCH_NEIGHBOURS)]
+        self.comparison_worker.request(self.selected_pdf, self.use_native_parts.get(), neighbours)
+
+    def poll_comparisons(self):
+        """Displays the comparison of the selected PDF when the comparison worker has finished it. Results of PDFs that are no longer selected are ignored. Runs on the Tk thread."""
+        while True:
+            try:
+                message, pdf_path, value = self.comparison_worker.queue.get_nowait()
+            except queue.Empty:
+                break
+            if pdf_path != self.selected_pdf:
+                continue
             
-    def select_pdf(self, button, pdf_file):
-        """Called with a PDF file. Calls check with TAF file and displays the results."""
-        if self.active_button and self.active_button.winfo_exists():
-            self.active_button.config(relief="raised")  # Reset the previous active button
-        button.config(relief="sunken")  # Set the new button to look pressed
-        self.active_button = button  # Update the reference to the active button
-        pdf_path = os.path.join(self.tmt_dir, pdf_file) # Get TMT dir
-        print(f"pdf_path: {pdf_path}")
-        
-        # Create instance of ComparePdfTaf and compare the PDF to the TAF files
-        comparer = ComparePdfTaf(pdf_path, self.file_manager)
-        comparison_results = comparer.compare_pdf_taf()
-        
-        # Check if the TAF file was found. If not, display an error message and end.
-        if comparison_results is False:
-            messagebox.showerror("Error", "TAF File not Found!")
+            # Check the comparison worked and the TAF file was found. If not, display an error message.
+            if message == 'error':
+                messagebox.showerror("Error", f"Could not compare {os.path.basename(pdf_path)}:\n{value}")
+            elif value is False:
+                messagebox.showerror("Error", "TAF File not Found!")
+            else:
+                self.display_comparison_results(value) # Display the results in the output list
+        self.root.after(50, self.poll_comparisons)
+
+    def toggle_instrumentation(self):
+        """Starts or stops collecting the timings (and the profile) when a Diagnostics checkbox is clicked. Profiling also turns on the timings."""
+        if self.profile_var.get():
+            self.instrument_var.set(True)
+        if self.instrument_var.get():
+            if self.profile_var.get() != (instrumentation.profile is not None):
+                instrumentation.disable()
+                instrumentation.reset() # The profile is only started with a new run
+            instrumentation.enable(self.profile_var.get())
+        else:
+            instrumentation.disable()
+
+    def show_run_summary(self):
+        """Shows the timings and counters collected since the run started in a separate window."""
+        window = tk.Toplevel(self.root)
+        window.title("Run Summary")
+        text = scrolledtext.ScrolledText(window, width=110, height=30, font=("Courier", 9))
+        text.pack(expand=True, fill="both")
+        if not instrumentation.enabled and not instrumentation.spans and not instrumentation.counters:
+            text.insert(tk.END, "Nothing collected. Turn on Diagnostics > Collect Timings and run a search, comparison or update.")
+        else:
+            text.insert(tk.END, "\n".join(instrumentation.summary()))
+        text.config(state="disabled")
+
+    def export_instrumentation(self, kind):
+        """Saves the collected timings as JSON or the cProfile profile as a pstats file."""
+        extension = '.json' if kind == 'json' else '.pstats'
+        file_path = filedialog.asksaveasfilename(initialdir=self.config_manager.app_dir, title="Export Diagnostics", defaultextension=extension,
+                                                 filetypes=((f"{kind} files", "*" + extension), ("All files", "*.*")))
+        if not file_path:
+            return
+        try:
+            if kind == 'json':
+                instrumentation.export_json(file_path)
+            else:
+                instrumentation.export_pstats(file_path)
+        except (OSError, ValueError) as error:
+            messagebox.showerror("Error", f"Could not export:\n{error}")
+
+    def start_pdf_audit(self):
+        """Compares every PDF in the TMT directory with its TAF in the background and writes the CSV and HTML reports into a folder chosen by the user."""
+        output_dir = filedialog.askdirectory(initialdir=self.config_manager.app_dir, title="Select Folder for the Audit Report")
+        if not output_dir:
             return
-        print(f"comparison_results: {comparison_results}")
+        audit = PdfAudit(self.tmt_dir, self.taf_dir, self.geo_dir, self.pdf_cache_path, self.use_native_parts.get())
+        audit_queue = queue.Queue()
 
-        # Display the results in the output list
-        self.display_comparison_results(comparison_results)
+        def run_audit():
+            """Runs the audit in the app's worker pool and puts the report (or the error) on the queue for the Tk thread."""
+            try:
+                with instrumentation.profile_thread():
+                    report = audit.run(self.worker_pool)
+                audit_queue.put(('done', (report, report.write_reports(output_dir))))
+            except Exception as e:
+                audit_queue.put(('error', e))
+
+        threading.Thread(target=run_audit, daemon=True).start()
+        self.root.after(200, self.poll_pdf_audit, audit_queue)
+
+    def poll_pdf_audit(self, audit_queue):
+        """Shows the summary of the audit once it is finished. Reschedules itself until then."""
+        try:
+            message, value = audit_queue.get_nowait()
+        except queue.Empty:
+            self.root.after(200, self.poll_pdf_audit, audit_queue)
+            return
+        if message == 'error':
+            messagebox.showerror("Error", f"The audit failed: {value}")
+            return
+        report, (csv_path, html_path) = value
+        for line in report.summary():
+            print(line) # Includes the per-worker throughput
+        messagebox.showinfo("Audit Finished", "\n".join(report.summary()[:4]) + f"\n\nReports written to:\n{csv_path}\n{html_path}")
 
     def display_comparison_results(self, results):
         """Show the PDF-vs-TAF comparison, sorted A-Z / 0-9 by part number."""
@@ -450,68 +684,8 @@ class FileUpdaterGUI:
         results = sorted(results, key=lambda r: natural_key(r[0]))  # r[0] = part_number
         # -----------------------------------------------------------------
 
-        # ---------- 2. colour map / helper (unchanged) -------------------
-        geo_state_colors = {
-            'GEO missing revision': 'purple',
-            'No GEO found':         'purple',
-            r'Newer GEO.*':         'blue',
-            r'Latest GEO revision is.*': 'blue',
-            r'Program contains latest.*': 'white',
-        }
-
-        def get_color_based_on_geo_state(geo_state):
-            for pattern, color in geo_state_colors.items():
-                if re.search(pattern, geo_state):
-                    return color
-            return 'white'
-        # -----------------------------------------------------------------
-
-        # ---------- 3. clear previous widgets ----------------------------
-        for widget in self.results_frame.winfo_children():
-            widget.destroy()
+        # ---------- 2. show them in the results list ----------------------
+        # The colours and text come from classify_result, which the audit report uses too
+        self.results_list.set_items(results)
+        self.results_list.canvas.yview_moveto(0)
         # -----------------------------------------------------------------
-
-        # ---------- 4. build the new, sorted display ---------------------
-        for (part_number, match,
-            taf_before_underscore, pdf_before_underscore,
-            taf_after_underscore, pdf_after_underscore,
-            geo_state) in results:
-
-            if (match
-                and taf_after_underscore != "Missing Revision"
-                and pdf_after_underscore != "Missing Revision"):
-                bg_color = 'green'
-                text = (f"{part_number}\n"
-                        f"Revision: {pdf_after_underscore}\n"
-                        f"GEO State: {geo_state}")
-
-            elif (match
-                and taf_after_underscore == "Missing Revision"
-                and pdf_after_underscore == "Missing Revision"):
-                bg_color = 'orange'
-                text = (f"{part_number}\n"
-                        f"TAF & PDF Missing Revision\n"
-                        f"GEO State: {geo_state}")
-
-            else:
-                bg_color = 'red'
-                if pdf_before_underscore == "Part not found":
-                    text = (f"{part_number}\n"
-                            f"PDF: {pdf_before_underscore}, "
-                            f"TAF: {taf_before_underscore}_{taf_after_underscore}\n"
-                            f"GEO State: {geo_state}")
-                elif taf_after_underscore != "Missing TAF":
-                    text = (f"{part_number}\n"
-                            f"PDF: {pdf_before_underscore}_{pdf_after_underscore}, "
-                            f"TAF: {taf_before_underscore}_{taf_after_underscore}\n"
-                            f"GEO State: {geo_state}")
-                else:
-                    text = (f"{part_number}\n"
-                            f"PDF: {pdf_before_underscore}_{pdf_after_underscore}, "
-                            f"TAF: {taf_before_underscore}\n"
-                            f"GEO State: {geo_state}")
-
-            fg_color = get_color_based_on_geo_state(geo_state)
-            tk.Label(self.results_frame, text=text,
-                    bg=bg_color, fg=fg_color,
-                    padx=15, pady=5).pack(fill='both', padx=5, pady=5)
\ No newline at end of file
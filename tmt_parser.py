@@ -0,0 +1,71 @@
+# This module contains all code related to reading the native TruTops .TMT program files
+import os
+import re
+
+class TmtProgram:
+    """This class holds what the comparison needs from a TMT file: the TMT path from the header, the TAF name from the sheet record and the GEO path of every part."""
+    def __init__(self, file_path):
+        """Creates an empty program for the TMT file at file_path."""
+        self.file_path = file_path
+        self.tmt_path = None # Path written in the bereich Kopf header
+        self.taf_name = None # Source TAF name from the sheet record (#~11) of the Geo section
+        self.geo_paths = [] # GEO path of every part in the Technologie section, in file order
+
+    def get_parts(self):
+        """Returns the part names (GEO name without the folders, extension or whitespace) in the same format PdfSearcher.search_pdf returns them with all_parts."""
+        return [re.sub(r'\s+', '', re.split(r"[\\/]", geo_path)[-1].rsplit('.', 1)[0]) for geo_path in self.geo_paths]
+
+def parse_tmt(file_path):
+    """Reads a TMT file line by line and returns a TmtProgram. Only the header, the sheet record and the [T1_S_TEIL] part records are looked at,
+    and reading stops at the bereich ProzessParameter section, so nothing is kept in memory apart from the results."""
+    program = TmtProgram(file_path)
+    section = None
+    pending = None # Name of the record whose next lines are being read
+    record_lines = 0
+
+    # TMT files are written by TruTops on Windows so latin-1 is used to read every byte without errors
+    with open(file_path, 'r', encoding='latin-1') as file:
+        for line in file:
+            line = line.rstrip('\r\n')
+
+            # Track which "bereich" (section) the line is in
+            if line.startswith('bereich '):
+                section = line[8:].split(' ', 1)[0]
+                if section == 'ProzessParameter':
+                    break # Machine parameters only, no part references after this
+                continue
+
+            if section == 'Kopf':
+                if program.tmt_path is None and line.startswith('"'):
+                    program.tmt_path = line.strip('"')
+            elif section == 'Geo':
+                # The sheet record (#~11) is followed by the sheet line and then the TAF name
+                if pending == '#~11':
+                    record_lines += 1
+                    if record_lines == 2:
+                        program.taf_name = line.strip()
+                        pending = None
+                elif program.taf_name is None and line.startswith('#~11 '):
+                    pending, record_lines = '#~11', 0
+            elif section == 'Technologie':
+                # A part record is [T1_S_TEIL] followed by three lines of ids and flags and then the quoted GEO path (empty for internal parts)
+                if pending == '[T1_S_TEIL]':
+                    record_lines += 1
+                    if line.startswith('"') or line.startswith('['):
+                        geo_path = line.rstrip(';').strip('"')
+                        if geo_path.upper().endswith('.GEO'):
+                            program.geo_paths.append(geo_path)
+                        pending = None
+                    elif record_lines > 4:
+                        pending = None # Unexpected record layout, don't read the rest of the section as part of it
+                elif line.startswith('[T1_S_TEIL]'):
+                    pending, record_lines = '[T1_S_TEIL]', 0
+    return program
+
+def find_tmt_for_pdf(pdf_path):
+    """Returns the path of the TMT file with the same name as the PDF (in the same folder), or None if there isn't one."""
+    base_path = os.path.splitext(pdf_path)[0]
+    for extension in ('.TMT', '.tmt', '.Tmt'):
+        if os.path.isfile(base_path + extension):
+            return base_path + extension
+    return None
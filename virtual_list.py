@@ -0,0 +1,153 @@
+# This module contains the virtualised list widget and the incremental filter used by the PDF list and the comparison results in the GUI
+import tkinter as tk
+from tkinter import ttk, font as tkfont
+
+SELECTED_COLOR = 'gray75' # Background of the selected row
+
+class VirtualList:
+    """This class is a scrollable list that only draws the rows that are visible. The rows are kept in a plain list (see set_items) and a small pool of canvas rectangles and texts
+    is reused for whatever is scrolled into view, so thousands of PDFs or results take the same time and memory to show as twenty. render_row turns an item into (bg, fg, text).
+    With on_select the rows can be clicked (or moved through with the arrow keys) and the selected row is drawn darker with a heavier outline."""
+    def __init__(self, parent, render_row, on_select=None, lines=1, font=None, width=None, pady=5, gap=0):
+        """Creates the canvas and scrollbar in parent (pack them with pack). lines is the number of text lines in a row, pady the space above and below the text
+        and gap the space between rows. The row height is calculated from the font so the text always fits."""
+        self.render_row = render_row
+        self.on_select = on_select
+        self.font = tkfont.Font(font=font) if font is not None else tkfont.nametofont('TkDefaultFont')
+        self.gap = gap
+        self.row_height = self.font.metrics('linespace') * lines + 2 * pady + gap
+        self.items = []
+        self.selected = None # The selected item (not its index, so it stays selected when the list is filtered)
+        self.rows = [] # Pool of (rectangle, text) canvas items, one per visible row
+        self.redraw_pending = False
+
+        self.canvas = tk.Canvas(parent, highlightthickness=0, yscrollincrement=self.row_height)
+        if width is not None:
+            self.canvas.configure(width=width)
+        self.scrollbar = ttk.Scrollbar(parent, orient="vertical", command=self.canvas.yview)
+        self.canvas.configure(yscrollcommand=self.on_scroll)
+        self.canvas.bind('<Configure>', lambda event: self.schedule_redraw())
+        if on_select is not None:
+            self.canvas.bind('<Button-1>', self.on_click)
+            self.canvas.bind('<Up>', lambda event: self.move_selection(-1))
+            self.canvas.bind('<Down>', lambda event: self.move_selection(1))
+
+    def pack(self, **options):
+        """Packs the canvas and the scrollbar side by side."""
+        self.canvas.pack(side="left", **options)
+        self.scrollbar.pack(side="left", fill="y")
+
+    def set_items(self, items):
+        """Replaces the rows of the list. The scroll position is kept where possible."""
+        self.items = items
+        self.canvas.configure(scrollregion=(0, 0, 0, len(items) * self.row_height))
+        self.schedule_redraw()
+
+    def on_scroll(self, first, last):
+        """Moves the scrollbar and redraws the rows that came into view."""
+        self.scrollbar.set(first, last)
+        self.schedule_redraw()
+
+    def schedule_redraw(self):
+        """Redraws once the pending events are handled, so a burst of scroll events only draws once."""
+        if not self.redraw_pending:
+            self.redraw_pending = True
+            self.canvas.after_idle(self.redraw)
+
+    def redraw(self):
+        """Draws the visible rows, reusing the canvas items of the pool."""
+        self.redraw_pending = False
+        left = self.canvas.canvasx(0)
+        width = self.canvas.winfo_width()
+        height = self.canvas.winfo_height()
+        first = max(int(self.canvas.canvasy(0) // self.row_height), 0)
+        count = min(height // self.row_height + 2, max(len(self.items) - first, 0))
+
+        # Grow the pool to the number of rows that fit in the window
+        while len(self.rows) < count:
+            self.rows.append((self.canvas.create_rectangle(0, 0, 0, 0), self.canvas.create_text(0, 0, font=self.font, justify="center")))
+        for slot, (rectangle, text_item) in enumerate(self.rows):
+            if slot >= count:
+                self.canvas.itemconfigure(rectangle, state="hidden")
+                self.canvas.itemconfigure(text_item, state="hidden")
+                continue
+            item = self.items[first + slot]
+            bg_color, fg_color, text = self.render_row(item)
+            top = (first + slot) * self.row_height
+            selected = self.on_select is not None and item == self.selected
+            self.canvas.coords(rectangle, left + self.gap, top + self.gap / 2, left + width - self.gap - 1, top + self.row_height - self.gap / 2 - 1)
+            self.canvas.itemconfigure(rectangle, state="normal", fill=SELECTED_COLOR if selected else bg_color, outline="gray25" if selected else "gray60", width=2 if selected else 1)
+            self.canvas.coords(text_item, left + width / 2, top + self.row_height / 2)
+            self.canvas.itemconfigure(text_item, state="normal", text=text, fill=fg_color)
+
+    def on_click(self, event):
+        """Selects the clicked row."""
+        self.canvas.focus_set() # So the arrow keys move the selection
+        index = int(self.canvas.canvasy(event.y) // self.row_height)
+        if 0 <= index < len(self.items):
+            self.select(self.items[index])
+
+    def move_selection(self, step):
+        """Selects the row above (step -1) or below (step 1) the selected one and scrolls it into view."""
+        if not self.items:
+            return
+        try:
+            index = self.items.index(self.selected) + step
+        except ValueError:
+            index = 0
+        index = min(max(index, 0), len(self.items) - 1)
+        self.see(index)
+        self.select(self.items[index])
+
+    def see(self, index):
+        """Scrolls the row at index into view."""
+        first = int(self.canvas.canvasy(0) // self.row_height)
+        visible = max(self.canvas.winfo_height() // self.row_height, 1)
+        if index < first:
+            self.canvas.yview_moveto(index / len(self.items))
+        elif index >= first + visible:
+            self.canvas.yview_moveto((index - visible + 1) / len(self.items))
+
+    def select(self, item):
+        """Selects an item, redraws and calls on_select with it."""
+        self.selected = item
+        self.schedule_redraw()
+        self.on_select(item)
+
+    def get_neighbours(self, item, count=1):
+        """Returns the items up to count rows above and below item (nearest first), or an empty list if it isn't in the list."""
+        try:
+            index = self.items.index(item)
+        except ValueError:
+            return []
+        neighbours = []
+        for distance in range(1, count + 1):
+            neighbours += [self.items[i] for i in (index + distance, index - distance) if 0 <= i < len(self.items)]
+        return neighbours
+
+class IncrementalFilter:
+    """This class filters a list of names by a case insensitive substring. When the query only grows (typing another character) only the previous matches are checked again,
+    so filtering gets faster as the query gets longer. The names are lowercased once in set_items instead of on every keystroke."""
+    def __init__(self, items=()):
+        """Sets the names to filter."""
+        self.set_items(items)
+
+    def set_items(self, items):
+        """Replaces the names (for example when the watcher finds a new PDF). The next filter checks every name again."""
+        self.items = list(items)
+        self.keys = [item.lower() for item in self.items]
+        self.query = None
+        self.matches = None # Indexes of the names matching query, in order
+
+    def filter(self, query):
+        """Returns the names containing query, in their original order."""
+        query = query.lower()
+        if self.query is not None and query.startswith(self.query):
+            candidates = self.matches # Narrow down the previous matches
+        else:
+            candidates = range(len(self.items))
+        keys = self.keys
+        self.matches = [index for index in candidates if query in keys[index]]
+        self.query = query
+        items = self.items
+        return [items[index] for index in self.matches]
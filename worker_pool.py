@@ -0,0 +1,95 @@
+# This module contains the long-lived worker pool shared by the PDF search and comparison features
+import os
+import queue
+import threading
+import multiprocessing
+
+def prewarm_worker(_task_number):
+    """Imports PyMuPDF in a worker process so the first real task doesn't pay for it. Returns the worker's process id."""
+    import fitz # Imported for its side effect (loading PyMuPDF into the worker)
+    return os.getpid()
+
+class WorkerError:
+    """Wraps an exception raised in a worker so it can be passed back through the results queue."""
+    def __init__(self, error):
+        self.error = error
+
+class WorkerPool:
+    """This class owns one multiprocessing pool for the lifetime of the application. Under the PyInstaller build every new pool has to spawn fresh interpreters and import fitz again,
+    so the pool is started (and the workers prewarmed) in the background at launch and then reused by every search and comparison. shutdown() is called when the window closes."""
+    def __init__(self, processes=None):
+        """Sets the number of worker processes (None uses one per CPU core)."""
+        self.processes = processes or os.cpu_count() or 1
+        self.pool = None
+        self.ready = threading.Event()
+        self.start_thread = None
+
+    def start(self):
+        """Starts the pool on a background thread so the window can open while the workers spawn."""
+        if self.start_thread is None:
+            self.start_thread = threading.Thread(target=self.create_pool, daemon=True)
+            self.start_thread.start()
+
+    def create_pool(self):
+        """Creates the pool and hands out one prewarm task per worker so PyMuPDF is loaded before the first search."""
+        try:
+            self.pool = multiprocessing.Pool(self.processes)
+            self.pool.map(prewarm_worker, range(self.processes), chunksize=1)
+        except Exception as e:
+            print(f"Error starting worker pool: {e}")
+        finally:
+            self.ready.set() # Callers waiting on the pool are released even if it failed to start
+
+    def get_pool(self):
+        """Returns the pool, starting it if needed and waiting until the workers are ready."""
+        self.start()
+        self.ready.wait()
+        if self.pool is None:
+            raise RuntimeError("The worker pool could not be started.")
+        return self.pool
+
+    def apply(self, func, args=()):
+        """Runs one task in the pool and returns its result."""
+        return self.get_pool().apply(func, args)
+
+    def imap_unordered(self, func, items, cancel_event=None):
+        """Yields func(item) for every item in the order the tasks finish. Only a few tasks per worker are queued at a time,
+        so when the cancel_event is set no new tasks are handed out and the workers are free for the next search almost straight away."""
+        pool = self.get_pool()
+        results = queue.Queue()
+        items = iter(items)
+        in_flight = 0
+
+        def submit():
+            """Hand the next item to the pool. Returns False when there are no items left or the job was cancelled."""
+            if cancel_event is not None and cancel_event.is_set():
+                return False
+            try:
+                item = next(items)
+            except StopIteration:
+                return False
+            pool.apply_async(func, (item,), callback=results.put, error_callback=lambda error: results.put(WorkerError(error)))
+            return True
+
+        # Keep two tasks per worker queued so no worker waits for the next one
+        while in_flight < self.processes * 2 and submit():
+            in_flight += 1
+        while in_flight:
+            result = results.get()
+            in_flight -= 1
+            if isinstance(result, WorkerError):
+                raise result.error
+            if submit():
+                in_flight += 1
+            yield result
+            if cancel_event is not None and cancel_event.is_set():
+                return # Tasks still running finish in the background and their results are dropped
+
+    def shutdown(self):
+        """Stops the worker processes. Called when the application closes."""
+        if self.start_thread is not None:
+            self.ready.wait()
+        if self.pool is not None:
+            self.pool.terminate()
+            self.pool.join()
+            self.pool = None